@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import timeit
+
+if __name__ == '__main__' and __package__ is None:
+    import sys
+    # __file__ should be defined in this case
+    PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PARENT_DIR)
+
+from françoise.context import estimate_tokens
+from françoise.mail import normalize_body
+
+parser = argparse.ArgumentParser(
+        description="Benchmarks email body normalization over Mailgun `body-plain` payloads.")
+
+parser.add_argument("-n", "--number", type=int, default=2000)
+parser.add_argument("--turns", type=int, default=20, help="letters of quoted history in threaded payloads")
+
+args = parser.parse_args()
+
+REPLY = """Bonjour Françoise,
+
+Merci pour ta lettre ! Ce week-end, je suis allé au marché avec ma sœur et nous avons acheté des fraises.
+Est-ce que tu aimes cuisiner ? Moi, j'essaie de faire une tarte mais c'est difficile.
+
+À bientôt,
+Bob"""
+
+LETTER = """Cher Bob,
+
+Quelle belle journée tu as passée ! J'adore les marchés du dimanche, surtout au printemps.
+Oui, j'aime beaucoup cuisiner. Ma spécialité, c'est la ratatouille de ma grand-mère.
+Petite correction : on dit « je suis allé au marché », et c'est parfait !
+
+Bises,
+Françoise"""
+
+
+def quote(text: str) -> str:
+    return '\n'.join('> %s' % (line,) if line else '>' for line in text.split('\n'))
+
+
+def create_gmail_thread(turns: int) -> str:
+    # NOTE every reply quotes the whole thread before it
+    body = LETTER
+    for i in range(turns):
+        letter = REPLY if i % 2 else LETTER
+        body = '%s\n\nOn Mon, Mar %d, 2025 at 10:12 AM Françoise <francoise.1@example.com> wrote:\n%s' % (
+                letter,
+                i % 28 + 1,
+                quote(body))
+    return '%s\n\nLe lun. 3 mars 2025 à 10:12, Françoise <francoise.1@example.com> a écrit\u202f:\n%s' % (
+            REPLY,
+            quote(body))
+
+
+def create_outlook_thread(turns: int) -> str:
+    body = LETTER
+    for i in range(turns):
+        body = '%s\n\nFrom: Françoise <francoise.1@example.com>\nSent: Monday, March 3, 2025 10:12 AM\nTo: Bob <bob@example.com>\nSubject: Re: Bonjour\n\n%s' % (
+                REPLY if i % 2 else LETTER,
+                body)
+    return body.replace('\n', '\r\n')
+
+
+payloads = {
+    'plain': REPLY,
+    'mobile': '%s\n\nEnvoyé de mon iPhone' % (REPLY,),
+    'inline': '> Est-ce que tu aimes cuisiner ?\nOui !\n> Et la musique ?\nAussi.\n\n-- \nBob',
+    'gmail': create_gmail_thread(args.turns),
+    'outlook': create_outlook_thread(args.turns)
+}
+
+print('%-8s %10s %10s %10s %10s %8s' % ('payload', 'chars', 'kept', 'tokens', 'kept', 'µs/call'))
+for name, body in payloads.items():
+    normalized = normalize_body(body)
+    seconds = timeit.timeit(lambda: normalize_body(body), number=args.number)
+    print('%-8s %10d %10d %10d %10d %8.1f' % (
+        name,
+        len(body),
+        len(normalized),
+        estimate_tokens(body),
+        estimate_tokens(normalized),
+        seconds / args.number * 1e6))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+WORDS = ('Bonjour', 'Bob', 'merci', 'pour', 'ta', 'lettre', 'je', 'suis', 'contente', 'de', 'te', 'lire')
+
+
+def create_ollama_app(
+        models: tuple = ('gemma3:latest',),
+        latency: float = 0.2,
+        token_rate: float = 50.0,
+        response_tokens: int = 100,
+        load_seconds: float = 0.0,
+        concurrency: int = 4) -> FastAPI:
+    # NOTE stands in for Ollama's `/api/chat`, a generation waits `latency`
+    # for the prompt then streams `response_tokens` at `token_rate`, and at
+    # most `concurrency` generations run at once, like `OLLAMA_NUM_PARALLEL`
+    app = FastAPI()
+    slots = asyncio.Semaphore(concurrency)
+    loaded = set()
+
+    def create_chunk(model: str, content: str, done: bool = False, **kwargs) -> dict:
+        return {'model': model, 'message': {'role': 'assistant', 'content': content}, 'done': done, **kwargs}
+
+    def create_final_chunk(model: str, content: str, prompt_tokens: int, load_duration: float, started: float) -> dict:
+        return create_chunk(
+                model,
+                content,
+                done=True,
+                done_reason='stop',
+                prompt_eval_count=prompt_tokens,
+                prompt_eval_duration=int(latency * 1e9),
+                eval_count=response_tokens,
+                eval_duration=int(response_tokens / token_rate * 1e9),
+                load_duration=int(load_duration * 1e9),
+                total_duration=int((time.monotonic() - started) * 1e9))
+
+    async def load(model: str) -> float:
+        if model in loaded:
+            return 0.0
+        await asyncio.sleep(load_seconds)
+        loaded.add(model)
+        return load_seconds
+
+    @app.get('/api/tags')
+    def tags():
+        return {'models': [{'name': name} for name in models]}
+
+    @app.get('/api/ps')
+    def ps():
+        return {'models': [{'name': name} for name in loaded]}
+
+    @app.post('/api/chat')
+    async def chat(request: Request):
+        data = await request.json()
+        model = data.get('model')
+        if ':' not in model:
+            model = '%s:latest' % (model,)
+        started = time.monotonic()
+        prompt_tokens = sum(len(message.get('content', '')) // 4 for message in data.get('messages', []))
+        tokens = [WORDS[i % len(WORDS)] + ' ' for i in range(response_tokens)]
+
+        if not data.get('messages'):
+            load_duration = await load(model)
+            return create_chunk(model, '', done=True, done_reason='load', load_duration=int(load_duration * 1e9))
+
+        if not data.get('stream', True):
+            async with slots:
+                load_duration = await load(model)
+                await asyncio.sleep(latency + response_tokens / token_rate)
+            return JSONResponse(create_final_chunk(model, ''.join(tokens), prompt_tokens, load_duration, started))
+
+        async def stream():
+            async with slots:
+                load_duration = await load(model)
+                await asyncio.sleep(latency)
+                for token in tokens:
+                    yield json.dumps(create_chunk(model, token)) + '\n'
+                    await asyncio.sleep(1 / token_rate)
+            yield json.dumps(create_final_chunk(model, '', prompt_tokens, load_duration, started)) + '\n'
+
+        return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+    return app
+
+
+def create_mailgun_app(on_message=None, latency: float = 0.05) -> FastAPI:
+    # NOTE stands in for Mailgun's messages API, `on_message` is called with
+    # the time each email arrived and its form fields
+    app = FastAPI()
+    app.state.messages = []
+
+    @app.post('/v3/{domain}/messages')
+    async def messages(domain: str, request: Request):
+        form = dict(await request.form())
+        app.state.messages.append((time.time(), form))
+        if on_message:
+            on_message(time.time(), form)
+        await asyncio.sleep(latency)
+        return {'id': '<%d@%s>' % (len(app.state.messages), domain), 'message': 'Queued. Thank you.'}
+
+    return app
+
+
+class Server:
+    # NOTE serves an app on its own thread and event loop
+    def __init__(self, app, port: int, host: str = '127.0.0.1'):
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level='warning', lifespan='on'))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.url = 'http://%s:%d' % (host, port)
+
+    def start(self, timeout: float = 30.0) -> None:
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise Exception('server on %s failed to start' % (self.url,))
+            time.sleep(0.05)
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Serves stand-ins for Ollama and Mailgun, to point a running app at.")
+
+    parser.add_argument("--ollama-port", type=int, default=11435)
+    parser.add_argument("--mailgun-port", type=int, default=11436)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="tokens per second")
+    parser.add_argument("--response-tokens", type=int, default=100)
+    parser.add_argument("--load-seconds", type=float, default=0.0, help="seconds to load a model the first time")
+    parser.add_argument("--ollama-concurrency", type=int, default=4)
+    parser.add_argument("--mailgun-latency", type=float, default=0.05)
+
+    args = parser.parse_args()
+
+    servers = [
+        Server(create_ollama_app(
+            latency=args.latency,
+            token_rate=args.token_rate,
+            response_tokens=args.response_tokens,
+            load_seconds=args.load_seconds,
+            concurrency=args.ollama_concurrency), args.ollama_port),
+        Server(create_mailgun_app(latency=args.mailgun_latency), args.mailgun_port)
+    ]
+    for server in servers:
+        server.start()
+        print('serving on %s' % (server.url,))
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for server in servers:
+            server.stop()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+if __name__ == '__main__' and __package__ is None:
+    import sys
+    # __file__ should be defined in this case
+    PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PARENT_DIR)
+
+import httpx
+from françoise.app import App
+from françoise.db import open_db
+from stubs import Server, create_mailgun_app, create_ollama_app
+
+parser = argparse.ArgumentParser(
+        description="Replays Mailgun webhooks at a target rate against the app, with Ollama and Mailgun stand-ins, "
+                    "and reports throughput, ack and reply latency percentiles and database growth.")
+
+parser.add_argument("-r", "--rate", type=float, default=5.0, help="webhooks per second")
+parser.add_argument("-d", "--duration", type=float, default=30.0, help="seconds to send webhooks for")
+parser.add_argument("--drain", type=float, default=60.0, help="seconds to wait for outstanding replies")
+parser.add_argument("-c", "--conversations", type=int, default=100)
+parser.add_argument("--skew", type=float, default=0.0,
+                    help="share of webhooks sent to the first conversation, to simulate a prolific user")
+parser.add_argument("--body", type=str, default='plain', choices=['plain', 'thread'])
+parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+parser.add_argument("--token-rate", type=float, default=50.0, help="tokens per second")
+parser.add_argument("--response-tokens", type=int, default=100)
+parser.add_argument("--load-seconds", type=float, default=0.0, help="seconds to load a model the first time")
+parser.add_argument("--ollama-concurrency", type=int, default=4)
+parser.add_argument("--mailgun-latency", type=float, default=0.05)
+parser.add_argument("--port", type=int, default=18000, help="first of the three ports to serve on")
+parser.add_argument("-db", "--database", type=str, help="defaults to a temporary file")
+parser.add_argument("-s", "--set", type=str, action='append', default=[],
+                    help="app configuration as `KEY=value`, as in `--set WORKER_CONCURRENCY=8`")
+
+args = parser.parse_args()
+
+REPLY = """Bonjour Françoise,
+
+Merci pour ta lettre ! Ce week-end, je suis allé au marché avec ma sœur et nous avons acheté des fraises.
+Est-ce que tu aimes cuisiner ? Moi, j'essaie de faire une tarte mais c'est difficile.
+
+À bientôt,
+Bob"""
+
+
+def create_body(turns: int) -> str:
+    body = REPLY
+    for i in range(turns):
+        body = '%s\n\nOn Mon, Mar %d, 2025 at 10:12 AM Françoise <francoise.1@example.com> wrote:\n%s' % (
+                REPLY,
+                i % 28 + 1,
+                '\n'.join('> %s' % (line,) for line in body.split('\n')))
+    return body
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def get_size(url: str) -> int:
+    return sum(os.path.getsize(url + suffix) for suffix in ('', '-wal') if os.path.exists(url + suffix))
+
+
+def count_rows(url: str) -> dict[str, int]:
+    with open_db(url) as db:
+        return {table_name: db.connection.execute('SELECT COUNT(*) FROM %s' % (table_name,)).fetchone()[0]
+                for table_name in ('messages', 'jobs', 'generations')}
+
+
+def seed(url: str, conversations: int) -> None:
+    with open_db(url) as db:
+        db.migrate()
+        db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}, a pen pal writing to {user_name}.')
+        db.onboard_users([{
+            'name': 'User %d' % (i,),
+            'email': 'user%d@example.com' % (i,),
+            'salt': 'salt',
+            'password': 'password',
+            'agent_id': 1,
+            'proficiency': 'A2',
+            'model': 'gemma3'
+        } for i in range(1, conversations + 1)])
+
+
+def create_form(conversation_id: int, message_id: str, body: str) -> dict[str, str]:
+    headers = [
+        ['To', '"Françoise.%d" <francoise.%d@example.com>' % (conversation_id, conversation_id)],
+        ['Message-Id', message_id]
+    ]
+    return {
+        'message-headers': json.dumps(headers, ensure_ascii=False, separators=(',', ':')),
+        'body-plain': body,
+        'sender': 'user%d@example.com' % (conversation_id,),
+        'subject': 'Re: Bonjour'
+    }
+
+
+async def generate_load(url: str, body: str, sent: dict, acks: list, statuses: dict) -> None:
+    # NOTE open loop, webhooks go out on schedule however slow the app is
+    async with httpx.AsyncClient(base_url=url, timeout=60, limits=httpx.Limits(max_connections=None)) as client:
+        async def post(i: int) -> None:
+            if random.random() < args.skew:
+                conversation_id = 1
+            else:
+                conversation_id = random.randint(1, args.conversations)
+            message_id = '<%d.%d@example.com>' % (i, conversation_id)
+            started = time.monotonic()
+            sent[message_id] = time.time()
+            try:
+                response = await client.post('/mailgun', data=create_form(conversation_id, message_id, body))
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            acks.append(time.monotonic() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+        tasks = []
+        started = time.monotonic()
+        for i in range(int(args.rate * args.duration)):
+            await asyncio.sleep(max(0.0, started + i / args.rate - time.monotonic()))
+            tasks.append(asyncio.create_task(post(i)))
+        await asyncio.gather(*tasks)
+
+
+def main():
+    url = args.database
+    if not url:
+        fd, url = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+    seed(url, args.conversations)
+
+    replies = {}
+
+    def on_message(received_at: float, form: dict) -> None:
+        replies[form.get('h:In-Reply-To')] = received_at
+
+    ollama = Server(create_ollama_app(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        response_tokens=args.response_tokens,
+        load_seconds=args.load_seconds,
+        concurrency=args.ollama_concurrency), args.port + 1)
+    mailgun = Server(create_mailgun_app(on_message, latency=args.mailgun_latency), args.port + 2)
+
+    config = {
+        'DATABASE_URL': url,
+        'LLM_API_URLS': ollama.url,
+        'MAILGUN_API_URL': '%s/v3/example.com/messages' % (mailgun.url,),
+        'MAILGUN_API_KEY': 'key',
+        'MAILGUN_API_SENDER': 'francoise@example.com',
+        'SERVER_API_KEY': 'key',
+        'REPLY_COALESCE_WINDOW': '0',
+        'WORKER_POLL_INTERVAL': '0.1',
+        **dict(pair.split('=', 1) for pair in args.set)
+    }
+    app = Server(App(**config), args.port)
+
+    size, rows = get_size(url), count_rows(url)
+    body = REPLY if args.body == 'plain' else create_body(10)
+    sent, acks, statuses = {}, [], {}
+
+    for server in (ollama, mailgun, app):
+        server.start()
+    try:
+        started = time.monotonic()
+        asyncio.run(generate_load(app.url, body, sent, acks, statuses))
+        elapsed = time.monotonic() - started
+
+        deadline = time.monotonic() + args.drain
+        while time.monotonic() < deadline:
+            with open_db(url) as db:
+                pending = sum(count for (kind, status), count in db.count_jobs().items() if status != 'dead')
+            if not pending:
+                break
+            time.sleep(0.5)
+        replied_at = time.monotonic()
+    finally:
+        for server in (app, mailgun, ollama):
+            server.stop()
+
+    # NOTE coalesced messages share one reply, so latency is measured from
+    # the message each reply answers
+    latencies = [received_at - sent[message_id] for message_id, received_at in replies.items() if message_id in sent]
+    span = max(replies.values(), default=0) - min(sent.values(), default=0)
+
+    print('sent `%d` webhooks in %.1fs (%.1f/s), statuses %s' % (
+        len(acks), elapsed, len(acks) / elapsed, ', '.join('`%s` %d' % item for item in sorted(statuses.items()))))
+    print('received `%d` replies in %.1fs (%.1f/s), drained after %.1fs' % (
+        len(replies), span, len(replies) / span if span > 0 else 0, replied_at - started))
+    print('%-8s %10s %10s %10s %10s' % ('latency', 'p50', 'p95', 'p99', 'max'))
+    for name, values in (('ack', acks), ('reply', latencies)):
+        print('%-8s %10.3f %10.3f %10.3f %10.3f' % (
+            name,
+            percentile(values, 50),
+            percentile(values, 95),
+            percentile(values, 99),
+            max(values, default=float('nan'))))
+
+    growth = count_rows(url)
+    print('database grew by %.1f KiB, %s' % (
+        (get_size(url) - size) / 1024,
+        ', '.join('%s `%+d`' % (table_name, count - rows[table_name]) for table_name, count in growth.items())))
+
+    if not args.database:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(url + suffix):
+                os.remove(url + suffix)
+
+
+main()
@@ -1,12 +1,43 @@
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import logging
 import os
 import re
+import sqlite3
+import time
 from typing import Annotated, Optional
 
-from fastapi import BackgroundTasks, FastAPI, Form, Response, status
+from fastapi import FastAPI, Form, Response, status
+from fastapi.responses import PlainTextResponse
 
-from .chat import chat, get_prompt_message_from_conversation, message_tuple_to_dict
-from .db import open_db
-from .mail import parse_conversation_id_from_headers, send_mail
+from .admission import AdmissionController
+from .asyncdb import AsyncDatabase
+from .breaker import CircuitBreaker, CircuitOpen
+from .bumps import BumpScheduler, bumps_total
+from .cache import Cache
+from .chat import ChatClient
+from .context import ContextManager, get_token_budget, parse_token_budgets
+from .db import SCHEMA_VERSION, ConnectionPool, Database
+from .metrics import Counter, Gauge, Histogram, registry
+from .profiler import Profiler
+from .residency import ResidencyManager, parse_hours
+from .router import Router, parse_backend_urls
+from .scheduler import FairScheduler
+from .mail import MailClient, RateLimited, normalize_body, parse_conversation_id_from_headers
+from .worker import RetryLater, WorkerPool
+
+logger = logging.getLogger(__name__)
+
+stage_seconds = Histogram('francoise_reply_stage_seconds', 'Time spent per stage of a reply.', ('stage', 'model', 'agent'))
+reply_seconds = Histogram('francoise_reply_latency_seconds', 'Time from receiving an email to mailing its reply.', ('model', 'agent'))
+webhook_seconds = Histogram('francoise_webhook_seconds', 'Time taken to acknowledge a Mailgun webhook.')
+webhooks_total = Counter('francoise_webhooks_total', 'Mailgun webhooks by outcome.', ('outcome',))
+webhooks_in_flight = Gauge('francoise_webhooks_in_flight', 'Mailgun webhooks being handled.')
+jobs_queued = Gauge('francoise_jobs_queued', 'Jobs in the queue by status.', ('kind', 'status'))
+llm_in_flight = Gauge('francoise_llm_in_flight', 'Generations in flight per backend.', ('backend',))
+llm_healthy = Gauge('francoise_llm_healthy', 'Whether a backend passed its last health check.', ('backend',))
+llm_waiting = Gauge('francoise_llm_waiting', 'Generations waiting on the scheduler for a slot.')
+mail_circuit_open = Gauge('francoise_mail_circuit_open', 'Whether sends to Mailgun are paused by the circuit breaker.')
 
 
 def get_config(
@@ -19,77 +50,568 @@ def get_config(
 
 def App(**kwargs):
 
-    app = FastAPI()
-
     DATABASE_URL = get_config(kwargs, 'DATABASE_URL', 'data.db')
+    DATABASE_READERS = int(get_config(kwargs, 'DATABASE_READERS', '4'))
+    DATABASE_WRITE_BATCH = int(get_config(kwargs, 'DATABASE_WRITE_BATCH', '128'))
+    DATABASE_PRAGMAS = {
+        'journal_mode': get_config(kwargs, 'SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': get_config(kwargs, 'SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': int(get_config(kwargs, 'SQLITE_BUSY_TIMEOUT', '5000')),
+        'cache_size': int(get_config(kwargs, 'SQLITE_CACHE_SIZE', '-16000')),
+        'mmap_size': int(get_config(kwargs, 'SQLITE_MMAP_SIZE', '268435456'))
+    }
     LLM_API_CHAT_URL = get_config(kwargs, 'LLM_API_CHAT_URL', 'http://localhost:11434/api/chat')
+    # NOTE a comma separated list of Ollama backends that replaces `LLM_API_CHAT_URL`
+    LLM_API_URLS = parse_backend_urls(get_config(kwargs, 'LLM_API_URLS', LLM_API_CHAT_URL))
+    LLM_API_PROBE_INTERVAL = float(get_config(kwargs, 'LLM_API_PROBE_INTERVAL', '15'))
+    LLM_API_CONNECT_TIMEOUT = float(get_config(kwargs, 'LLM_API_CONNECT_TIMEOUT', '5'))
+    LLM_API_READ_TIMEOUT = float(get_config(kwargs, 'LLM_API_READ_TIMEOUT', '300'))
+    LLM_API_MAX_CONCURRENCY = int(get_config(kwargs, 'LLM_API_MAX_CONCURRENCY', '4'))
+    LLM_API_STREAM = get_config(kwargs, 'LLM_API_STREAM', 'true').lower() in ('1', 'true', 'yes')
+    LLM_API_STALL_TIMEOUT = float(get_config(kwargs, 'LLM_API_STALL_TIMEOUT', '30'))
+    # NOTE per model budgets are formatted as `gemma3=32768,llama3.2=8192`, and
+    # each is the context Ollama is asked to load the model with
+    LLM_CONTEXT_TOKENS = int(get_config(kwargs, 'LLM_CONTEXT_TOKENS', '8192'))
+    LLM_CONTEXT_TOKENS_BY_MODEL = parse_token_budgets(get_config(kwargs, 'LLM_CONTEXT_TOKENS_BY_MODEL'))
+    LLM_RESPONSE_TOKENS = int(get_config(kwargs, 'LLM_RESPONSE_TOKENS', '1024'))
+    # NOTE replies are capped at the room the context budget reserved for them
+    LLM_MAX_TOKENS = int(get_config(kwargs, 'LLM_MAX_TOKENS', str(LLM_RESPONSE_TOKENS)))
+    # NOTE `keep_alive` follows recent traffic per model, within these bounds
+    LLM_KEEP_ALIVE_MIN = float(get_config(kwargs, 'LLM_KEEP_ALIVE_MIN', '300'))
+    LLM_KEEP_ALIVE_MAX = float(get_config(kwargs, 'LLM_KEEP_ALIVE_MAX', '3600'))
+    LLM_KEEP_ALIVE_WINDOW = float(get_config(kwargs, 'LLM_KEEP_ALIVE_WINDOW', '3600'))
+    # NOTE the busiest models of conversations active in the last days are
+    # loaded at startup, and again at the off-peak hours (UTC) if any
+    LLM_WARMUP_ON_START = get_config(kwargs, 'LLM_WARMUP_ON_START', 'true').lower() in ('1', 'true', 'yes')
+    LLM_WARMUP_ACTIVE_DAYS = float(get_config(kwargs, 'LLM_WARMUP_ACTIVE_DAYS', '7'))
+    LLM_WARMUP_MODELS = int(get_config(kwargs, 'LLM_WARMUP_MODELS', '1'))
+    LLM_WARMUP_HOURS = parse_hours(get_config(kwargs, 'LLM_WARMUP_HOURS'))
+    # NOTE jobs are claimed by user, so one user's backlog does not hold up
+    # another's reply, and generations beyond the capacity wait their turn by
+    # user too, each user getting a share in proportion to `users.weight`,
+    # `WORKER_CONCURRENCY` at or above the capacity keeps the backends busy,
+    # while the queue of jobs is where users take turns
+    LLM_SCHEDULER_CAPACITY = int(get_config(
+        kwargs,
+        'LLM_SCHEDULER_CAPACITY',
+        str(LLM_API_MAX_CONCURRENCY * len(LLM_API_URLS))))
+    LLM_SCHEDULER_BY_MODEL = get_config(kwargs, 'LLM_SCHEDULER_BY_MODEL', 'false').lower() in ('1', 'true', 'yes')
     MAILGUN_API_KEY = get_config(kwargs, 'MAILGUN_API_KEY')
     MAILGUN_API_SENDER = get_config(kwargs, 'MAILGUN_API_SENDER')
     MAILGUN_API_URL = get_config(kwargs, 'MAILGUN_API_URL')
+    MAILGUN_API_TIMEOUT = float(get_config(kwargs, 'MAILGUN_API_TIMEOUT', '10'))
+    # NOTE sends per second across the mail workers, Mailgun's own limits
+    # are answered with 429 and `Retry-After`, which is honored
+    MAILGUN_API_RATE = float(get_config(kwargs, 'MAILGUN_API_RATE', '10'))
+    MAILGUN_API_BURST = float(get_config(kwargs, 'MAILGUN_API_BURST', '10'))
+    # NOTE after this many failures in a row sends stop for the reset period,
+    # then a single send tests whether Mailgun is back
+    MAILGUN_BREAKER_THRESHOLD = int(get_config(kwargs, 'MAILGUN_BREAKER_THRESHOLD', '5'))
+    MAILGUN_BREAKER_RESET = float(get_config(kwargs, 'MAILGUN_BREAKER_RESET', '30'))
     SERVER_API_KEY = get_config(kwargs, 'SERVER_API_KEY')
+    # NOTE instrumentation is a no-op, and `/metrics` is hidden, unless enabled
+    METRICS_ENABLED = get_config(kwargs, 'METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    # NOTE a fraction of jobs run under cProfile and tracemalloc, each writing
+    # its profile and top allocation sites to `PROFILE_DIR`, while the stacks
+    # sampled meanwhile are served folded from `/profile`, `0` disables
+    PROFILE_SAMPLE_RATE = float(get_config(kwargs, 'PROFILE_SAMPLE_RATE', '0'))
+    PROFILE_DIR = get_config(kwargs, 'PROFILE_DIR', 'profiles')
+    PROFILE_ALLOCATIONS = get_config(kwargs, 'PROFILE_ALLOCATIONS', 'true').lower() in ('1', 'true', 'yes')
+    PROFILE_TOP_ALLOCATIONS = int(get_config(kwargs, 'PROFILE_TOP_ALLOCATIONS', '25'))
+    PROFILE_INTERVAL = float(get_config(kwargs, 'PROFILE_INTERVAL', '0.005'))
+    # NOTE set to `0` when jobs are drained by `scripts/worker.py` instead
+    WORKER_CONCURRENCY = int(get_config(kwargs, 'WORKER_CONCURRENCY', '2'))
+    WORKER_POLL_INTERVAL = float(get_config(kwargs, 'WORKER_POLL_INTERVAL', '1'))
+    # NOTE running jobs renew their lock every third of the timeout, so it is
+    # how long the job of a worker that died waits, not how long jobs may run
+    JOB_VISIBILITY_TIMEOUT = float(get_config(kwargs, 'JOB_VISIBILITY_TIMEOUT', '600'))
+    JOB_MAX_ATTEMPTS = int(get_config(kwargs, 'JOB_MAX_ATTEMPTS', '5'))
+    JOB_RETRY_DELAY = float(get_config(kwargs, 'JOB_RETRY_DELAY', '30'))
+    # NOTE replies are mailed by their own workers, retried from `MAIL_RETRY_DELAY`
+    # doubling each attempt, so an outage of a few hours loses nothing
+    MAIL_CONCURRENCY = int(get_config(kwargs, 'MAIL_CONCURRENCY', '4'))
+    MAIL_MAX_ATTEMPTS = int(get_config(kwargs, 'MAIL_MAX_ATTEMPTS', '10'))
+    MAIL_RETRY_DELAY = float(get_config(kwargs, 'MAIL_RETRY_DELAY', '10'))
+    # NOTE emails for a conversation within the window are answered together
+    REPLY_COALESCE_WINDOW = float(get_config(kwargs, 'REPLY_COALESCE_WINDOW', '20'))
+    REPLY_COALESCE_MAX_WAIT = float(get_config(kwargs, 'REPLY_COALESCE_MAX_WAIT', '120'))
+    # NOTE conversations without a message for `BUMP_DORMANT_DAYS` are written
+    # to again during the off-peak hours (UTC), at most `BUMP_MAX_BUMPS` times
+    # until the user answers, no hours disables bumping
+    BUMP_HOURS = parse_hours(get_config(kwargs, 'BUMP_HOURS'))
+    BUMP_DORMANT_DAYS = float(get_config(kwargs, 'BUMP_DORMANT_DAYS', '7'))
+    BUMP_MAX_BUMPS = int(get_config(kwargs, 'BUMP_MAX_BUMPS', '2'))
+    BUMP_BATCH_SIZE = int(get_config(kwargs, 'BUMP_BATCH_SIZE', '10'))
+    BUMP_INTERVAL = float(get_config(kwargs, 'BUMP_INTERVAL', '60'))
+    # NOTE no bumps are enqueued while more replies than this wait
+    BUMP_MAX_QUEUED = int(get_config(kwargs, 'BUMP_MAX_QUEUED', '0'))
+    BUMP_PROMPT = get_config(
+        kwargs,
+        'BUMP_PROMPT',
+        '{user_name} has not written back in {days} days. Write them a short letter that picks up where the '
+        'conversation left off and asks them something, without reproaching them for the silence.')
+    BUMP_SUBJECT = get_config(kwargs, 'BUMP_SUBJECT', 'A letter from {agent_name}')
 
-    def chat_and_reply(
-            headers: str,
-            message: str,
-            sender: Optional[str],
-            subject: Optional[str]) -> None:
-        conversation_id = parse_conversation_id_from_headers(headers)
-        if not conversation_id:
-            raise Exception('unspecified conversation `id` in %s' % (headers,))
+    # NOTE conversations are cached with their rendered prompt, writes in this
+    # process invalidate them and the TTL bounds staleness from other processes
+    CONVERSATION_CACHE_SIZE = int(get_config(kwargs, 'CONVERSATION_CACHE_SIZE', '1024'))
+    CONVERSATION_CACHE_TTL = float(get_config(kwargs, 'CONVERSATION_CACHE_TTL', '300'))
+    # NOTE webhooks past these limits are answered with 503 and `Retry-After`,
+    # and Mailgun retries them later, rates are per second and `0` disables
+    ADMISSION_MAX_IN_FLIGHT = int(get_config(kwargs, 'ADMISSION_MAX_IN_FLIGHT', '32'))
+    ADMISSION_MAX_QUEUED = int(get_config(kwargs, 'ADMISSION_MAX_QUEUED', '500'))
+    ADMISSION_SENDER_RATE = float(get_config(kwargs, 'ADMISSION_SENDER_RATE', '0.1'))
+    ADMISSION_SENDER_BURST = float(get_config(kwargs, 'ADMISSION_SENDER_BURST', '10'))
+    ADMISSION_CONVERSATION_RATE = float(get_config(kwargs, 'ADMISSION_CONVERSATION_RATE', '0.1'))
+    ADMISSION_CONVERSATION_BURST = float(get_config(kwargs, 'ADMISSION_CONVERSATION_BURST', '10'))
+    ADMISSION_RETRY_AFTER = float(get_config(kwargs, 'ADMISSION_RETRY_AFTER', '60'))
+
+    conversation_cache = Cache('conversations', maxsize=CONVERSATION_CACHE_SIZE, ttl=CONVERSATION_CACHE_TTL)
+    pool = ConnectionPool(
+            DATABASE_URL,
+            readers=DATABASE_READERS,
+            pragmas=DATABASE_PRAGMAS,
+            conversation_cache=conversation_cache)
+    # NOTE the request path and jobs use the pool through coroutines, with
+    # concurrent writes committed in batches of up to `DATABASE_WRITE_BATCH`
+    database = AsyncDatabase(pool, max_batch=DATABASE_WRITE_BATCH)
+
+    # NOTE each backend gets its own connection pool and concurrency cap
+    router = Router(
+            LLM_API_URLS,
+            lambda url: ChatClient(
+                url,
+                connect_timeout=LLM_API_CONNECT_TIMEOUT,
+                read_timeout=LLM_API_READ_TIMEOUT,
+                max_concurrency=LLM_API_MAX_CONCURRENCY,
+                stream=LLM_API_STREAM,
+                stall_timeout=LLM_API_STALL_TIMEOUT,
+                max_tokens=LLM_MAX_TOKENS,
+                context_tokens=lambda model: get_token_budget(
+                    model,
+                    LLM_CONTEXT_TOKENS,
+                    LLM_CONTEXT_TOKENS_BY_MODEL)),
+            probe_interval=LLM_API_PROBE_INTERVAL,
+            probe_timeout=LLM_API_CONNECT_TIMEOUT)
+
+    residency = ResidencyManager(
+            router,
+            pool,
+            keep_alive_min=LLM_KEEP_ALIVE_MIN,
+            keep_alive_max=LLM_KEEP_ALIVE_MAX,
+            window=LLM_KEEP_ALIVE_WINDOW,
+            active_days=LLM_WARMUP_ACTIVE_DAYS,
+            max_models=LLM_WARMUP_MODELS,
+            warmup_on_start=LLM_WARMUP_ON_START,
+            warmup_hours=LLM_WARMUP_HOURS)
 
-        with open_db(DATABASE_URL) as db:
-            result = db.get_conversation(conversation_id)
+    scheduler = FairScheduler(residency, capacity=LLM_SCHEDULER_CAPACITY, by_model=LLM_SCHEDULER_BY_MODEL)
 
-            if not result:
-                raise Exception('conversation with `id` %d does not exist' % conversation_id)
+    context_manager = ContextManager(
+            pool,
+            scheduler,
+            default_budget=LLM_CONTEXT_TOKENS,
+            budgets=LLM_CONTEXT_TOKENS_BY_MODEL,
+            response_tokens=LLM_RESPONSE_TOKENS)
 
-            conversation = db.conversation_to_dict(result)
+    def get_conversation(db: Database, conversation_id: int) -> tuple[dict[str, str], Optional[int], Optional[tuple]]:
+        conversation = db.get_conversation_dict(conversation_id)
 
-            user_email = conversation.get('user_email')
-            if sender not in user_email:
-                raise Exception('invalid user email `%s` for conversation %d' % (user_email, conversation_id))
+        if not conversation:
+            raise Exception('conversation with `id` %d does not exist' % conversation_id)
 
-            prompt = get_prompt_message_from_conversation(conversation)
-            db.add_user_message(conversation_id, message)
-            messages = db.get_messages_by_conversation(conversation_id)
-            message_objects = list(map(message_tuple_to_dict, [prompt] + messages))
-            response = chat(message_objects, model=conversation.get('model'), url=LLM_API_CHAT_URL)
-            db.add_assistant_message(conversation_id, response)
+        user_message_id, reply = db.get_reply_state(conversation_id)
+        return (conversation, user_message_id, reply)
 
+    def create_mail_data(conversation: dict, payload: dict, response: str) -> dict[str, str]:
         data = {
-            "from": "%s.%d <%s>" % (conversation.get('agent_name'), conversation_id, MAILGUN_API_SENDER),
-            "to": sender,
+            "from": "%s.%d <%s>" % (conversation.get('agent_name'), conversation.get('id'), MAILGUN_API_SENDER),
+            "to": payload.get('sender'),
             "text": response
         }
 
+        # NOTE what follows is integral to threaded replies
+        if payload.get('message_id'):
+            data["h:In-Reply-To"] = payload.get('message_id')
+
+        # NOTE only add the subject if it exists
+        if payload.get('subject'):
+            data['subject'] = payload.get('subject')
+
+        return data
+
+    def enqueue_mail(db, conversation: dict, payload: dict, message_id: int, response: str) -> None:
+        db.enqueue_job(
+                'mail',
+                {
+                    'message_id': message_id,
+                    'data': create_mail_data(conversation, payload, response),
+                    'enqueued_at': payload.get('enqueued_at'),
+                    'model': conversation.get('model'),
+                    'agent': conversation.get('agent_name')
+                },
+                conversation_id=conversation.get('id'))
+
+    def store_reply(
+            db: Database,
+            conversation: dict,
+            payload: dict,
+            response: str,
+            reply_to: int,
+            generation: dict) -> Optional[int]:
+        # NOTE the reply and the job that mails it are committed together, so a
+        # stored reply is never left without a way out
+        with db.transaction():
+            # NOTE another worker answered while this one generated, as when
+            # the job was reclaimed after its lock expired, so this is dropped
+            reply = db.get_reply_state(conversation.get('id'))[1]
+            if reply and reply[1] and reply[1] >= reply_to:
+                return None
+            message_id = db.add_assistant_message(
+                    conversation.get('id'),
+                    response,
+                    reply_to=reply_to,
+                    generation=generation)[0]
+            enqueue_mail(db, conversation, payload, message_id, response)
+        return message_id
+
+    async def chat_and_reply(job: dict) -> None:
+        payload = job.get('payload')
+        conversation_id = payload.get('conversation_id')
+
+        conversation, user_message_id, reply = await database.read(lambda db: get_conversation(db, conversation_id))
+        if not user_message_id:
+            return
+
+        labels = {'model': conversation.get('model'), 'agent': conversation.get('agent_name')}
+
+        if reply and reply[1] and reply[1] >= user_message_id:
+            # NOTE an earlier job already answered this message along with its own
+            if reply[3]:
+                return
+            # NOTE replies stored before mail jobs existed, or whose mail job
+            # died, are handed to a new one
+            message_id, reply_to, response, sent_at = reply
+            await database.write(lambda db: enqueue_mail(db, conversation, payload, message_id, response))
+        else:
+            # NOTE messages that arrive during the generation are answered by
+            # the job they enqueue, which runs after this one
+            with stage_seconds.time(stage='context', **labels):
+                messages = await context_manager.get_messages(conversation, until=user_message_id)
+            with stage_seconds.time(stage='generate', **labels):
+                generation = await scheduler.complete(
+                        messages,
+                        model=conversation.get('model'),
+                        tenant=conversation.get('user_id'),
+                        weight=conversation.get('user_weight'))
+            response = generation['message']['content']
+            with stage_seconds.time(stage='store', **labels):
+                message_id = await database.write(
+                        lambda db: store_reply(db, conversation, payload, response, user_message_id, generation))
+            if not message_id:
+                logger.info('dropped a reply to conversation %d that was already answered', conversation_id)
+                return
+
+        # NOTE the mail workers send it, so generation moves on to the next job
+        mail_pool.notify()
+
+    def store_bump(
+            db: Database,
+            conversation: dict,
+            last_message_at: str,
+            response: str,
+            generation: dict) -> Optional[int]:
+        with db.transaction():
+            # NOTE the user wrote while the bump generated, so it is dropped
+            if db.get_activity(conversation.get('id'))[0] != last_message_at:
+                return None
+            message_id = db.add_bump_message(conversation.get('id'), response, generation=generation)[0]
+            payload = {'sender': conversation.get('user_email'), 'subject': BUMP_SUBJECT.format(**conversation)}
+            enqueue_mail(db, conversation, payload, message_id, response)
+        return message_id
+
+    async def bump(job: dict) -> None:
+        payload = job.get('payload')
+        conversation_id = payload.get('conversation_id')
+
+        conversation = await database.get_conversation_dict(conversation_id)
+        activity = await database.get_activity(conversation_id)
+        if not conversation or not activity:
+            raise Exception('conversation with `id` %d does not exist' % conversation_id)
+
+        # NOTE the user wrote, or a bump went out, since it was found dormant
+        last_message_at, bumps = activity
+        if not last_message_at or last_message_at >= payload.get('before') or bumps >= BUMP_MAX_BUMPS:
+            bumps_total.inc(outcome='skipped')
+            return
+
+        labels = {'model': conversation.get('model'), 'agent': conversation.get('agent_name')}
+        days = (datetime.now(timezone.utc) - datetime.fromisoformat(last_message_at)).days
+        with stage_seconds.time(stage='context', **labels):
+            messages = await context_manager.get_messages(conversation)
+        messages.append({'role': 'system', 'content': BUMP_PROMPT.format(days=days, **conversation)})
+        with stage_seconds.time(stage='generate', **labels):
+            generation = await scheduler.complete(
+                    messages,
+                    model=conversation.get('model'),
+                    tenant=conversation.get('user_id'),
+                    weight=conversation.get('user_weight'))
+        response = generation['message']['content']
+        with stage_seconds.time(stage='store', **labels):
+            message_id = await database.write(
+                    lambda db: store_bump(db, conversation, last_message_at, response, generation))
+
+        if not message_id:
+            bumps_total.inc(outcome='skipped')
+            return
+        bumps_total.inc(outcome='generated')
+        mail_pool.notify()
+
+    async def send_reply(job: dict) -> None:
+        payload = job.get('payload')
+        labels = {'model': payload.get('model'), 'agent': payload.get('agent')}
+
+        # NOTE a retried job whose email went out before it was marked sent is done
+        if await database.get_sent_at(payload.get('message_id')):
+            return
+
+        try:
+            with stage_seconds.time(stage='send', **labels):
+                await mail_client.send(payload.get('data'))
+        except (RateLimited, CircuitOpen) as e:
+            # NOTE neither is this email's fault, so it waits without using
+            # up its attempts
+            raise RetryLater(e.delay, str(e))
+
+        await database.mark_messages_sent([payload.get('message_id')])
+
+        if payload.get('enqueued_at'):
+            reply_seconds.observe(time.time() - payload.get('enqueued_at'), **labels)
+
+    mail_client = MailClient(
+            MAILGUN_API_URL,
+            MAILGUN_API_KEY,
+            timeout=MAILGUN_API_TIMEOUT,
+            max_connections=MAIL_CONCURRENCY,
+            rate=MAILGUN_API_RATE,
+            burst=MAILGUN_API_BURST,
+            breaker=CircuitBreaker(MAILGUN_BREAKER_THRESHOLD, MAILGUN_BREAKER_RESET))
+
+    profiler = Profiler(
+            PROFILE_DIR,
+            sample_rate=PROFILE_SAMPLE_RATE,
+            allocations=PROFILE_ALLOCATIONS,
+            top_allocations=PROFILE_TOP_ALLOCATIONS,
+            interval=PROFILE_INTERVAL)
+
+    worker_pool = WorkerPool(
+            pool,
+            {'reply': profiler.wrap(chat_and_reply), 'bump': profiler.wrap(bump)},
+            concurrency=WORKER_CONCURRENCY,
+            poll_interval=WORKER_POLL_INTERVAL,
+            visibility_timeout=JOB_VISIBILITY_TIMEOUT,
+            max_attempts=JOB_MAX_ATTEMPTS,
+            retry_delay=JOB_RETRY_DELAY)
+
+    mail_pool = WorkerPool(
+            pool,
+            {'mail': profiler.wrap(send_reply)},
+            concurrency=MAIL_CONCURRENCY,
+            poll_interval=WORKER_POLL_INTERVAL,
+            visibility_timeout=JOB_VISIBILITY_TIMEOUT,
+            max_attempts=MAIL_MAX_ATTEMPTS,
+            retry_delay=MAIL_RETRY_DELAY)
+
+    def count_jobs() -> dict:
+        with pool.read() as db:
+            return db.count_jobs()
+
+    def count_queued() -> int:
+        # NOTE only replies wait on the LLM, outbound mail drains on its own
+        return sum(count for (kind, status), count in count_jobs().items()
+                   if kind == 'reply' and status in ('pending', 'running'))
+
+    bump_scheduler = BumpScheduler(
+            database,
+            worker_pool.notify,
+            hours=BUMP_HOURS,
+            dormant_days=BUMP_DORMANT_DAYS,
+            max_bumps=BUMP_MAX_BUMPS,
+            batch_size=BUMP_BATCH_SIZE,
+            interval=BUMP_INTERVAL,
+            max_queued=BUMP_MAX_QUEUED)
+
+    admission = AdmissionController(
+            count_queued,
+            max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+            max_queued=ADMISSION_MAX_QUEUED,
+            sender_rate=ADMISSION_SENDER_RATE,
+            sender_burst=ADMISSION_SENDER_BURST,
+            conversation_rate=ADMISSION_CONVERSATION_RATE,
+            conversation_burst=ADMISSION_CONVERSATION_BURST,
+            retry_after=ADMISSION_RETRY_AFTER)
+
+    registry.enabled = METRICS_ENABLED
+    jobs_queued.set_function(count_jobs)
+    webhooks_in_flight.set_function(lambda: {(): admission.in_flight})
+    llm_in_flight.set_function(lambda: {(backend.url,): backend.in_flight for backend in router.backends})
+    llm_healthy.set_function(lambda: {(backend.url,): int(backend.healthy) for backend in router.backends})
+    llm_waiting.set_function(lambda: {(): len(scheduler.waiters)})
+    mail_circuit_open.set_function(lambda: {(): int(mail_client.breaker.state == 'open')})
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        database.start()
+        version = await database.get_schema_version()
+        if version < SCHEMA_VERSION:
+            logger.warning('database schema is at version %d, run `scripts/db-init.py` to migrate to %d',
+                           version,
+                           SCHEMA_VERSION)
+
+        await router.start()
+        residency.start()
+        worker_pool.start()
+        mail_pool.start()
+        bump_scheduler.start()
+        yield
+        await bump_scheduler.stop()
+        await worker_pool.stop()
+        await mail_pool.stop()
+        await residency.stop()
+        await router.close()
+        await mail_client.close()
+        await database.close()
+        pool.close()
+
+    app = FastAPI(lifespan=lifespan)
+
+    def store_message(db: Database, conversation_id: int, message: str, payload: dict) -> str:
+        # NOTE the message and its reply job are committed together
+        with db.transaction():
+            # NOTE a delivery Mailgun retried after we stored it was already
+            # queued for a reply, so it is only acknowledged
+            if payload.get('message_id') and db.has_message_id(payload.get('message_id')):
+                return 'duplicate'
+            db.add_user_message(conversation_id, message, message_id=payload.get('message_id'))
+            db.enqueue_coalesced_job(
+                    'reply',
+                    conversation_id,
+                    payload,
+                    REPLY_COALESCE_WINDOW,
+                    REPLY_COALESCE_MAX_WAIT)
+        return 'accepted'
+
+    async def receive_message(
+            conversation_id: int,
+            message: str,
+            sender: str,
+            payload: dict) -> tuple[str, Optional[dict[str, str]]]:
+        conversation = await database.get_conversation_dict(conversation_id)
+
+        if not conversation:
+            logger.warning('conversation with `id` %d does not exist', conversation_id)
+            return ('rejected', None)
+
+        user_email = conversation.get('user_email')
+        if sender not in user_email:
+            logger.warning('invalid user email `%s` for conversation %d', user_email, conversation_id)
+            return ('rejected', None)
+
+        try:
+            # NOTE concurrent webhooks are committed together by the writer
+            outcome = await database.write(lambda db: store_message(db, conversation_id, message, payload))
+        except sqlite3.IntegrityError as e:
+            # NOTE the same delivery was stored by another process in between,
+            # while any other constraint failing is a bug that must surface
+            if payload.get('message_id') and 'messages.message_id' in str(e):
+                return ('duplicate', conversation)
+            raise
+
+        return (outcome, conversation)
+
+    async def receive(
+            conversation_id: int,
+            headers: str,
+            message: str,
+            sender: str,
+            subject: str) -> str:
+        payload = {
+            'conversation_id': conversation_id,
+            'sender': sender,
+            'subject': subject
+        }
+
         # NOTE what follows is integral to threaded replies
         match = re.search('"Message-Id","([^\"]*)"', headers)
         if match:
-            data["h:In-Reply-To"] = match.group(1)
+            payload['message_id'] = match.group(1).strip()
 
-        # NOTE only add the subject if it exists
-        if subject:
-            data['subject'] = subject
+        # NOTE quoted history is already stored, so only the new text is kept
+        message = normalize_body(message)
 
-        send_mail(MAILGUN_API_URL, api_key=MAILGUN_API_KEY, data=data)
+        outcome, conversation = await receive_message(conversation_id, message, sender, payload)
+        if outcome == 'duplicate':
+            logger.info('dropped duplicate delivery of `%s` for conversation %d', payload.get('message_id'), conversation_id)
+        if outcome != 'accepted':
+            return outcome
+
+        residency.prefetch(conversation.get('model'))
+        worker_pool.notify()
+        return 'accepted'
 
     @app.get('/heartbeat', status_code=200)
     def heartbeat(api_key: str, response: Response) -> None:
         if api_key != SERVER_API_KEY:
             response.status_code = status.HTTP_401_UNAUTHORIZED
 
+    @app.get('/metrics', status_code=200)
+    def metrics(api_key: str, response: Response):
+        if not METRICS_ENABLED:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            return
+        if api_key != SERVER_API_KEY:
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return
+        return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+    @app.get('/profile', status_code=200)
+    def profile(api_key: str, response: Response, reset: bool = False):
+        if not PROFILE_SAMPLE_RATE:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            return
+        if api_key != SERVER_API_KEY:
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return
+        # NOTE folded stacks, as read by `flamegraph.pl` or speedscope
+        return PlainTextResponse(profiler.render_stacks(reset=reset))
+
     @app.post('/mailgun', status_code=200)
     async def mailgun(
             headers: Annotated[str, Form(alias='message-headers')],
             message: Annotated[str, Form(alias='body-plain')],
             sender: Annotated[str, Form()],
             subject: Annotated[str, Form()],
-            background_tasks: BackgroundTasks) -> None:
-        background_tasks.add_task(
-                chat_and_reply,
-                headers,
-                message,
-                sender,
-                subject)
+            response: Response) -> None:
+        with webhook_seconds.time():
+            conversation_id = parse_conversation_id_from_headers(headers)
+            if not conversation_id:
+                logger.warning('unspecified conversation `id` in %s', headers)
+                outcome = 'rejected'
+            elif retry_after := await admission.admit(sender, conversation_id):
+                outcome = 'shed'
+            else:
+                try:
+                    outcome = await receive(conversation_id, headers, message, sender, subject)
+                finally:
+                    admission.release()
+        webhooks_total.inc(outcome=outcome)
+        if outcome == 'rejected':
+            # NOTE Mailgun does not retry a webhook that was answered with 406
+            response.status_code = status.HTTP_406_NOT_ACCEPTABLE
+        elif outcome == 'shed':
+            # NOTE Mailgun retries on its own schedule, which makes it the
+            # buffer for bursts past what the queue holds
+            response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            response.headers['Retry-After'] = str(retry_after)
 
     return app
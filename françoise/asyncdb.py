@@ -0,0 +1,193 @@
+import asyncio
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import inspect
+import queue
+import threading
+from typing import Any, Optional
+
+from .cache import Cache
+from .db import ConnectionPool, Database
+from .metrics import Histogram
+
+batch_size = Histogram(
+        'francoise_db_write_batch_size',
+        'Writes committed together by the async writer.',
+        buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+# NOTE methods that change rows go through the writer, in a batch
+WRITE_METHODS = frozenset((
+    'table_insert',
+    'bulk_insert',
+    'create_agent',
+    'create_user',
+    'set_user_weight',
+    'create_conversation',
+    'onboard_users',
+    'create_message',
+    'add_user_message',
+    'add_assistant_message',
+    'add_assistant_messages',
+    'create_generation',
+    'mark_messages_sent',
+    'archive_messages',
+    'enqueue_job',
+    'enqueue_coalesced_job',
+    'claim_job',
+    'extend_job',
+    'complete_job',
+    'fail_job',
+    'defer_job',
+    'requeue_dead_jobs',
+    'save_summary',
+    'update_last_message_at',
+    'enqueue_bumps',
+    'add_bump_message'
+))
+
+READ_METHODS = frozenset((
+    'get_schema_version',
+    'iter_rows',
+    'has_message_id',
+    'get_model_throughput',
+    'get_prompt_growth',
+    'get_cold_loads',
+    'get_active_models',
+    'get_last_messages',
+    'get_reply_state',
+    'get_conversation',
+    'get_conversations',
+    'get_conversation_dict',
+    'get_messages_by_conversation',
+    'get_archived_messages',
+    'get_archivable_conversations',
+    'get_sent_at',
+    'count_jobs',
+    'get_messages_after',
+    'get_summary',
+    'get_dormant_conversations',
+    'get_activity'
+))
+
+
+class AsyncDatabase:
+    # NOTE the methods of `Database` as coroutines, reads run on a thread per
+    # pooled reader and writes are queued to a single writer thread, which
+    # commits whatever queued up while it was busy in one transaction
+    def __init__(self, pool: ConnectionPool, max_batch: int = 128):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.readers = None
+        self.writes = queue.Queue()
+        self.writer = None
+
+    def __getattr__(self, name: str) -> Callable:
+        if name in WRITE_METHODS:
+            return lambda *args, **kwargs: self.write(lambda db: getattr(db, name)(*args, **kwargs))
+        if name in READ_METHODS:
+            return lambda *args, **kwargs: self.read(lambda db: getattr(db, name)(*args, **kwargs))
+        raise AttributeError('`%s` is not available on AsyncDatabase' % (name,))
+
+    def run_read(self, fn: Callable[[Database], Any]) -> Any:
+        with self.pool.read() as db:
+            result = fn(db)
+            # NOTE the connection goes back to the pool, so rows are fetched now
+            if inspect.isgenerator(result):
+                result = list(result)
+            return result
+
+    async def read(self, fn: Callable[[Database], Any]) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self.run_read, fn)
+
+    async def write(self, fn: Callable[[Database], Any]) -> Any:
+        # NOTE `fn` runs on the writer thread within a savepoint, so its
+        # statements commit with the rest of the batch or not at all
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.writes.put((fn, loop, future))
+        return await future
+
+    def run_writer(self) -> None:
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.commit(batch)
+                    return
+                batch.append(item)
+            self.commit(batch)
+
+    def commit(self, batch: list[tuple]) -> None:
+        batch_size.observe(len(batch))
+        results = []
+        try:
+            with self.pool.write() as db:
+                with db.transaction():
+                    if not db.connection.in_transaction:
+                        db.connection.execute('BEGIN IMMEDIATE')
+                    for fn, loop, future in batch:
+                        try:
+                            with db.savepoint('batched_write'):
+                                results.append((fn(db), None))
+                        except Exception as e:
+                            results.append((None, e))
+        except Exception as e:
+            # NOTE nothing was committed, so every write in the batch failed
+            results = [(None, e)] * len(batch)
+
+        for (fn, loop, future), (result, error) in zip(batch, results):
+            try:
+                loop.call_soon_threadsafe(resolve, future, result, error)
+            except RuntimeError:
+                # NOTE the loop closed, so nobody is waiting on the result
+                pass
+
+    def start(self) -> None:
+        self.readers = ThreadPoolExecutor(max_workers=self.pool.max_readers, thread_name_prefix='db-reader')
+        self.writer = threading.Thread(target=self.run_writer, name='db-writer', daemon=True)
+        self.writer.start()
+
+    async def close(self) -> None:
+        # NOTE writes queued before this are committed first
+        if self.writer:
+            self.writes.put(None)
+            await asyncio.to_thread(self.writer.join)
+            self.writer = None
+        if self.readers:
+            self.readers.shutdown(wait=True)
+            self.readers = None
+
+
+def resolve(future: asyncio.Future, result: Any, error: Optional[Exception]) -> None:
+    # NOTE the caller may have been cancelled while its write was committed
+    if future.cancelled():
+        return
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+@asynccontextmanager
+async def open_async_db(
+        url: str,
+        readers: int = 4,
+        pragmas: Optional[dict] = None,
+        conversation_cache: Optional[Cache] = None):
+    pool = ConnectionPool(url, readers=readers, pragmas=pragmas, conversation_cache=conversation_cache)
+    db = AsyncDatabase(pool)
+    db.start()
+    try:
+        yield db
+    finally:
+        await db.close()
+        pool.close()
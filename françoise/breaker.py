@@ -0,0 +1,50 @@
+import time
+
+
+class CircuitOpen(Exception):
+    def __init__(self, delay: float):
+        super().__init__('circuit is open for another %.1fs' % (delay,))
+        self.delay = delay
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def before(self) -> None:
+        # NOTE once `reset_timeout` has passed a single trial call goes
+        # through, and its outcome closes or reopens the circuit
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self.trial):
+            delay = self.opened_at + self.reset_timeout - time.monotonic()
+            raise CircuitOpen(max(delay, 1.0))
+        if state == 'half-open':
+            self.trial = True
+
+    def release(self) -> None:
+        # NOTE a trial call that ended without an outcome, say it was
+        # cancelled, lets the next call be the trial instead
+        self.trial = False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.trial = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
@@ -0,0 +1,87 @@
+import asyncio
+from collections.abc import Callable, Sequence
+from datetime import datetime, timedelta, timezone
+import logging
+
+from .asyncdb import AsyncDatabase
+from .metrics import Counter
+from .residency import get_seconds_until
+
+logger = logging.getLogger(__name__)
+
+bumps_total = Counter('francoise_bumps_total', 'Dormant conversation bumps by outcome.', ('outcome',))
+
+
+class BumpScheduler:
+    # NOTE during the off-peak `hours` (UTC), enqueues a `bump` job for up to
+    # `batch_size` dormant conversations every `interval`, but only once the
+    # previous batch is done and no more than `max_queued` replies wait, so
+    # bumps fill idle time rather than delaying replies
+    def __init__(
+            self,
+            database: AsyncDatabase,
+            notify: Callable[[], None],
+            hours: Sequence[int] = (),
+            dormant_days: float = 7.0,
+            max_bumps: int = 2,
+            batch_size: int = 10,
+            interval: float = 60.0,
+            max_queued: int = 0):
+        self.database = database
+        self.notify = notify
+        self.hours = hours
+        self.dormant_days = dormant_days
+        self.max_bumps = max_bumps
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queued = max_queued
+        self.tasks = set()
+
+    def is_idle(self, counts: dict[tuple[str, str], int]) -> bool:
+        replies = sum(count for (kind, status), count in counts.items()
+                      if kind == 'reply' and status in ('pending', 'running'))
+        bumps = sum(count for (kind, status), count in counts.items()
+                    if kind == 'bump' and status in ('pending', 'running'))
+        return replies <= self.max_queued and not bumps
+
+    async def enqueue(self, now: datetime) -> list[int]:
+        if not self.is_idle(await self.database.count_jobs()):
+            return []
+
+        before = (now - timedelta(days=self.dormant_days)).isoformat()
+        ids = await self.database.write(lambda db: db.enqueue_bumps(
+                db.get_dormant_conversations(before, self.max_bumps, self.batch_size),
+                before))
+        if ids:
+            logger.info('enqueued bumps for `%d` dormant conversations', len(ids))
+            bumps_total.inc(len(ids), outcome='enqueued')
+            self.notify()
+        return ids
+
+    async def run(self) -> None:
+        while True:
+            now = datetime.now(timezone.utc)
+            if now.hour not in self.hours:
+                await asyncio.sleep(get_seconds_until(self.hours, now))
+                continue
+
+            try:
+                await self.enqueue(now)
+            except Exception:
+                logger.exception('failed to enqueue bumps')
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        # NOTE there is nothing to schedule without off-peak hours
+        if not self.hours:
+            return
+        task = asyncio.create_task(self.run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def stop(self) -> None:
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = set()
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from collections.abc import Callable
+import threading
+import time
+from typing import Any, Optional
+
+from .metrics import Counter
+
+cache_requests_total = Counter('francoise_cache_requests_total', 'Cache lookups by result.', ('cache', 'result'))
+
+
+class Cache:
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[Any]:
+        # NOTE entries expire after `ttl`, which bounds how long writes made by
+        # other processes, which cannot invalidate this cache, go unseen
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                value = entry[1]
+            else:
+                if entry:
+                    del self.entries[key]
+                self.misses += 1
+                value = None
+        cache_requests_total.inc(cache=self.name, result='hit' if value is not None else 'miss')
+        return value
+
+    def set(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, predicate: Callable[[Any], bool]) -> None:
+        with self.lock:
+            for key in [key for key, (expires_at, value) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
@@ -1,5 +1,33 @@
-from collections.abc import Sequence
-import requests
+import asyncio
+from collections.abc import Callable, Sequence
+import json
+import logging
+import time
+from typing import Optional
+
+import httpx
+
+from .metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+request_seconds = Histogram('francoise_llm_request_seconds', 'Time spent on chat requests.', ('model',))
+first_token_seconds = Histogram('francoise_llm_first_token_seconds', 'Time to the first streamed chunk.', ('model',))
+# NOTE durations Ollama reports in nanoseconds, to tell a cold load or a long
+# prompt from a slow generation
+load_seconds = Histogram('francoise_llm_load_seconds', 'Time Ollama spent loading the model.', ('model',))
+prompt_eval_seconds = Histogram('francoise_llm_prompt_eval_seconds', 'Time Ollama spent evaluating the prompt.', ('model',))
+eval_seconds = Histogram('francoise_llm_eval_seconds', 'Time Ollama spent generating the response.', ('model',))
+
+
+def observe_chat_response(model: str, json: dict) -> None:
+    for histogram, key in ((load_seconds, 'load_duration'),
+                           (prompt_eval_seconds, 'prompt_eval_duration'),
+                           (eval_seconds, 'eval_duration')):
+        if json.get(key) is not None:
+            histogram.observe(json.get(key) / 1e9, model=model)
+    if json.get('time_to_first_token') is not None:
+        first_token_seconds.observe(json.get('time_to_first_token'), model=model)
 
 
 def message_tuple_to_dict(values: tuple[str, str]):
@@ -11,6 +39,9 @@ def get_prompt_message(s: str) -> tuple[str, str]:
 
 
 def create_prompt_from_conversation(conversation: dict[str, str]) -> str:
+    # NOTE conversations loaded through the cache carry their rendered prompt
+    if conversation.get('system_prompt'):
+        return conversation.get('system_prompt')
     return conversation.get('agent_prompt').format(**conversation)
 
 
@@ -19,7 +50,7 @@ def get_prompt_message_from_conversation(conversation: dict[str, str]) -> tuple[
     return get_prompt_message(content)
 
 
-def chat(messages: Sequence[dict[str, str]], **kwargs):
+def create_chat_request(messages: Sequence[dict[str, str]], **kwargs) -> tuple[str, dict]:
     if not messages:
         raise Exception('messages is empty or unspecified')
 
@@ -34,12 +65,154 @@ def chat(messages: Sequence[dict[str, str]], **kwargs):
     data = {
       "model": model,
       "messages": messages,
-      "stream": False
+      "stream": bool(kwargs.get('stream'))
     }
 
-    response = requests.post(url, json=data)
-    # throw an error if we got a failure from the LLM
-    response.raise_for_status()
+    # NOTE Ollama stops generating after `num_predict` tokens
+    if kwargs.get('max_tokens'):
+        data.setdefault('options', {})['num_predict'] = kwargs.get('max_tokens')
+
+    # NOTE Ollama's own default context is smaller than most budgets, and it
+    # drops the start of a prompt that does not fit without saying so
+    if kwargs.get('context_tokens'):
+        data.setdefault('options', {})['num_ctx'] = kwargs.get('context_tokens')
+
+    # NOTE how long Ollama keeps the model in memory after this request
+    if kwargs.get('keep_alive') is not None:
+        data['keep_alive'] = kwargs.get('keep_alive')
+
+    return (url, data)
+
+
+class ChatClient:
+    def __init__(
+            self,
+            url: str,
+            connect_timeout: float = 5.0,
+            read_timeout: float = 300.0,
+            max_concurrency: int = 4,
+            stream: bool = False,
+            stall_timeout: float = 30.0,
+            max_tokens: Optional[int] = None,
+            context_tokens: Optional[Callable[[str], int]] = None):
+        self.url = url
+        self.stream = stream
+        self.stall_timeout = stall_timeout
+        self.max_tokens = max_tokens
+        # NOTE the context size by model, every request for a model must ask
+        # for the same one, as Ollama reloads the model when it changes
+        self.context_tokens = context_tokens
+        self.max_concurrency = max_concurrency
+        # NOTE requests beyond the cap wait here as coroutines, rather than
+        # holding a thread or timing out waiting on the connection pool
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None),
+                limits=httpx.Limits(
+                    max_connections=max_concurrency,
+                    max_keepalive_connections=max_concurrency))
+
+    async def read_stream(self, url: str, data: dict, max_tokens: Optional[int]) -> dict:
+        started = time.monotonic()
+        content = []
+        result = {}
+
+        async with self.client.stream('POST', url, json=data) as response:
+            # throw an error if we got a failure from the LLM
+            response.raise_for_status()
+
+            lines = response.aiter_lines()
+            while True:
+                # NOTE waiting on the first chunk includes loading the model and
+                # evaluating the prompt, so only the read timeout applies to it
+                try:
+                    if content:
+                        line = await asyncio.wait_for(anext(lines), self.stall_timeout)
+                    else:
+                        line = await anext(lines)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise Exception('generation stalled for %.1fs after %d chunks' % (self.stall_timeout, len(content)))
+
+                if not line:
+                    continue
+
+                chunk = json.loads(line)
+                if 'error' in chunk:
+                    raise Exception('generation failed with `%s`' % (chunk['error'],))
+
+                if not content:
+                    result['time_to_first_token'] = time.monotonic() - started
+
+                content.append(chunk.get('message', {}).get('content', ''))
+
+                if chunk.get('done'):
+                    result.update(chunk)
+                    break
+
+                # NOTE leaving the stream closes the connection, which is how
+                # Ollama is told to stop a runaway generation
+                if max_tokens and len(content) >= max_tokens:
+                    result.update(chunk, done=True, done_reason='length')
+                    break
+
+        if not result.get('done'):
+            raise Exception('generation ended after %d chunks without completing' % (len(content),))
+
+        result['message'] = {'role': 'assistant', 'content': ''.join(content)}
+
+        logger.info('model `%s` produced its first token after %.3fs and %d chunks in %.3fs',
+                    data.get('model'),
+                    result.get('time_to_first_token', 0),
+                    len(content),
+                    time.monotonic() - started)
+
+        return result
+
+    async def complete(self, messages: Sequence[dict[str, str]], **kwargs) -> dict:
+        kwargs.setdefault('url', self.url)
+        kwargs.setdefault('stream', self.stream)
+        kwargs.setdefault('max_tokens', self.max_tokens)
+        if self.context_tokens and kwargs.get('model'):
+            kwargs.setdefault('context_tokens', self.context_tokens(kwargs.get('model')))
+        url, data = create_chat_request(messages, **kwargs)
+
+        async with self.semaphore:
+            with request_seconds.time(model=data.get('model')):
+                if data.get('stream'):
+                    json = await self.read_stream(url, data, kwargs.get('max_tokens'))
+                else:
+                    response = await self.client.post(url, json=data)
+                    # throw an error if we got a failure from the LLM
+                    response.raise_for_status()
+                    json = response.json()
+
+        observe_chat_response(data.get('model'), json)
+        return json
+
+    async def chat(self, messages: Sequence[dict[str, str]], **kwargs) -> str:
+        json = await self.complete(messages, **kwargs)
+        return json['message']['content']
+
+    async def load(self, model: str, keep_alive: Optional[float] = None) -> dict:
+        # NOTE a chat request without messages loads the model and returns
+        # without generating anything
+        data = {'model': model, 'messages': []}
+        if keep_alive is not None:
+            data['keep_alive'] = keep_alive
+        # NOTE loaded with the context the model's generations will ask for
+        if self.context_tokens:
+            data['options'] = {'num_ctx': self.context_tokens(model)}
+
+        async with self.semaphore:
+            response = await self.client.post(self.url, json=data)
+            # throw an error if we got a failure from the LLM
+            response.raise_for_status()
+            json = response.json()
+
+        observe_chat_response(model, json)
+        return json
 
-    json = response.json()
-    return json['message']['content']
+    async def close(self) -> None:
+        await self.client.aclose()
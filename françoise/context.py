@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from typing import Optional
+
+from .chat import get_prompt_message_from_conversation, message_tuple_to_dict
+from .db import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """You maintain the memory of a pen pal correspondence between {user_name} and {agent_name}.
+Rewrite the existing summary so that it also covers the new letters.
+Keep names, facts {user_name} shared about themselves, open questions, ongoing topics and recurring mistakes.
+Write at most {summary_words} words of plain prose, without commentary."""
+
+
+def estimate_tokens(content: str) -> int:
+    # NOTE there is no tokenizer for every model, so this errs towards
+    # overestimating with ~3 characters per token plus per-message overhead
+    return len(content) // 3 + 4
+
+
+def parse_token_budgets(s: Optional[str]) -> dict[str, int]:
+    # NOTE formatted as `gemma3=32768,llama3.2=8192`
+    budgets = {}
+    for pair in filter(None, (s or '').split(',')):
+        model, budget = pair.split('=')
+        budgets[model.strip()] = int(budget)
+    return budgets
+
+
+def get_token_budget(model: str, default_budget: int, budgets: dict[str, int]) -> int:
+    # NOTE `gemma3:12b` falls back to the budget for `gemma3`
+    budget = budgets.get(model) or budgets.get(model.split(':')[0])
+    return budget or default_budget
+
+
+def split_history(messages: list[tuple], budget: int) -> tuple[list[tuple], list[tuple]]:
+    # NOTE keeps the newest messages that fit, and always the latest one
+    tokens = 0
+    i = len(messages)
+    while i > 0:
+        tokens += estimate_tokens(messages[i - 1][-1])
+        if tokens > budget and i < len(messages):
+            break
+        i -= 1
+    return (messages[:i], messages[i:])
+
+
+def format_transcript(conversation: dict[str, str], messages: list[tuple]) -> str:
+    names = {
+        'user': conversation.get('user_name'),
+        'assistant': conversation.get('agent_name')
+    }
+    return '\n\n'.join('%s: %s' % (names.get(role, role), content) for id, role, content in messages)
+
+
+class ContextManager:
+    def __init__(
+            self,
+            pool: ConnectionPool,
+            chat,
+            default_budget: int = 8192,
+            budgets: Optional[dict[str, int]] = None,
+            response_tokens: int = 1024,
+            summary_words: int = 250):
+        self.pool = pool
+        self.chat = chat
+        self.default_budget = default_budget
+        self.budgets = budgets or {}
+        self.response_tokens = response_tokens
+        self.summary_words = summary_words
+
+    def get_budget(self, model: str) -> int:
+        return get_token_budget(model, self.default_budget, self.budgets)
+
+    def load(self, conversation_id: int, until: Optional[int]) -> tuple[Optional[tuple], list[tuple]]:
+        with self.pool.read() as db:
+            summary = db.get_summary(conversation_id)
+            message_id = summary[0] if summary else 0
+            messages = db.get_messages_after(conversation_id, message_id, until)
+        return (summary, messages)
+
+    def save(self, conversation_id: int, message_id: int, content: str) -> None:
+        with self.pool.write() as db:
+            db.save_summary(conversation_id, message_id, content)
+
+    async def summarize(
+            self,
+            conversation: dict[str, str],
+            summary: Optional[str],
+            messages: list[tuple]) -> str:
+        prompt = SUMMARY_PROMPT.format(summary_words=self.summary_words, **conversation)
+        content = 'Existing summary:\n%s\n\nNew letters:\n%s' % (
+                summary or '(none)',
+                format_transcript(conversation, messages))
+        return await self.chat.chat(
+                [message_tuple_to_dict(('system', prompt)), message_tuple_to_dict(('user', content))],
+                model=conversation.get('model'),
+                tenant=conversation.get('user_id'),
+                weight=conversation.get('user_weight'))
+
+    async def get_messages(
+            self,
+            conversation: dict[str, str],
+            until: Optional[int] = None) -> list[dict[str, str]]:
+        conversation_id = conversation.get('id')
+        prompt = get_prompt_message_from_conversation(conversation)
+        summary, messages = await asyncio.to_thread(self.load, conversation_id, until)
+        summary = summary[1] if summary else None
+
+        budget = self.get_budget(conversation.get('model')) - self.response_tokens
+        budget -= estimate_tokens(prompt[1]) + estimate_tokens(summary or '')
+        older, recent = split_history(messages, budget)
+
+        if older:
+            # NOTE folding down to half the budget leaves room for several
+            # more turns, so a summary is only regenerated every so often
+            older, recent = split_history(messages, budget // 2)
+            try:
+                summary = await self.summarize(conversation, summary, older)
+                await asyncio.to_thread(self.save, conversation_id, older[-1][0], summary)
+            except Exception:
+                # NOTE the reply can still go out with the recent turns alone
+                logger.exception('failed to summarize conversation %d', conversation_id)
+
+        context = [prompt]
+        if summary:
+            context.append(('system', 'Summary of your earlier letters:\n%s' % (summary,)))
+        context.extend((role, content) for id, role, content in recent)
+
+        return list(map(message_tuple_to_dict, context))
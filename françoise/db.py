@@ -1,6 +1,22 @@
+from collections.abc import Iterable
 from contextlib import contextmanager
 from datetime import datetime, timezone
+import functools
+import itertools
+import json
+import queue
 import sqlite3
+import sys
+import threading
+import time
+from typing import Optional
+import zlib
+
+from .cache import Cache
+from .chat import create_prompt_from_conversation
+from .metrics import Histogram, timed
+
+query_seconds = Histogram('francoise_db_query_seconds', 'Time spent in Database methods.', ('method',))
 
 tables = [
     (
@@ -10,7 +26,9 @@ tables = [
              ('name', 'TEXT NOT NULL'),
              ('email', 'TEXT UNIQUE'),
              ('salt', 'TEXT NOT NULL'),
-             ('password', 'TEXT NOT NULL')
+             ('password', 'TEXT NOT NULL'),
+             # NOTE the user's share of generations relative to other users
+             ('weight', 'REAL NOT NULL DEFAULT 1')
          ]
     ),
 
@@ -32,7 +50,12 @@ tables = [
             ('user_id', 'INTEGER NOT NULL'),
             ('agent_id', 'INTEGER NOT NULL'),
             ('model', 'TEXT NOT NULL'),
-            ('proficiency', 'TEXT NOT NULL')
+            ('proficiency', 'TEXT NOT NULL'),
+            # NOTE kept by `create_message`, so dormant conversations are found
+            # on an index rather than by scanning messages
+            ('last_message_at', 'TEXT'),
+            # NOTE bumps sent since the user last wrote
+            ('bumps', 'INTEGER NOT NULL DEFAULT 0')
         ],
         [
             'UNIQUE(model, user_id, agent_id)',
@@ -48,11 +71,92 @@ tables = [
             ('conversation_id', 'INTEGER NOT NULL'),
             ('role', 'TEXT NOT NULL'),
             ('content', 'TEXT NOT NULL'),
+            ('created_at', 'TEXT NOT NULL'),
+            # NOTE set once an assistant message has been mailed
+            ('sent_at', 'TEXT'),
+            # NOTE the last user message an assistant message answers
+            ('reply_to', 'INTEGER'),
+            # NOTE the `Message-Id` of the email a user message came from
+            ('message_id', 'TEXT')
+        ],
+        [
+            'FOREIGN KEY(conversation_id) REFERENCES conversations(id)'
+        ]
+    ),
+
+    (
+        'jobs',
+        [
+            ('id', 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+            ('kind', 'TEXT NOT NULL'),
+            # NOTE jobs for the same conversation never run concurrently
+            ('conversation_id', 'INTEGER'),
+            ('payload', 'TEXT NOT NULL'),
+            ('status', "TEXT NOT NULL DEFAULT 'pending'"),
+            ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+            # NOTE timestamps that are compared on claim are unix epoch seconds
+            ('available_at', 'REAL NOT NULL'),
+            ('locked_until', 'REAL'),
+            ('last_error', 'TEXT'),
+            ('created_at', 'TEXT NOT NULL')
+        ]
+    ),
+
+    (
+        'generations',
+        [
+            ('id', 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+            ('message_id', 'INTEGER NOT NULL UNIQUE'),
+            ('conversation_id', 'INTEGER NOT NULL'),
+            ('model', 'TEXT NOT NULL'),
+            ('backend', 'TEXT'),
+            # NOTE counts and durations as reported by Ollama, in nanoseconds
+            ('prompt_eval_count', 'INTEGER'),
+            ('eval_count', 'INTEGER'),
+            ('total_duration', 'INTEGER'),
+            ('load_duration', 'INTEGER'),
+            ('prompt_eval_duration', 'INTEGER'),
+            ('eval_duration', 'INTEGER'),
+            ('time_to_first_token', 'REAL'),
+            ('done_reason', 'TEXT'),
+            ('created_at', 'TEXT NOT NULL')
+        ],
+        [
+            'FOREIGN KEY(message_id) REFERENCES messages(id)',
+            'FOREIGN KEY(conversation_id) REFERENCES conversations(id)'
+        ]
+    ),
+
+    (
+        'archives',
+        [
+            ('id', 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+            ('conversation_id', 'INTEGER NOT NULL'),
+            ('first_message_id', 'INTEGER NOT NULL'),
+            ('last_message_id', 'INTEGER NOT NULL'),
+            ('message_count', 'INTEGER NOT NULL'),
+            # NOTE zlib compressed JSON of the archived rows, see `archive_columns`
+            ('content', 'BLOB NOT NULL'),
             ('created_at', 'TEXT NOT NULL')
         ],
         [
             'FOREIGN KEY(conversation_id) REFERENCES conversations(id)'
         ]
+    ),
+
+    (
+        'summaries',
+        [
+            ('id', 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+            ('conversation_id', 'INTEGER NOT NULL UNIQUE'),
+            # NOTE the last message folded into the summary
+            ('message_id', 'INTEGER NOT NULL'),
+            ('content', 'TEXT NOT NULL'),
+            ('updated_at', 'TEXT NOT NULL')
+        ],
+        [
+            'FOREIGN KEY(conversation_id) REFERENCES conversations(id)'
+        ]
     )
 ]
 
@@ -61,6 +165,151 @@ for table in tables:
     tables_by_name[table[0]] = table
 
 
+def create_index(table_name: str, columns: list[str], unique: bool = False):
+    def migrate(connection):
+        connection.execute('CREATE {unique}INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns});'.format(
+                unique='UNIQUE ' if unique else '',
+                index_name='%s_%s_idx' % (table_name, '_'.join(columns)),
+                table_name=table_name,
+                columns=', '.join(columns)))
+    return migrate
+
+
+def add_column(table_name: str, column_name: str):
+    # NOTE the column type comes from the table definition, and the column is
+    # skipped if the table was created after the definition included it
+    def migrate(connection):
+        existing = [row[1] for row in connection.execute('PRAGMA table_info(%s)' % (table_name,))]
+        if column_name in existing:
+            return
+        column_type = dict(tables_by_name[table_name][1])[column_name]
+        connection.execute('ALTER TABLE %s ADD COLUMN %s %s;' % (table_name, column_name, column_type))
+    return migrate
+
+
+def execute(sql: str):
+    def migrate(connection):
+        connection.execute(sql)
+    return migrate
+
+
+update_last_message_at_statement = """
+    UPDATE conversations
+    SET last_message_at = (SELECT MAX(created_at) FROM messages WHERE conversation_id = conversations.id)
+    WHERE last_message_at IS NULL
+"""
+
+
+# NOTE versions are stored in `PRAGMA user_version`, append new migrations
+# here and every operation must be safe to run against a fresh schema
+migrations = [
+    (
+        1,
+        [
+            create_index('messages', ['conversation_id', 'id']),
+            create_index('jobs', ['status', 'available_at'])
+        ]
+    ),
+    (
+        2,
+        [
+            add_column('messages', 'sent_at'),
+            # NOTE replies stored before delivery was tracked were all sent
+            execute("UPDATE messages SET sent_at = created_at WHERE role = 'assistant' AND sent_at IS NULL")
+        ]
+    ),
+    (
+        3,
+        [
+            add_column('jobs', 'conversation_id'),
+            add_column('messages', 'reply_to'),
+            create_index('jobs', ['conversation_id', 'status'])
+        ]
+    ),
+    (
+        4,
+        [
+            create_index('generations', ['conversation_id', 'id']),
+            create_index('generations', ['model', 'created_at'])
+        ]
+    ),
+    (
+        5,
+        [
+            add_column('users', 'weight')
+        ]
+    ),
+    (
+        6,
+        [
+            add_column('messages', 'message_id'),
+            create_index('messages', ['message_id'], unique=True)
+        ]
+    ),
+    (
+        7,
+        [
+            create_index('archives', ['conversation_id', 'first_message_id'])
+        ]
+    ),
+    (
+        8,
+        [
+            add_column('conversations', 'last_message_at'),
+            add_column('conversations', 'bumps'),
+            execute(update_last_message_at_statement),
+            create_index('conversations', ['last_message_at'])
+        ]
+    )
+]
+
+SCHEMA_VERSION = migrations[-1][0]
+
+archive_columns = ('id', 'role', 'content', 'created_at', 'sent_at', 'reply_to', 'message_id')
+
+
+conversation_query = """
+    SELECT
+        conversation.id,
+        conversation.model,
+        conversation.user_id,
+        user.email AS user_email,
+        user.name AS user_name,
+        conversation.proficiency AS user_proficiency,
+        conversation.agent_id,
+        agent.name AS agent_name,
+        agent.language AS agent_language,
+        agent.proficiency AS agent_proficiency,
+        agent.prompt AS agent_prompt,
+        user.weight AS user_weight
+    FROM conversations conversation
+    JOIN users user
+    ON conversation.user_id = user.id
+    JOIN agents agent
+    ON conversation.agent_id = agent.id
+"""
+
+
+@functools.lru_cache(maxsize=256)
+def get_insert_statement(table_name: str, columns: tuple[str, ...], on_conflict: Optional[str] = None) -> str:
+    # NOTE the same string for the same columns lets sqlite3 reuse its
+    # prepared statement, instead of parsing the SQL again on every insert
+    table = tables_by_name.get(table_name)
+    if not table:
+        raise Exception('table with name `%s` is unspecified' % table_name)
+
+    known = dict(table[1])
+    for column in columns:
+        if column not in known:
+            raise Exception('column with name `%s` is unspecified on table `%s`' % (column, table_name))
+
+    return 'INSERT {or_clause}INTO {table_name} ({columns}) VALUES ({values})'.format(
+            or_clause='OR %s ' % (on_conflict.upper(),) if on_conflict else '',
+            table_name=table_name,
+            columns=','.join(columns),
+            values=','.join('?' for _ in columns))
+
+
 def table_definition_to_create_statement(definition: tuple) -> str:
     columns = ', '.join(list(map(lambda col: ' '.join(col), definition[1])))
 
@@ -75,67 +324,155 @@ def table_definition_to_create_statement(definition: tuple) -> str:
 
 
 class Database:
-    def __init__(self, connection):
+    def __init__(self, connection, conversation_cache: Optional[Cache] = None):
         self.connection = connection
+        self.transaction_depth = 0
+        # NOTE conversation dicts by `id`, which writes to the tables they
+        # are joined from invalidate
+        self.conversation_cache = conversation_cache
+
+    def invalidate_conversations(self, column: str, value) -> None:
+        if self.conversation_cache:
+            self.conversation_cache.invalidate(lambda conversation: conversation.get(column) == value)
+
+    @contextmanager
+    def transaction(self):
+        # NOTE nested transactions join the outermost one, which commits
+        self.transaction_depth += 1
+        try:
+            if self.transaction_depth > 1:
+                yield self
+            else:
+                with self.connection:
+                    yield self
+        finally:
+            self.transaction_depth -= 1
+
+    @contextmanager
+    def savepoint(self, name: str = 'savepoint'):
+        # NOTE undoes only the statements within it, leaving the outer
+        # transaction open, which must have been begun explicitly
+        self.connection.execute('SAVEPOINT %s' % (name,))
+        try:
+            yield self
+        except Exception:
+            self.connection.execute('ROLLBACK TO %s' % (name,))
+            self.connection.execute('RELEASE %s' % (name,))
+            raise
+        self.connection.execute('RELEASE %s' % (name,))
 
     def create_schema(self):
-        with self.connection:
+        with self.transaction():
             # NOTE it didn't look like we could create tables in one go
             for sql in list(map(table_definition_to_create_statement, tables)):
                 self.connection.execute(sql)
 
+    def get_schema_version(self) -> int:
+        return self.connection.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self) -> int:
+        # NOTE tables that do not exist yet are created with every column
+        self.create_schema()
+
+        version = self.get_schema_version()
+        for migration_version, operations in migrations:
+            if migration_version <= version:
+                continue
+
+            with self.transaction():
+                # NOTE DDL does not implicitly begin a transaction
+                self.connection.execute('BEGIN')
+                for operation in operations:
+                    operation(self.connection)
+                self.connection.execute('PRAGMA user_version = %d' % (migration_version,))
+            version = migration_version
+
+        return version
+
     def delete_schema(self):
         for table_name in tables_by_name.keys():
             self.table_delete(table_name)
 
     def table_insert(self, table_name: str, **kwargs) -> tuple:
-        table = tables_by_name.get(table_name)
-        if not table:
-            raise Exception('table with name `%s` is unspecified' % table_name)
-
-        columns = []
-        params = []
-        # TODO verify that the column exists on the table using the definition
-        for key, value in kwargs.items():
-            columns.append(key)
-            params.append(value)
-
-        sql = 'INSERT INTO {table_name} ({columns}) VALUES ({values}) RETURNING *;'.format(
-                table_name=table_name,
-                columns=','.join(columns),
-                values=','.join(list(map(lambda col: '?', columns))))
+        sql = get_insert_statement(table_name, tuple(kwargs.keys())) + ' RETURNING *;'
 
-        with self.connection:
-            cursor = self.connection.execute(sql, params)
+        with self.transaction():
+            cursor = self.connection.execute(sql, tuple(kwargs.values()))
             row = cursor.fetchone()
 
         return row
 
+    @timed(query_seconds, method='bulk_insert')
+    def bulk_insert(
+            self,
+            table_name: str,
+            rows: Iterable[dict],
+            batch_size: int = 1000,
+            on_conflict: Optional[str] = None) -> int:
+        # NOTE rows are consumed lazily, one transaction per batch, and every
+        # row in a batch must have the columns of the first, returns the
+        # number of rows inserted
+        count = 0
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return count
+
+            columns = tuple(batch[0].keys())
+            sql = get_insert_statement(table_name, columns, on_conflict)
+            with self.transaction():
+                cursor = self.connection.executemany(sql, (tuple(row[column] for column in columns) for row in batch))
+            # NOTE rows skipped by `on_conflict` are not counted
+            count += cursor.rowcount
+
+    def iter_rows(self, table_name: str) -> Iterable[dict]:
+        # NOTE the cursor steps through the table, so rows are never all in memory
+        if table_name not in tables_by_name:
+            raise Exception('table with name `%s` is unspecified' % table_name)
+        cursor = self.connection.execute('SELECT * FROM %s ORDER BY id' % (table_name,))
+        columns = [column[0] for column in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
+
     def create_agent(
             self,
             name: str,
             language: str,
             proficiency: str,
             prompt: str) -> tuple:
-        return self.table_insert(
+        agent = self.table_insert(
                 'agents',
                 name=name,
                 language=language,
                 proficiency=proficiency,
                 prompt=prompt)
+        self.invalidate_conversations('agent_id', agent[0])
+        return agent
 
     def create_user(
             self,
             name: str,
             email: str,
             salt: str,
-            password: str) -> tuple:
-        return self.table_insert(
+            password: str,
+            weight: float = 1.0) -> tuple:
+        user = self.table_insert(
                 'users',
                 name=name,
                 email=email,
                 salt=salt,
-                password=password)
+                password=password,
+                weight=weight)
+        self.invalidate_conversations('user_id', user[0])
+        return user
+
+    def set_user_weight(self, id: int, weight: float) -> Optional[tuple]:
+        with self.transaction():
+            res = self.connection.execute('UPDATE users SET weight = ? WHERE id = ? RETURNING *', (weight, id))
+            user = res.fetchone()
+        self.invalidate_conversations('user_id', id)
+        return user
 
     def create_conversation(
             self,
@@ -143,51 +480,252 @@ class Database:
             agent_id: int,
             proficiency: str,
             model: str) -> tuple:
-        return self.table_insert(
+        conversation = self.table_insert(
                 'conversations',
                 user_id=user_id,
                 agent_id=agent_id,
                 proficiency=proficiency,
                 model=model)
+        self.invalidate_conversations('id', conversation[0])
+        return conversation
+
+    @timed(query_seconds, method='onboard_users')
+    def onboard_users(self, users: list[dict]) -> list:
+        # NOTE creates each user with their conversation in one transaction for
+        # the batch, a row that fails is rolled back alone and its exception
+        # is returned in its place
+        agent_ids = {row[0] for row in self.connection.execute('SELECT id FROM agents')}
+        results = []
+        with self.transaction():
+            if not self.connection.in_transaction:
+                self.connection.execute('BEGIN')
+            for user in users:
+                try:
+                    if user.get('agent_id') not in agent_ids:
+                        raise Exception('agent with `id` %s does not exist' % (user.get('agent_id'),))
+                    with self.savepoint('onboard_user'):
+                        user_row = self.create_user(
+                                name=user.get('name'),
+                                email=user.get('email'),
+                                salt=user.get('salt'),
+                                password=user.get('password'),
+                                weight=user.get('weight', 1.0))
+                        conversation_row = self.create_conversation(
+                                user_id=user_row[0],
+                                agent_id=user.get('agent_id'),
+                                proficiency=user.get('proficiency'),
+                                model=user.get('model'))
+                    results.append((user_row[0], conversation_row[0]))
+                except Exception as e:
+                    results.append(e)
+        return results
+
+    @timed(query_seconds, method='create_message')
+    def create_message(self, conversation_id: int, role: str, content: str, **kwargs):
+        created_at = datetime.now(timezone.utc).isoformat()
+        with self.transaction():
+            message = self.table_insert(
+                    'messages',
+                    conversation_id=conversation_id,
+                    role=role,
+                    content=content,
+                    created_at=created_at,
+                    **kwargs)
+            self.connection.execute("""
+                UPDATE conversations
+                SET last_message_at = ?,
+                    bumps = CASE WHEN ? = 'user' THEN 0 ELSE bumps END
+                WHERE id = ?
+            """, (created_at, role, conversation_id))
+        return message
+
+    def update_last_message_at(self) -> None:
+        # NOTE for rows inserted around `create_message`, as by an import, while
+        # activity that was imported along with them is kept
+        with self.transaction():
+            self.connection.execute(update_last_message_at_statement)
 
-    def create_message(self, conversation_id: int, role: str, content: str):
+    def add_user_message(self, conversation_id: int, content: str, message_id: Optional[str] = None):
+        return self.create_message(conversation_id, 'user', content, message_id=message_id)
+
+    def has_message_id(self, message_id: str) -> bool:
+        res = self.connection.execute('SELECT 1 FROM messages WHERE message_id = ?', (message_id,))
+        return res.fetchone() is not None
+
+    def add_assistant_message(
+            self,
+            conversation_id: int,
+            content: str,
+            reply_to: Optional[int] = None,
+            generation: Optional[dict] = None):
+        # NOTE the message and the Ollama response it came from are committed together
+        with self.transaction():
+            message = self.create_message(conversation_id, 'assistant', content, reply_to=reply_to)
+            if generation:
+                self.create_generation(message[0], conversation_id, generation)
+        return message
+
+    @timed(query_seconds, method='add_assistant_messages')
+    def add_assistant_messages(self, messages: list[tuple[int, str, Optional[dict]]]) -> list[tuple]:
+        # NOTE one transaction for the whole batch rather than one per row
+        with self.transaction():
+            return [self.add_assistant_message(conversation_id, content, generation=generation)
+                    for conversation_id, content, generation in messages]
+
+    def create_generation(self, message_id: int, conversation_id: int, generation: dict) -> tuple:
         now = datetime.now(timezone.utc)
         return self.table_insert(
-                'messages',
+                'generations',
+                message_id=message_id,
                 conversation_id=conversation_id,
-                role=role,
-                content=content,
+                model=generation.get('model'),
+                backend=generation.get('backend'),
+                prompt_eval_count=generation.get('prompt_eval_count'),
+                eval_count=generation.get('eval_count'),
+                total_duration=generation.get('total_duration'),
+                load_duration=generation.get('load_duration'),
+                prompt_eval_duration=generation.get('prompt_eval_duration'),
+                eval_duration=generation.get('eval_duration'),
+                time_to_first_token=generation.get('time_to_first_token'),
+                done_reason=generation.get('done_reason'),
                 created_at=now.isoformat())
 
-    def add_user_message(self, conversation_id: int, content: str):
-        self.create_message(conversation_id, 'user', content)
+    def get_model_throughput(self, since: str) -> list[tuple]:
+        res = self.connection.execute("""
+            SELECT
+                model,
+                COUNT(*),
+                AVG(prompt_eval_count),
+                AVG(eval_count),
+                SUM(prompt_eval_count) * 1e9 / NULLIF(SUM(prompt_eval_duration), 0),
+                SUM(eval_count) * 1e9 / NULLIF(SUM(eval_duration), 0),
+                AVG(time_to_first_token),
+                AVG(total_duration) / 1e9
+            FROM generations
+            WHERE created_at >= ?
+            GROUP BY model
+            ORDER BY COUNT(*) DESC
+        """, (since,))
+        return res.fetchall()
 
-    def add_assistant_message(self, conversation_id: int, content: str):
-        self.create_message(conversation_id, 'assistant', content)
+    def get_prompt_growth(self, since: str, limit: int = 20) -> list[tuple]:
+        # NOTE the conversations whose prompts grew the most, with the first and
+        # latest prompt sizes in the period
+        res = self.connection.execute("""
+            SELECT
+                conversation_id,
+                COUNT(*),
+                (SELECT prompt_eval_count FROM generations first
+                 WHERE first.conversation_id = generation.conversation_id AND first.created_at >= ?
+                 ORDER BY first.id LIMIT 1) AS first_prompt,
+                (SELECT prompt_eval_count FROM generations latest
+                 WHERE latest.conversation_id = generation.conversation_id
+                 ORDER BY latest.id DESC LIMIT 1) AS latest_prompt,
+                MAX(prompt_eval_count)
+            FROM generations generation
+            WHERE created_at >= ?
+            GROUP BY conversation_id
+            ORDER BY latest_prompt - first_prompt DESC, MAX(prompt_eval_count) DESC
+            LIMIT ?
+        """, (since, since, limit))
+        return res.fetchall()
 
-    def get_conversation(self, id: int):
+    def get_cold_loads(self, since: str, threshold: float) -> list[tuple]:
+        # NOTE a load slower than `threshold` seconds means the model was not resident
         res = self.connection.execute("""
             SELECT
-                conversation.id,
-                conversation.model,
-                conversation.user_id,
-                user.email AS user_email,
-                user.name AS user_name,
-                conversation.proficiency AS user_proficiency,
-                conversation.agent_id,
-                agent.name AS agent_name,
-                agent.language AS agent_language,
-                agent.proficiency AS agent_proficiency,
-                agent.prompt AS agent_prompt
-            FROM conversations conversation
-            JOIN users user
-            ON conversation.user_id = user.id
-            JOIN agents agent
-            ON conversation.agent_id = agent.id
+                model,
+                COUNT(*),
+                SUM(load_duration > ?),
+                AVG(CASE WHEN load_duration > ? THEN load_duration END) / 1e9
+            FROM generations
+            WHERE created_at >= ?
+            GROUP BY model
+            ORDER BY SUM(load_duration > ?) DESC
+        """, (threshold * 1e9, threshold * 1e9, since, threshold * 1e9))
+        return res.fetchall()
+
+    @timed(query_seconds, method='get_active_models')
+    def get_active_models(self, since: str) -> list[tuple[str, int]]:
+        # NOTE models of conversations with a message since `since`, the
+        # busiest first, found through the index on `last_message_at` rather
+        # than by scanning every message, `+model` keeps SQLite from walking
+        # every conversation in model order to group them instead
+        res = self.connection.execute("""
+            SELECT model, COUNT(*) FROM conversations
+            WHERE last_message_at >= ?
+            GROUP BY +model
+            ORDER BY COUNT(*) DESC
+        """, (since,))
+        return res.fetchall()
+
+    @timed(query_seconds, method='mark_messages_sent')
+    def mark_messages_sent(self, ids: list[int]):
+        now = datetime.now(timezone.utc)
+        with self.transaction():
+            self.connection.executemany(
+                    "UPDATE messages SET sent_at = ? WHERE id = ?",
+                    [(now.isoformat(), id) for id in ids])
+
+    @timed(query_seconds, method='get_last_messages')
+    def get_last_messages(self, conversation_ids: list[int]) -> dict[int, tuple]:
+        res = self.connection.execute("""
+            SELECT conversation_id, id, role, content, sent_at FROM messages
+            WHERE id IN (
+                SELECT MAX(id) FROM messages
+                WHERE conversation_id IN ({ids})
+                GROUP BY conversation_id
+            )
+        """.format(ids=','.join('?' * len(conversation_ids))), conversation_ids)
+        return {row[0]: row[1:] for row in res.fetchall()}
+
+    @timed(query_seconds, method='get_reply_state')
+    def get_reply_state(self, conversation_id: int) -> tuple[Optional[int], Optional[tuple]]:
+        # NOTE the latest user message, and the latest reply with what it answered
+        res = self.connection.execute(
+                "SELECT MAX(id) FROM messages WHERE conversation_id = ? AND role = 'user'",
+                (conversation_id,))
+        user_message_id = res.fetchone()[0]
+        res = self.connection.execute("""
+            SELECT id, reply_to, content, sent_at FROM messages
+            WHERE conversation_id = ? AND role = 'assistant'
+            ORDER BY id DESC
+            LIMIT 1
+        """, (conversation_id,))
+        return (user_message_id, res.fetchone())
+
+    @timed(query_seconds, method='get_conversation')
+    def get_conversation(self, id: int):
+        res = self.connection.execute(conversation_query + """
             WHERE conversation.id = ?
         """, (id,))
         return res.fetchone()
 
+    @timed(query_seconds, method='get_conversations')
+    def get_conversations(self, ids: list[int]) -> list[tuple]:
+        res = self.connection.execute(conversation_query + """
+            WHERE conversation.id IN ({ids})
+        """.format(ids=','.join('?' * len(ids))), ids)
+        return res.fetchall()
+
+    def get_conversation_dict(self, id: int) -> Optional[dict[str, str]]:
+        # NOTE the cached dict is shared, so callers must not modify it
+        if self.conversation_cache:
+            conversation = self.conversation_cache.get(id)
+            if conversation:
+                return conversation
+
+        result = self.get_conversation(id)
+        if not result:
+            return None
+
+        conversation = self.conversation_to_dict(result)
+        # NOTE the system prompt only changes with the rows it is rendered from
+        conversation['system_prompt'] = create_prompt_from_conversation(conversation)
+        if self.conversation_cache:
+            self.conversation_cache.set(id, conversation)
+        return conversation
+
     def conversation_to_dict(self, conversation: tuple) -> dict[str, str]:
         return dict(zip(('id',
                          'model',
@@ -199,19 +737,315 @@ class Database:
                          'agent_name',
                          'agent_language',
                          'agent_proficiency',
-                         'agent_prompt'),
+                         'agent_prompt',
+                         'user_weight'),
                     conversation))
 
-    def get_messages_by_conversation(self, conversation_id: int):
-        res = self.connection.execute("SELECT role, content FROM messages WHERE conversation_id = ?", (conversation_id,))
+    @timed(query_seconds, method='get_messages_by_conversation')
+    def get_messages_by_conversation(self, conversation_id: int, archived: bool = False):
+        res = self.connection.execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY id",
+                (conversation_id,))
+        messages = res.fetchall()
+        if archived:
+            # NOTE archives are only decompressed when the full history is asked for
+            archive = [(message['role'], message['content']) for message in self.get_archived_messages(conversation_id)]
+            messages = archive + messages
+        return messages
+
+    def get_archived_messages(self, conversation_id: int) -> list[dict]:
+        res = self.connection.execute(
+                "SELECT content FROM archives WHERE conversation_id = ? ORDER BY first_message_id",
+                (conversation_id,))
+        messages = []
+        for content, in res:
+            messages.extend(dict(zip(archive_columns, row)) for row in json.loads(zlib.decompress(content)))
+        return messages
+
+    def get_archivable_conversations(self, before: str) -> list[tuple[int, int]]:
+        # NOTE only messages already folded into a summary are archived, the
+        # ones after it are still read to build prompts
+        res = self.connection.execute("""
+            SELECT summary.conversation_id, summary.message_id
+            FROM summaries summary
+            WHERE EXISTS (
+                SELECT 1 FROM messages message
+                WHERE message.conversation_id = summary.conversation_id
+                AND message.id <= summary.message_id
+                AND message.created_at < ?
+            )
+            ORDER BY summary.conversation_id
+        """, (before,))
+        return res.fetchall()
+
+    @timed(query_seconds, method='archive_messages')
+    def archive_messages(self, conversation_id: int, message_id: int, before: str, level: int = 6) -> int:
+        # NOTE moves the messages up to `message_id` and older than `before`
+        # into one compressed blob, in a single transaction
+        with self.transaction():
+            res = self.connection.execute("""
+                SELECT {columns} FROM messages
+                WHERE conversation_id = ? AND id <= ? AND created_at < ?
+                ORDER BY id
+            """.format(columns=', '.join(archive_columns)), (conversation_id, message_id, before))
+            rows = res.fetchall()
+            if not rows:
+                return 0
+
+            content = zlib.compress(json.dumps(rows, ensure_ascii=False).encode('utf-8'), level)
+            self.table_insert(
+                    'archives',
+                    conversation_id=conversation_id,
+                    first_message_id=rows[0][0],
+                    last_message_id=rows[-1][0],
+                    message_count=len(rows),
+                    content=content,
+                    created_at=datetime.now(timezone.utc).isoformat())
+            self.connection.execute(
+                    "DELETE FROM messages WHERE conversation_id = ? AND id <= ? AND created_at < ?",
+                    (conversation_id, message_id, before))
+        return len(rows)
+
+    def enqueue_job(
+            self,
+            kind: str,
+            payload: dict,
+            delay: float = 0,
+            conversation_id: Optional[int] = None) -> tuple:
+        now = datetime.now(timezone.utc)
+        return self.table_insert(
+                'jobs',
+                kind=kind,
+                conversation_id=conversation_id,
+                payload=json.dumps(payload),
+                available_at=time.time() + delay,
+                created_at=now.isoformat())
+
+    @timed(query_seconds, method='enqueue_coalesced_job')
+    def enqueue_coalesced_job(
+            self,
+            kind: str,
+            conversation_id: int,
+            payload: dict,
+            window: float,
+            max_wait: float) -> tuple:
+        now = time.time()
+        # NOTE a pending job for the conversation takes the newer payload and is
+        # pushed back by `window`, but never past `max_wait` since it was first
+        # enqueued, otherwise a new job waits out the window
+        with self.transaction():
+            res = self.connection.execute("""
+                UPDATE jobs
+                SET payload = json_set(?, '$.enqueued_at', json_extract(payload, '$.enqueued_at')),
+                    available_at = MIN(?, json_extract(payload, '$.enqueued_at') + ?)
+                WHERE kind = ? AND conversation_id = ? AND status = 'pending'
+                RETURNING *
+            """, (json.dumps(payload), now + window, max_wait, kind, conversation_id))
+            job = res.fetchone()
+            if job:
+                return job
+
+            return self.enqueue_job(
+                    kind,
+                    {**payload, 'enqueued_at': now},
+                    delay=window,
+                    conversation_id=conversation_id)
+
+    @timed(query_seconds, method='claim_job')
+    def claim_job(self, visibility_timeout: float, kinds: Optional[list[str]] = None) -> Optional[tuple]:
+        now = time.time()
+        # NOTE a running job whose lock has expired belongs to a worker that
+        # died or hung, so it is claimable again, while jobs wait for any
+        # running job of the same kind and conversation, and for any earlier
+        # one still to run, say a mail waiting to be retried, so replies stay
+        # ordered
+        kind_clause = 'AND job.kind IN (%s)' % (','.join('?' for _ in kinds),) if kinds else ''
+        # NOTE the user with the fewest jobs of the kind running for their
+        # weight goes first, so a backlog from one user does not hold up the
+        # next user's job until it drains, and ties go in order of arrival
+        with self.transaction():
+            res = self.connection.execute("""
+                UPDATE jobs
+                SET status = 'running', attempts = attempts + 1, locked_until = ?
+                WHERE id = (
+                    SELECT job.id FROM jobs job
+                    LEFT JOIN conversations conversation
+                    ON job.conversation_id = conversation.id
+                    LEFT JOIN users user
+                    ON conversation.user_id = user.id
+                    WHERE ((job.status = 'pending' AND job.available_at <= ?)
+                    OR (job.status = 'running' AND job.locked_until <= ?))
+                    {kind_clause}
+                    AND NOT EXISTS (
+                        SELECT 1 FROM jobs other
+                        WHERE other.conversation_id = job.conversation_id
+                        AND other.kind = job.kind
+                        AND ((other.status = 'running' AND other.locked_until > ?)
+                        OR (other.id < job.id AND other.status IN ('pending', 'running')))
+                    )
+                    ORDER BY (
+                        SELECT COUNT(*) FROM jobs running
+                        JOIN conversations running_conversation
+                        ON running.conversation_id = running_conversation.id
+                        WHERE running_conversation.user_id = conversation.user_id
+                        AND running.kind = job.kind
+                        AND running.status = 'running'
+                        AND running.locked_until > ?
+                    ) / COALESCE(user.weight, 1), job.available_at, job.id
+                    LIMIT 1
+                )
+                RETURNING id, kind, payload, attempts
+            """.format(kind_clause=kind_clause), (now + visibility_timeout, now, now, *(kinds or ()), now, now))
+            return res.fetchone()
+
+    def job_to_dict(self, job: tuple) -> dict:
+        id, kind, payload, attempts = job
+        return {
+            'id': id,
+            'kind': kind,
+            'payload': json.loads(payload),
+            'attempts': attempts
+        }
+
+    @timed(query_seconds, method='complete_job')
+    @timed(query_seconds, method='extend_job')
+    def extend_job(self, id: int, visibility_timeout: float) -> bool:
+        # NOTE keeps a job that is still running from being claimed again, and
+        # is a no-op for a job that was reclaimed or finished meanwhile
+        with self.transaction():
+            res = self.connection.execute("""
+                UPDATE jobs SET locked_until = ?
+                WHERE id = ? AND status = 'running'
+            """, (time.time() + visibility_timeout, id))
+            return res.rowcount > 0
+
+    def complete_job(self, id: int):
+        with self.transaction():
+            self.connection.execute("DELETE FROM jobs WHERE id = ?", (id,))
+
+    @timed(query_seconds, method='fail_job')
+    def fail_job(self, id: int, error: str, delay: float, max_attempts: int):
+        with self.transaction():
+            self.connection.execute("""
+                UPDATE jobs
+                SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'pending' END,
+                    available_at = ?,
+                    locked_until = NULL,
+                    last_error = ?
+                WHERE id = ?
+            """, (max_attempts, time.time() + delay, error, id))
+
+    @timed(query_seconds, method='defer_job')
+    def defer_job(self, id: int, delay: float):
+        # NOTE puts a job back without counting the attempt, for when it could
+        # not run rather than failed
+        with self.transaction():
+            self.connection.execute("""
+                UPDATE jobs
+                SET status = 'pending',
+                    attempts = MAX(attempts - 1, 0),
+                    available_at = ?,
+                    locked_until = NULL
+                WHERE id = ?
+            """, (time.time() + delay, id))
+
+    @timed(query_seconds, method='get_dormant_conversations')
+    def get_dormant_conversations(self, before: str, max_bumps: int, limit: int) -> list[int]:
+        # NOTE the longest dormant first, skipping conversations with a job in
+        # flight and those whose bump could not be sent
+        res = self.connection.execute("""
+            SELECT id FROM conversations conversation
+            WHERE last_message_at < ? AND bumps < ?
+            AND NOT EXISTS (
+                SELECT 1 FROM jobs job
+                WHERE job.conversation_id = conversation.id
+                AND (job.status IN ('pending', 'running') OR (job.kind = 'bump' AND job.status = 'dead'))
+            )
+            ORDER BY last_message_at
+            LIMIT ?
+        """, (before, max_bumps, limit))
+        return [row[0] for row in res.fetchall()]
+
+    def get_activity(self, conversation_id: int) -> Optional[tuple[str, int]]:
+        res = self.connection.execute(
+                "SELECT last_message_at, bumps FROM conversations WHERE id = ?",
+                (conversation_id,))
+        return res.fetchone()
+
+    def enqueue_bumps(self, conversation_ids: list[int], before: str) -> list[int]:
+        # NOTE the job skips a conversation that saw a message after `before`
+        now = time.time()
+        with self.transaction():
+            for conversation_id in conversation_ids:
+                self.enqueue_job(
+                        'bump',
+                        {'conversation_id': conversation_id, 'before': before, 'enqueued_at': now},
+                        conversation_id=conversation_id)
+        return conversation_ids
+
+    def add_bump_message(self, conversation_id: int, content: str, generation: Optional[dict] = None):
+        with self.transaction():
+            message = self.add_assistant_message(conversation_id, content, generation=generation)
+            self.connection.execute("UPDATE conversations SET bumps = bumps + 1 WHERE id = ?", (conversation_id,))
+        return message
+
+    def get_sent_at(self, message_id: int) -> Optional[str]:
+        res = self.connection.execute("SELECT sent_at FROM messages WHERE id = ?", (message_id,))
+        row = res.fetchone()
+        return row[0] if row else None
+
+    def count_jobs(self) -> dict[tuple[str, str], int]:
+        res = self.connection.execute("SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status")
+        return {(kind, status): count for kind, status, count in res.fetchall()}
+
+    def requeue_dead_jobs(self) -> int:
+        with self.transaction():
+            res = self.connection.execute("""
+                UPDATE jobs
+                SET status = 'pending', attempts = 0, available_at = ?
+                WHERE status = 'dead'
+            """, (time.time(),))
+            return res.rowcount
+
+    @timed(query_seconds, method='get_messages_after')
+    def get_messages_after(
+            self,
+            conversation_id: int,
+            message_id: int = 0,
+            until: Optional[int] = None):
+        res = self.connection.execute("""
+            SELECT id, role, content FROM messages
+            WHERE conversation_id = ? AND id > ? AND id <= ?
+            ORDER BY id
+        """, (conversation_id, message_id, until if until is not None else sys.maxsize))
         return res.fetchall()
 
+    @timed(query_seconds, method='get_summary')
+    def get_summary(self, conversation_id: int):
+        res = self.connection.execute(
+                "SELECT message_id, content FROM summaries WHERE conversation_id = ?",
+                (conversation_id,))
+        return res.fetchone()
+
+    @timed(query_seconds, method='save_summary')
+    def save_summary(self, conversation_id: int, message_id: int, content: str):
+        now = datetime.now(timezone.utc)
+        with self.transaction():
+            self.connection.execute("""
+                INSERT INTO summaries (conversation_id, message_id, content, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(conversation_id) DO UPDATE SET
+                    message_id = excluded.message_id,
+                    content = excluded.content,
+                    updated_at = excluded.updated_at
+            """, (conversation_id, message_id, content, now.isoformat()))
+
     def table_delete(self, table_name: str):
         table = tables_by_name.get(table_name)
         if not table:
             raise Exception('table with name `%s` is unspecified' % table_name)
 
-        with self.connection:
+        with self.transaction():
             self.connection.execute("DELETE FROM %s" % (table_name,))
             self.connection.execute("DELETE FROM SQLITE_SEQUENCE WHERE name = ?", [table_name])
 
@@ -219,10 +1053,97 @@ class Database:
         self.table_delete('messages')
 
 
+# NOTE WAL lets readers proceed while the single writer appends, and
+# `synchronous = NORMAL` is durable in WAL mode save for power loss
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'mmap_size': 268435456
+}
+
+
+def connect(url: str, pragmas: Optional[dict] = None) -> sqlite3.Connection:
+    # NOTE pooled connections move between threads, but are only ever used
+    # by one thread at a time
+    connection = sqlite3.connect(url, check_same_thread=False)
+    for key, value in {**DEFAULT_PRAGMAS, **(pragmas or {})}.items():
+        connection.execute('PRAGMA %s = %s' % (key, value))
+    return connection
+
+
 @contextmanager
-def open_db(url: str):
-    connection = sqlite3.connect(url)
+def open_db(url: str, pragmas: Optional[dict] = None):
+    connection = connect(url, pragmas)
     try:
         yield Database(connection)
     finally:
         connection.close()
+
+
+class ConnectionPool:
+    def __init__(
+            self,
+            url: str,
+            readers: int = 4,
+            pragmas: Optional[dict] = None,
+            conversation_cache: Optional[Cache] = None):
+        self.url = url
+        self.pragmas = pragmas
+        self.conversation_cache = conversation_cache
+        self.max_readers = readers
+        self.readers = queue.LifoQueue()
+        self.reader_count = 0
+        self.reader_lock = threading.Lock()
+        self.writer = None
+        self.write_lock = threading.Lock()
+
+    def acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self.readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.reader_lock:
+            create = self.reader_count < self.max_readers
+            if create:
+                self.reader_count += 1
+
+        if not create:
+            return self.readers.get()
+
+        connection = connect(self.url, self.pragmas)
+        connection.execute('PRAGMA query_only = ON')
+        return connection
+
+    @contextmanager
+    def read(self):
+        connection = self.acquire_reader()
+        try:
+            yield Database(connection, self.conversation_cache)
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            self.readers.put(connection)
+
+    @contextmanager
+    def write(self):
+        # NOTE writes within the process are serialized here rather than on
+        # the SQLite lock, `busy_timeout` covers writers in other processes
+        with self.write_lock:
+            if not self.writer:
+                self.writer = connect(self.url, self.pragmas)
+            yield Database(self.writer, self.conversation_cache)
+
+    def close(self) -> None:
+        with self.write_lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
@@ -1,8 +1,18 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import re
 from typing import Optional
 
+import httpx
 import requests
 
+from .breaker import CircuitBreaker
+from .metrics import Counter, Histogram, timed
+from .ratelimit import TokenBucket
+
+send_seconds = Histogram('francoise_mail_send_seconds', 'Time spent posting to the Mailgun API.')
+sends_total = Counter('francoise_mail_sends_total', 'Posts to the Mailgun API by outcome.', ('outcome',))
+
 
 def parse_to_header(headers: str) -> Optional[str]:
     match = re.search('\\["To",([^\\]]*)\\]', headers)
@@ -21,6 +31,78 @@ def parse_conversation_id_from_headers(headers: str) -> Optional[int]:
     return int(match.group(1))
 
 
+# NOTE a single search for anything that could start a quote or signature,
+# most emails have none and skip the line by line pass
+body_marker_pattern = re.compile(
+        r'^\s*>|wrote\s*:|écrit\s*:|^--\s*$|^\s*-{2,}|^\s*(?:from|de)\s*:|^\s*(?:sent from|envoyé de|get outlook)',
+        re.IGNORECASE | re.MULTILINE)
+
+attribution_pattern = re.compile(r'^\s*(?:on|le)\s.+(?:wrote|a écrit)\s*:\s*$', re.IGNORECASE)
+# NOTE what a client writes into an attribution, but prose rarely has
+address_pattern = re.compile(r'<?[^\s<>@]+@[^\s<>@]+\.[^\s<>@]+>?')
+time_pattern = re.compile(r'\b\d{1,2}[:h]\d{2}\b')
+year_pattern = re.compile(r'\b(?:19|20)\d{2}\b')
+separator_pattern = re.compile(
+        r"^\s*-{2,}\s*(?:original message|forwarded message|message d'origine|message transféré)",
+        re.IGNORECASE)
+header_pattern = re.compile(r'^\s*(?:from|de)\s*:\s*\S', re.IGNORECASE)
+header_field_pattern = re.compile(r'^\s*(?:sent|date|envoyé|to|à|cc|subject|objet)\s*:', re.IGNORECASE)
+mobile_signature_pattern = re.compile(r'^\s*(?:sent from my|envoyé de mon|get outlook for)', re.IGNORECASE)
+
+
+def is_attribution(line: str) -> bool:
+    # NOTE `Le journal a écrit :` is a sentence, an attribution also carries
+    # the sender's address or the date and time of the quoted email
+    if not attribution_pattern.match(line):
+        return False
+    return bool(address_pattern.search(line) or (time_pattern.search(line) and year_pattern.search(line)))
+
+
+def is_quote_start(lines: list[str], i: int) -> bool:
+    line = lines[i]
+
+    # NOTE the conventional signature delimiter is `-- `
+    if line.rstrip() == '--':
+        return True
+
+    if separator_pattern.match(line) or mobile_signature_pattern.match(line):
+        return True
+
+    # NOTE attributions are often wrapped onto a second line
+    if is_attribution(line):
+        return True
+    if i + 1 < len(lines) and is_attribution('%s %s' % (line, lines[i + 1])):
+        return True
+
+    # NOTE Outlook quotes without `>` behind a `From:` and `Sent:` header block
+    if header_pattern.match(line):
+        fields = [next_line for next_line in lines[i + 1:i + 4] if next_line.strip()]
+        return any(header_field_pattern.match(field) for field in fields)
+
+    return False
+
+
+def normalize_body(body: str) -> str:
+    body = body.replace('\r\n', '\n').strip()
+    if not body_marker_pattern.search(body):
+        return body
+
+    lines = body.split('\n')
+    kept = []
+    for i, line in enumerate(lines):
+        if is_quote_start(lines, i):
+            break
+        # NOTE drops inline quotes, but keeps the answers between them
+        if line.lstrip().startswith('>'):
+            continue
+        kept.append(line)
+
+    normalized = re.sub(r'\n{3,}', '\n\n', '\n'.join(kept)).strip()
+    # NOTE a message that is entirely quoted is kept as is rather than lost
+    return normalized or body
+
+
+@timed(send_seconds)
 def send_mail(url: str, **kwargs):
     if not url:
         raise Exception('url is unspecified')
@@ -33,7 +115,94 @@ def send_mail(url: str, **kwargs):
     if not data:
         raise Exception('data is unspecified')
 
-    response = requests.post(url, auth=("api", api_key), data=data)
+    response = requests.post(url, auth=("api", api_key), data=data, timeout=kwargs.get('timeout', 30))
     # throw an error if we got a failure from the Mailgun API
     response.raise_for_status()
     return response
+
+
+class RateLimited(Exception):
+    def __init__(self, delay: float):
+        super().__init__('rate limited by Mailgun for %.1fs' % (delay,))
+        self.delay = delay
+
+
+def parse_retry_after(value: Optional[str], default: float) -> float:
+    # NOTE either seconds or an HTTP date
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+class MailClient:
+    def __init__(
+            self,
+            url: str,
+            api_key: str,
+            timeout: float = 10.0,
+            max_connections: int = 4,
+            rate: float = 10.0,
+            burst: float = 10.0,
+            breaker: Optional[CircuitBreaker] = None,
+            retry_after: float = 60.0):
+        self.url = url
+        self.api_key = api_key
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = breaker or CircuitBreaker()
+        self.retry_after = retry_after
+        self.client = httpx.AsyncClient(
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+
+    async def send(self, data: dict) -> dict:
+        if not self.url:
+            raise Exception('url is unspecified')
+
+        if not self.api_key:
+            raise Exception('api_key is unspecified')
+
+        if not data:
+            raise Exception('data is unspecified')
+
+        # NOTE raises `CircuitOpen` without calling Mailgun while it is down
+        self.breaker.before()
+        try:
+            await self.bucket.acquire()
+
+            try:
+                with send_seconds.time():
+                    response = await self.client.post(self.url, auth=('api', self.api_key), data=data)
+            except httpx.TransportError:
+                sends_total.inc(outcome='unreachable')
+                self.breaker.failure()
+                raise
+
+            if response.status_code >= 500:
+                sends_total.inc(outcome='failed')
+                self.breaker.failure()
+            else:
+                # NOTE being throttled or rejected still means Mailgun is up
+                self.breaker.success()
+
+            if response.status_code == 429:
+                sends_total.inc(outcome='throttled')
+                raise RateLimited(parse_retry_after(response.headers.get('Retry-After'), self.retry_after))
+
+            if response.status_code < 500:
+                sends_total.inc(outcome='sent' if response.is_success else 'rejected')
+        finally:
+            self.breaker.release()
+
+        # throw an error if we got a failure from the Mailgun API
+        response.raise_for_status()
+        return response.json()
+
+    async def close(self) -> None:
+        await self.client.aclose()
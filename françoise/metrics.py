@@ -0,0 +1,168 @@
+from collections.abc import Callable
+from contextlib import contextmanager
+import functools
+import math
+import threading
+import time
+from typing import Optional
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # NOTE every observation is a no-op until metrics are enabled
+        self.enabled = False
+
+    def render(self) -> str:
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+registry = Registry()
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def format_labels(names: tuple, values: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in pairs)
+    return '{%s}' % (','.join('%s="%s"' % (name, value) for (name, _), value in zip(pairs, escaped)),)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.metrics.append(self)
+
+    def get_key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def get_values(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+    def render_samples(self, values: dict) -> list[str]:
+        return ['%s%s %s\n' % (self.name, format_labels(self.labels, key), format_value(value))
+                for key, value in values.items()]
+
+    def render(self) -> str:
+        lines = ['# HELP %s %s\n' % (self.name, self.help), '# TYPE %s %s\n' % (self.name, self.type)]
+        return ''.join(lines + self.render_samples(self.get_values()))
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not registry.enabled:
+            return
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self.function = None
+
+    def set_function(self, function: Callable[[], dict]) -> None:
+        # NOTE computes the values on scrape, keyed by tuples of label values
+        self.function = function
+
+    def get_values(self) -> dict:
+        if self.function:
+            return {tuple(map(str, key)): value for key, value in self.function().items()}
+        return super().get_values()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not registry.enabled:
+            return
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        if not registry.enabled:
+            return
+        key = self.get_key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if not counts:
+                # NOTE a count per bucket, then the sum
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        if not registry.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def get_values(self) -> dict:
+        with self.lock:
+            return {key: list(counts) for key, counts in self.values.items()}
+
+    def render_samples(self, values: dict) -> list[str]:
+        lines = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d\n' % (
+                    self.name,
+                    format_labels(self.labels, key, ('le', format_value(bucket))),
+                    cumulative))
+            labels = format_labels(self.labels, key)
+            lines.append('%s_sum%s %s\n' % (self.name, labels, format_value(counts[-1])))
+            lines.append('%s_count%s %d\n' % (self.name, labels, cumulative))
+        return lines
+
+
+def timed(histogram: Histogram, **labels):
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return f(*args, **kwargs)
+            with histogram.time(**labels):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
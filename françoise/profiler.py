@@ -0,0 +1,125 @@
+import asyncio
+from collections import Counter
+from collections.abc import Awaitable, Callable
+import cProfile
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def format_frame(frame) -> str:
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), getattr(code, 'co_qualname', code.co_name))
+
+
+def get_stack(frame) -> str:
+    # NOTE folded as `outermost;...;innermost`, the format flame graph tools read
+    stack = []
+    while frame:
+        stack.append(format_frame(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Profiler:
+    def __init__(
+            self,
+            directory: str,
+            sample_rate: float = 0.0,
+            allocations: bool = True,
+            top_allocations: int = 10,
+            interval: float = 0.005,
+            max_stacks: int = 10000):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.allocations = allocations
+        self.top_allocations = top_allocations
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.active = None
+
+    def should_sample(self) -> bool:
+        # NOTE one job at a time, as cProfile and tracemalloc are process wide
+        return self.active is None and random.random() < self.sample_rate
+
+    def wrap(self, handler: Callable[[dict], Awaitable[None]]) -> Callable[[dict], Awaitable[None]]:
+        async def run(job: dict) -> None:
+            if not self.should_sample():
+                return await handler(job)
+            return await self.profile(handler, job)
+        return run
+
+    def sample(self, thread_id: int, stopped: threading.Event) -> None:
+        while not stopped.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = get_stack(frame)
+            with self.lock:
+                if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                    self.stacks[stack] += 1
+
+    async def profile(self, handler: Callable[[dict], Awaitable[None]], job: dict) -> None:
+        # NOTE the event loop runs other jobs and requests in between, which
+        # show up in the profile too, so it reads as the process under load
+        # while this job ran rather than the job alone
+        self.active = job
+        name = '%d-%s-%d' % (time.time() * 1000, job.get('kind'), job.get('id'))
+        tracing = self.allocations and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        stopped = threading.Event()
+        sampler = threading.Thread(target=self.sample, args=(threading.get_ident(), stopped), daemon=True)
+        profile = cProfile.Profile()
+        sampler.start()
+        profile.enable()
+        try:
+            return await handler(job)
+        finally:
+            profile.disable()
+            stopped.set()
+            snapshot = tracemalloc.take_snapshot() if self.allocations else None
+            if tracing:
+                tracemalloc.stop()
+            self.active = None
+            sampler.join()
+            try:
+                await asyncio.to_thread(self.write, name, profile, snapshot)
+            except Exception:
+                logger.exception('failed to write the profile of job %s', job.get('id'))
+
+    def write(self, name: str, profile: cProfile.Profile, snapshot: Optional[tracemalloc.Snapshot]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        # NOTE read with `python -m pstats` or snakeviz
+        profile.dump_stats(path + '.prof')
+
+        if snapshot:
+            # NOTE leaves out what profiling itself allocated
+            snapshot = snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, cProfile.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+            with open(path + '.allocations.txt', 'w') as file:
+                for statistic in snapshot.statistics('lineno')[:self.top_allocations]:
+                    file.write('%s\n' % (statistic,))
+
+        logger.info('profiled job to %s', path)
+
+    def render_stacks(self, reset: bool = False) -> str:
+        with self.lock:
+            stacks = self.stacks.most_common()
+            if reset:
+                self.stacks = Counter()
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
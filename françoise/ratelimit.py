@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self) -> bool:
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def get_delay(self) -> float:
+        # NOTE seconds until the next token is available
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self) -> None:
+        # NOTE each waiter reserves its token up front, so concurrent waiters
+        # are spaced out rather than all waking at once
+        self.refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
@@ -0,0 +1,150 @@
+import asyncio
+from collections import deque
+from collections.abc import Sequence
+from datetime import datetime, timedelta, timezone
+import logging
+import time
+from typing import Optional
+
+from .db import ConnectionPool
+from .metrics import Counter
+from .router import Router
+
+logger = logging.getLogger(__name__)
+
+warmups_total = Counter('francoise_llm_warmups_total', 'Model warm-ups by outcome.', ('model', 'outcome'))
+
+
+def parse_hours(s: Optional[str]) -> list[int]:
+    # NOTE formatted as `3,4,5`, in UTC
+    return sorted({int(hour) % 24 for hour in filter(None, (s or '').split(','))})
+
+
+def get_seconds_until(hours: Sequence[int], now: datetime) -> float:
+    # NOTE seconds until the start of the next hour in `hours`
+    start = now.replace(minute=0, second=0, microsecond=0)
+    for i in range(1, 25):
+        at = start + timedelta(hours=i)
+        if at.hour in hours:
+            return (at - now).total_seconds()
+    raise Exception('hours is empty or unspecified')
+
+
+class ResidencyManager:
+    def __init__(
+            self,
+            router: Router,
+            pool: ConnectionPool,
+            keep_alive_min: float = 300.0,
+            keep_alive_max: float = 3600.0,
+            window: float = 3600.0,
+            active_days: float = 7.0,
+            max_models: int = 1,
+            warmup_on_start: bool = True,
+            warmup_hours: Sequence[int] = ()):
+        self.router = router
+        self.pool = pool
+        self.keep_alive_min = keep_alive_min
+        self.keep_alive_max = keep_alive_max
+        self.window = window
+        self.active_days = active_days
+        self.max_models = max_models
+        self.warmup_on_start = warmup_on_start
+        self.warmup_hours = warmup_hours
+        self.requests = {}
+        self.loading = set()
+        self.tasks = set()
+
+    def record(self, model: str) -> int:
+        now = time.monotonic()
+        requests = self.requests.setdefault(model, deque())
+        requests.append(now)
+        while requests and requests[0] < now - self.window:
+            requests.popleft()
+        return len(requests)
+
+    def get_keep_alive(self, model: str) -> int:
+        now = time.monotonic()
+        count = sum(1 for at in self.requests.get(model, ()) if at >= now - self.window)
+        if not count:
+            return int(self.keep_alive_min)
+        # NOTE keeps the model long enough to catch the next request at the
+        # recent rate, unless requests are too rare to justify holding it
+        keep_alive = 2 * self.window / count
+        if keep_alive > self.keep_alive_max:
+            return int(self.keep_alive_min)
+        return int(max(self.keep_alive_min, keep_alive))
+
+    async def complete(self, messages: Sequence[dict[str, str]], **kwargs) -> dict:
+        model = kwargs.get('model')
+        if model:
+            self.record(model)
+            kwargs.setdefault('keep_alive', self.get_keep_alive(model))
+        return await self.router.complete(messages, **kwargs)
+
+    async def chat(self, messages: Sequence[dict[str, str]], **kwargs) -> str:
+        json = await self.complete(messages, **kwargs)
+        return json['message']['content']
+
+    async def warm(self, model: str, keep_alive: float) -> None:
+        if model in self.loading or self.router.is_loaded(model):
+            return
+
+        self.loading.add(model)
+        started = time.monotonic()
+        try:
+            url = await self.router.load(model, int(keep_alive))
+        except Exception as e:
+            warmups_total.inc(model=model, outcome='failed')
+            logger.warning('failed to warm up model `%s` with `%s`', model, e)
+            return
+        finally:
+            self.loading.discard(model)
+
+        warmups_total.inc(model=model, outcome='loaded')
+        logger.info('warmed up model `%s` on %s in %.3fs', model, url, time.monotonic() - started)
+
+    def prefetch(self, model: str) -> None:
+        # NOTE starts loading a model as soon as a message for it arrives, so
+        # the load overlaps the coalescing window instead of the reply
+        if model in self.loading or self.router.is_loaded(model):
+            return
+        task = asyncio.create_task(self.warm(model, self.get_keep_alive(model)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def get_active_models(self) -> list[str]:
+        since = datetime.now(timezone.utc) - timedelta(days=self.active_days)
+        with self.pool.read() as db:
+            return [model for model, count in db.get_active_models(since.isoformat())]
+
+    async def warm_active(self) -> None:
+        try:
+            models = await asyncio.to_thread(self.get_active_models)
+        except Exception:
+            logger.exception('failed to list the models of active conversations')
+            return
+
+        # NOTE one at a time, so models do not evict each other mid-load
+        for model in models[:self.max_models]:
+            await self.warm(model, max(self.keep_alive_max, self.get_keep_alive(model)))
+
+    async def run(self) -> None:
+        if self.warmup_on_start:
+            await self.warm_active()
+
+        while self.warmup_hours:
+            await asyncio.sleep(get_seconds_until(self.warmup_hours, datetime.now(timezone.utc)))
+            await self.warm_active()
+
+    def start(self) -> None:
+        task = asyncio.create_task(self.run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def stop(self) -> None:
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = set()
@@ -0,0 +1,168 @@
+import asyncio
+from collections.abc import Callable, Sequence
+import logging
+from typing import Optional
+
+import httpx
+
+from .chat import ChatClient
+
+logger = logging.getLogger(__name__)
+
+
+def parse_backend_urls(s: Optional[str]) -> list[str]:
+    # NOTE accepts base URLs, or chat URLs as in `LLM_API_CHAT_URL`
+    urls = []
+    for url in filter(None, (s or '').split(',')):
+        url = url.strip().rstrip('/')
+        if url.endswith('/api/chat'):
+            url = url[:-len('/api/chat')]
+        urls.append(url)
+    return urls
+
+
+def normalize_model(model: str) -> str:
+    # NOTE Ollama reports `gemma3` as `gemma3:latest`
+    return model if ':' in model else '%s:latest' % (model,)
+
+
+class Backend:
+    def __init__(self, url: str, client: ChatClient):
+        self.url = url
+        self.client = client
+        self.healthy = False
+        self.models = set()
+        self.loaded = set()
+        self.in_flight = 0
+
+    def serves(self, model: str) -> bool:
+        return self.healthy and normalize_model(model) in self.models
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < self.client.max_concurrency
+
+
+class Router:
+    def __init__(
+            self,
+            urls: Sequence[str],
+            create_client: Callable[[str], ChatClient],
+            probe_interval: float = 15.0,
+            probe_timeout: float = 5.0):
+        if not urls:
+            raise Exception('urls is empty or unspecified')
+
+        self.backends = [Backend(url, create_client('%s/api/chat' % (url,))) for url in urls]
+        self.probe_interval = probe_interval
+        self.probe_client = httpx.AsyncClient(timeout=probe_timeout)
+        self.task = None
+
+    async def probe(self, backend: Backend) -> None:
+        try:
+            tags = await self.probe_client.get('%s/api/tags' % (backend.url,))
+            tags.raise_for_status()
+            ps = await self.probe_client.get('%s/api/ps' % (backend.url,))
+            ps.raise_for_status()
+        except Exception as e:
+            if backend.healthy:
+                logger.warning('backend %s failed its health check with `%s`', backend.url, e)
+            backend.healthy = False
+            return
+
+        if not backend.healthy:
+            logger.info('backend %s is healthy', backend.url)
+        backend.models = {model.get('name') for model in tags.json().get('models', [])}
+        backend.loaded = {model.get('name') for model in ps.json().get('models', [])}
+        backend.healthy = True
+
+    async def probe_all(self) -> None:
+        await asyncio.gather(*map(self.probe, self.backends))
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            await self.probe_all()
+
+    async def start(self) -> None:
+        await self.probe_all()
+        self.task = asyncio.create_task(self.run())
+
+    def select(self, model: str, excluded: set) -> Optional[Backend]:
+        candidates = [backend for backend in self.backends if backend.serves(model) and backend not in excluded]
+        if not candidates:
+            return None
+        # NOTE prefers a backend that has the model in memory and a free slot,
+        # otherwise the one with the fewest generations in flight, so a warm
+        # model spills over to other backends rather than queueing on one
+        model = normalize_model(model)
+        return min(candidates, key=lambda backend: (
+            not (model in backend.loaded and backend.has_capacity()),
+            backend.in_flight,
+            model not in backend.loaded))
+
+    async def complete(self, messages: Sequence[dict[str, str]], **kwargs) -> dict:
+        model = kwargs.get('model')
+        if not model:
+            raise Exception('model is unspecified')
+
+        excluded = set()
+        while True:
+            backend = self.select(model, excluded)
+            if not backend:
+                raise Exception('no healthy backend serves model `%s`' % (model,))
+
+            backend.in_flight += 1
+            try:
+                result = await backend.client.complete(messages, **kwargs)
+            except httpx.TransportError as e:
+                # NOTE the backend is unreachable, so fail over to the next one
+                # and leave it to the probe to bring it back
+                logger.warning('backend %s failed with `%s`, failing over', backend.url, e)
+                backend.healthy = False
+                excluded.add(backend)
+                continue
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code < 500:
+                    raise
+                logger.warning('backend %s failed with `%s`, failing over', backend.url, e)
+                excluded.add(backend)
+                continue
+            finally:
+                backend.in_flight -= 1
+
+            backend.loaded.add(normalize_model(model))
+            result.setdefault('model', model)
+            result['backend'] = backend.url
+            return result
+
+    async def chat(self, messages: Sequence[dict[str, str]], **kwargs) -> str:
+        json = await self.complete(messages, **kwargs)
+        return json['message']['content']
+
+    def is_loaded(self, model: str) -> bool:
+        return any(backend.healthy and normalize_model(model) in backend.loaded for backend in self.backends)
+
+    async def load(self, model: str, keep_alive: Optional[float] = None) -> Optional[str]:
+        # NOTE loads the model on the backend its next generation would go to
+        backend = self.select(model, set())
+        if not backend:
+            raise Exception('no healthy backend serves model `%s`' % (model,))
+
+        backend.in_flight += 1
+        try:
+            await backend.client.load(model, keep_alive)
+        finally:
+            backend.in_flight -= 1
+
+        backend.loaded.add(normalize_model(model))
+        return backend.url
+
+    async def close(self) -> None:
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+        await self.probe_client.aclose()
+        for backend in self.backends:
+            await backend.client.close()
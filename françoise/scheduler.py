@@ -0,0 +1,95 @@
+import asyncio
+from collections.abc import Sequence
+from contextlib import asynccontextmanager
+import heapq
+import itertools
+from typing import Optional
+
+from .context import estimate_tokens
+from .metrics import Histogram
+
+wait_seconds = Histogram('francoise_scheduler_wait_seconds', 'Time generations waited for a slot.', ('model',))
+
+
+class FairScheduler:
+    def __init__(self, client, capacity: int = 4, by_model: bool = False, max_tenants: int = 10000):
+        self.client = client
+        self.capacity = capacity
+        self.by_model = by_model
+        self.max_tenants = max_tenants
+        self.active = 0
+        self.virtual_time = 0.0
+        # NOTE the finish tag of each tenant's latest generation
+        self.finish = {}
+        self.waiters = []
+        self.counter = itertools.count()
+
+    def get_key(self, tenant, model: Optional[str]):
+        return (tenant, model) if self.by_model else tenant
+
+    def tag(self, key, weight: float, cost: float) -> float:
+        # NOTE start-time fair queuing, a tenant's next generation starts where
+        # its previous one finished, so heavier tenants fall behind lighter ones
+        # in proportion to the tokens they use over their weight
+        start = max(self.virtual_time, self.finish.get(key, 0.0))
+        self.finish[key] = start + cost / max(weight, 1e-3)
+
+        if len(self.finish) > self.max_tenants:
+            # NOTE tenants that caught up with virtual time lose nothing by
+            # being forgotten
+            self.finish = {k: v for k, v in self.finish.items() if v > self.virtual_time}
+        return start
+
+    async def acquire(self, key, weight: float, cost: float) -> None:
+        start = self.tag(key, weight, cost)
+        if self.active < self.capacity and not self.waiters:
+            self.active += 1
+            self.virtual_time = max(self.virtual_time, start)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (start, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # NOTE a slot handed over just before the cancellation is passed on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        while self.waiters and self.active < self.capacity:
+            start, _, future = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self.active += 1
+            self.virtual_time = max(self.virtual_time, start)
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, tenant, weight: float = 1.0, cost: float = 1.0, model: Optional[str] = None):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await self.acquire(self.get_key(tenant, model), weight, cost)
+        wait_seconds.observe(loop.time() - started, model=model)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def complete(
+            self,
+            messages: Sequence[dict[str, str]],
+            tenant=None,
+            weight: Optional[float] = None,
+            **kwargs) -> dict:
+        # NOTE a generation costs roughly its prompt, so long histories count
+        # for more than short ones
+        cost = sum(estimate_tokens(message.get('content', '')) for message in messages)
+        async with self.slot(tenant, weight or 1.0, cost, kwargs.get('model')):
+            return await self.client.complete(messages, **kwargs)
+
+    async def chat(self, messages: Sequence[dict[str, str]], **kwargs) -> str:
+        json = await self.complete(messages, **kwargs)
+        return json['message']['content']
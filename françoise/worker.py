@@ -0,0 +1,139 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+import logging
+import traceback
+from typing import Optional
+
+from .db import ConnectionPool
+from .metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+jobs_total = Counter('francoise_jobs_total', 'Jobs run by outcome.', ('kind', 'outcome'))
+jobs_in_flight = Gauge('francoise_jobs_in_flight', 'Jobs currently running in this process.', ('kind',))
+
+
+class RetryLater(Exception):
+    # NOTE raised by handlers that could not run the job yet, which is put
+    # back for `delay` without counting the attempt
+    def __init__(self, delay: float, message: str = ''):
+        super().__init__(message or 'retry in %.1fs' % (delay,))
+        self.delay = delay
+
+
+class WorkerPool:
+    def __init__(
+            self,
+            pool: ConnectionPool,
+            handlers: dict[str, Callable[[dict], Awaitable[None]]],
+            concurrency: int = 2,
+            poll_interval: float = 1.0,
+            visibility_timeout: float = 600.0,
+            max_attempts: int = 5,
+            retry_delay: float = 30.0):
+        self.pool = pool
+        self.handlers = handlers
+        # NOTE only claims jobs this pool has handlers for
+        self.kinds = list(handlers.keys())
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    def notify(self) -> None:
+        # NOTE lets in-process producers skip the poll interval
+        self.wakeup.set()
+
+    def claim(self) -> Optional[dict]:
+        with self.pool.write() as db:
+            job = db.claim_job(self.visibility_timeout, self.kinds)
+            if not job:
+                return None
+            return db.job_to_dict(job)
+
+    def extend(self, job: dict) -> None:
+        with self.pool.write() as db:
+            db.extend_job(job['id'], self.visibility_timeout)
+
+    async def keep_locked(self, job: dict) -> None:
+        # NOTE renews the lock well before it expires, so a job that waits or
+        # generates for longer than `visibility_timeout` is not run twice
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            try:
+                await asyncio.to_thread(self.extend, job)
+            except Exception:
+                logger.exception('failed to extend the lock of job %d', job['id'])
+
+    def complete(self, job: dict) -> None:
+        with self.pool.write() as db:
+            db.complete_job(job['id'])
+
+    def fail(self, job: dict, error: str) -> None:
+        # NOTE exponential backoff, jobs past `max_attempts` are dead-lettered
+        delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+        with self.pool.write() as db:
+            db.fail_job(job['id'], error, delay, self.max_attempts)
+
+    def defer(self, job: dict, delay: float) -> None:
+        with self.pool.write() as db:
+            db.defer_job(job['id'], delay)
+
+    async def run_job(self, job: dict) -> None:
+        handler = self.handlers.get(job['kind'])
+        jobs_in_flight.inc(kind=job['kind'])
+        lock = asyncio.create_task(self.keep_locked(job))
+        try:
+            if not handler:
+                raise Exception('job kind `%s` has no handler' % job['kind'])
+            try:
+                await handler(job)
+            finally:
+                lock.cancel()
+        except RetryLater as e:
+            logger.info('job %d (%s) deferred with `%s`', job['id'], job['kind'], e)
+            jobs_total.inc(kind=job['kind'], outcome='deferred')
+            await asyncio.to_thread(self.defer, job, e.delay)
+        except Exception:
+            logger.exception('job %d (%s) failed on attempt %d', job['id'], job['kind'], job['attempts'])
+            outcome = 'dead' if job['attempts'] >= self.max_attempts else 'failed'
+            jobs_total.inc(kind=job['kind'], outcome=outcome)
+            await asyncio.to_thread(self.fail, job, traceback.format_exc())
+        else:
+            jobs_total.inc(kind=job['kind'], outcome='completed')
+            await asyncio.to_thread(self.complete, job)
+        finally:
+            jobs_in_flight.dec(kind=job['kind'])
+
+    async def run(self) -> None:
+        while True:
+            self.wakeup.clear()
+            try:
+                job = await asyncio.to_thread(self.claim)
+            except Exception:
+                logger.exception('failed to claim a job')
+                job = None
+
+            if job:
+                await self.run_job(job)
+                continue
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        for _ in range(self.concurrency):
+            self.tasks.append(asyncio.create_task(self.run()))
+
+    async def stop(self) -> None:
+        # NOTE interrupted jobs stay `running` until their lock expires, then
+        # another worker picks them up
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
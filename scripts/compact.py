@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import argparse
+from datetime import datetime, timedelta, timezone
+import os
+
+if __name__ == '__main__' and __package__ is None:
+    import sys
+    # __file__ should be defined in this case
+    PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PARENT_DIR)
+
+from dotenv import load_dotenv
+from françoise.db import open_db
+
+load_dotenv()
+
+parser = argparse.ArgumentParser(
+        description="Moves old messages that are folded into a summary into compressed per-conversation archives.")
+
+parser.add_argument("-d", "--days", type=float, default=30, help="archive messages older than `days`")
+parser.add_argument("-l", "--level", type=int, default=6, help="zlib compression level")
+parser.add_argument("--vacuum", action='store_true', help="shrink the database file afterwards")
+parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
+
+args = parser.parse_args()
+
+before = (datetime.now(timezone.utc) - timedelta(days=args.days)).isoformat()
+
+with open_db(args.database) as db:
+    conversations = db.get_archivable_conversations(before)
+
+    # NOTE one transaction per conversation keeps the write lock short, so
+    # this can run next to the app
+    count = 0
+    for conversation_id, message_id in conversations:
+        count += db.archive_messages(conversation_id, message_id, before, args.level)
+
+    print('archived `%d` messages from `%d` conversations' % (count, len(conversations)))
+
+    if args.vacuum:
+        # NOTE deleted rows leave free pages behind that only VACUUM returns
+        db.connection.execute('VACUUM')
+        print('vacuumed `%s`' % (args.database,))
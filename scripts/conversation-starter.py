@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
 import os
 
 if __name__ == '__main__' and __package__ is None:
@@ -10,43 +12,185 @@ if __name__ == '__main__' and __package__ is None:
     sys.path.append(PARENT_DIR)
 
 from dotenv import load_dotenv
-from françoise.chat import chat, get_prompt_message_from_conversation,  message_tuple_to_dict
-from françoise.db import open_db
+from françoise.chat import ChatClient, get_prompt_message_from_conversation,  message_tuple_to_dict
+from françoise.db import ConnectionPool
 from françoise.mail import send_mail
+from françoise.ratelimit import TokenBucket
+from françoise.router import Router, parse_backend_urls
 
 load_dotenv()
 
 parser = argparse.ArgumentParser(
         description="Starts a new, or bumps a dormant, conversation.")
 
-parser.add_argument("-id", "--id", type=int, required=True)
-parser.add_argument("-t", "--type", type=str, default='welcome')
+parser.add_argument("-id", "--id", type=str, help="conversation ids and ranges, as in `1-100,205`")
+parser.add_argument("-f", "--file", type=str, help="a file with one conversation id per line")
+parser.add_argument("-q", "--query", type=str, help="a query selecting conversation ids")
+parser.add_argument("-t", "--type", type=str, default='welcome', choices=['welcome', 'bump'],
+                    help="`bump` enqueues bumps for the app's workers, for the dormant conversations if no ids are given")
+parser.add_argument("--days", type=float, default=7.0, help="days without a message for a conversation to be dormant")
+parser.add_argument("--max-bumps", type=int, default=2, help="bumps to send at most until the user answers")
+parser.add_argument("--llm-concurrency", type=int, default=8)
+parser.add_argument("--mail-rate", type=float, default=5.0, help="emails per second")
+parser.add_argument("--batch-size", type=int, default=100)
 parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
 
 LLM_API_CHAT_URL = os.environ.get('LLM_API_CHAT_URL', 'http://localhost:11434/api/chat')
+LLM_API_URLS = parse_backend_urls(os.environ.get('LLM_API_URLS', LLM_API_CHAT_URL))
 MAILGUN_API_KEY = os.environ.get('MAILGUN_API_KEY')
 MAILGUN_API_SENDER = os.environ.get('MAILGUN_API_SENDER')
 MAILGUN_API_URL = os.environ.get('MAILGUN_API_URL')
 
 args = parser.parse_args()
 
-with open_db(args.database) as db:
-    conversation = db.conversation_to_dict(db.get_conversation(args.id))
+if not (args.id or args.file or args.query or args.type == 'bump'):
+    parser.error('one of --id, --file or --query is required')
 
-    data = {
-        "from": "%s.%d <%s>" % (conversation.get('agent_name'), args.id, MAILGUN_API_SENDER),
-        "to": conversation.get('user_email')
+
+def parse_ids(s: str) -> list[int]:
+    ids = []
+    for part in filter(None, s.replace(' ', '').split(',')):
+        start, _, end = part.partition('-')
+        ids.extend(range(int(start), int(end or start) + 1))
+    return ids
+
+
+def get_ids(pool: ConnectionPool) -> list[int]:
+    ids = []
+    if args.id:
+        ids.extend(parse_ids(args.id))
+    if args.file:
+        with open(args.file, 'r', encoding='utf8') as file:
+            ids.extend(int(line) for line in file if line.strip())
+    if args.query:
+        with pool.read() as db:
+            ids.extend(row[0] for row in db.connection.execute(args.query))
+    # NOTE dedupe while preserving order
+    return list(dict.fromkeys(ids))
+
+
+def load(pool: ConnectionPool, ids: list[int]) -> tuple[list[dict[str, str]], dict[int, tuple]]:
+    with pool.read() as db:
+        conversations = list(map(db.conversation_to_dict, db.get_conversations(ids)))
+        last_messages = db.get_last_messages(ids)
+    return (conversations, last_messages)
+
+
+def save(pool: ConnectionPool, messages: list[tuple[int, str, dict]]) -> list[int]:
+    with pool.write() as db:
+        return [row[0] for row in db.add_assistant_messages(messages)]
+
+
+def mark_sent(pool: ConnectionPool, ids: list[int]) -> None:
+    with pool.write() as db:
+        db.mark_messages_sent(ids)
+
+
+def enqueue_bumps(pool: ConnectionPool, ids: list[int]) -> list[int]:
+    # NOTE jobs skip conversations with a message since `before`, so given
+    # ids are only bumped if they are dormant too
+    before = (datetime.now(timezone.utc) - timedelta(days=args.days)).isoformat()
+    with pool.write() as db:
+        if not ids:
+            ids = db.get_dormant_conversations(before, args.max_bumps, -1)
+        return db.enqueue_bumps(ids, before)
+
+
+def create_welcome_mail(conversation: dict[str, str], text: str) -> dict[str, str]:
+    return {
+        "from": "%s.%d <%s>" % (conversation.get('agent_name'), conversation.get('id'), MAILGUN_API_SENDER),
+        "to": conversation.get('user_email'),
+        "subject": '{user_name}, meet {agent_name} ({agent_language} {agent_proficiency})'.format(**conversation),
+        "text": text
     }
 
-    if args.type == 'welcome':
+
+async def main():
+    pool = ConnectionPool(args.database)
+    if args.type == 'bump':
+        try:
+            ids = await asyncio.to_thread(get_ids, pool)
+            print('enqueued bumps for `%d` conversations' % (len(await asyncio.to_thread(enqueue_bumps, pool, ids)),))
+        finally:
+            pool.close()
+        return
+
+    router = Router(LLM_API_URLS, ChatClient)
+    llm_semaphore = asyncio.Semaphore(args.llm_concurrency)
+    # NOTE bounds the batches held in memory, while the next batch generates
+    # as the previous one is mailed
+    batch_semaphore = asyncio.Semaphore(2)
+    mail_bucket = TokenBucket(args.mail_rate)
+    counts = {'generated': 0, 'sent': 0, 'skipped': 0, 'failed': 0}
+
+    async def generate(conversation: dict[str, str]) -> dict:
         prompt = get_prompt_message_from_conversation(conversation)
+        async with llm_semaphore:
+            return await router.complete([message_tuple_to_dict(prompt)], model=conversation.get('model'))
+
+    async def send(message_id: int, data: dict[str, str]) -> None:
+        await mail_bucket.acquire()
+        await asyncio.to_thread(send_mail, MAILGUN_API_URL, api_key=MAILGUN_API_KEY, data=data)
+        # NOTE marked as soon as it is out, so a crash later in the batch
+        # does not have the next run send it again
+        await asyncio.to_thread(mark_sent, pool, [message_id])
+
+    async def start_batch(ids: list[int]) -> None:
+        conversations, last_messages = await asyncio.to_thread(load, pool, ids)
+
+        pending = []
+        unsent = []
+        for conversation in conversations:
+            last_message = last_messages.get(conversation.get('id'))
+            if not last_message:
+                pending.append(conversation)
+            elif last_message[1] == 'assistant' and not last_message[3]:
+                # NOTE generated and stored by a previous run that did not send it
+                unsent.append((last_message[0], create_welcome_mail(conversation, last_message[2])))
+            else:
+                counts['skipped'] += 1
+
+        counts['failed'] += len(ids) - len(conversations)
+
+        responses = await asyncio.gather(*map(generate, pending), return_exceptions=True)
+        generated = []
+        for conversation, response in zip(pending, responses):
+            if isinstance(response, Exception):
+                print('failed to generate for conversation `%d`: %s' % (conversation.get('id'), response))
+                counts['failed'] += 1
+            else:
+                generated.append((conversation, response))
+
+        # NOTE messages are stored before they are sent, so a crash never
+        # leaves a sent email without its message
+        message_ids = await asyncio.to_thread(
+                save,
+                pool,
+                [(conversation.get('id'), response['message']['content'], response) for conversation, response in generated])
+        counts['generated'] += len(message_ids)
+        for message_id, (conversation, response) in zip(message_ids, generated):
+            unsent.append((message_id, create_welcome_mail(conversation, response['message']['content'])))
+
+        results = await asyncio.gather(*(send(*mail) for mail in unsent), return_exceptions=True)
+        for (message_id, data), result in zip(unsent, results):
+            if isinstance(result, Exception):
+                print('failed to send message `%d` to `%s`: %s' % (message_id, data.get('to'), result))
+                counts['failed'] += 1
+            else:
+                counts['sent'] += 1
 
-        response = chat([message_tuple_to_dict(prompt)],
-                        model=conversation.get('model'),
-                        url=LLM_API_CHAT_URL)
-        db.add_assistant_message(args.id, response)
+    async def run_batch(ids: list[int]) -> None:
+        async with batch_semaphore:
+            await start_batch(ids)
+            print(', '.join('%s `%d`' % item for item in counts.items()))
 
-        data['subject'] = '{user_name}, meet {agent_name} ({agent_language} {agent_proficiency})'.format(**conversation)
-        data['text'] = response
+    await router.start()
+    try:
+        ids = await asyncio.to_thread(get_ids, pool)
+        batches = [ids[i:i + args.batch_size] for i in range(0, len(ids), args.batch_size)]
+        await asyncio.gather(*map(run_batch, batches))
+    finally:
+        await router.close()
+        pool.close()
 
-send_mail(MAILGUN_API_URL, api_key=MAILGUN_API_KEY, data=data)
+asyncio.run(main())
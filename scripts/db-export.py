@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import json
+import os
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    # __file__ should be defined in this case
+    PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PARENT_DIR)
+
+from dotenv import load_dotenv
+from françoise.db import open_db
+
+load_dotenv()
+
+# NOTE compacted messages only exist in `archives`, and a summary stands in
+# for them in prompts, so both go with the messages
+TABLES = ['users', 'agents', 'conversations', 'messages', 'summaries', 'archives']
+
+parser = argparse.ArgumentParser(
+        description="Exports tables as JSONL, one `{\"table\": ..., \"row\": ...}` object per line.")
+
+parser.add_argument("-o", "--output", type=str, default='-', help="file to write to, `-` for stdout")
+parser.add_argument("-t", "--tables", type=str, nargs='+', default=TABLES, choices=TABLES)
+parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
+
+args = parser.parse_args()
+
+
+def encode(value):
+    # NOTE bcrypt salts and hashes, and archives, are stored as bytes
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    raise TypeError('cannot serialize `%s`' % (type(value).__name__,))
+
+
+output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+counts = {}
+try:
+    with open_db(args.database) as db:
+        # NOTE parents first, so an import never refers to rows it has not seen
+        for table_name in (table_name for table_name in TABLES if table_name in args.tables):
+            counts[table_name] = 0
+            for row in db.iter_rows(table_name):
+                output.write(json.dumps({'table': table_name, 'row': row}, ensure_ascii=False, default=encode))
+                output.write('\n')
+                counts[table_name] += 1
+finally:
+    if output is not sys.stdout:
+        output.close()
+
+print(', '.join('%s `%d`' % item for item in counts.items()), file=sys.stderr)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import itertools
+import json
+import os
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    # __file__ should be defined in this case
+    PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PARENT_DIR)
+
+from dotenv import load_dotenv
+from françoise.db import open_db
+
+load_dotenv()
+
+parser = argparse.ArgumentParser(
+        description="Imports JSONL written by `scripts/db-export.py`, in batched transactions.")
+
+parser.add_argument("-i", "--input", type=str, default='-', help="file to read from, `-` for stdin")
+parser.add_argument("-b", "--batch-size", type=int, default=5000)
+parser.add_argument("--ignore-existing", action='store_true', help="skip rows whose `id` or unique columns exist")
+parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
+
+args = parser.parse_args()
+
+
+def decode(value: dict):
+    if set(value.keys()) == {'$bytes'}:
+        return base64.b64decode(value['$bytes'])
+    return value
+
+
+def read_lines(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line, object_hook=decode)
+
+
+input = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+counts = {}
+try:
+    with open_db(args.database) as db:
+        db.migrate()
+        # NOTE consecutive lines of the same table and columns are inserted
+        # together, while the file is read a line at a time
+        for (table_name, columns), lines in itertools.groupby(
+                read_lines(input),
+                key=lambda line: (line['table'], tuple(line['row'].keys()))):
+            counts[table_name] = counts.get(table_name, 0) + db.bulk_insert(
+                    table_name,
+                    (line['row'] for line in lines),
+                    batch_size=args.batch_size,
+                    on_conflict='ignore' if args.ignore_existing else None)
+        # NOTE exports from before activity was tracked leave it unset
+        if 'messages' in counts:
+            db.update_last_message_at()
+finally:
+    if input is not sys.stdin:
+        input.close()
+
+print(', '.join('%s `%d`' % item for item in counts.items()))
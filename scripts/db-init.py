@@ -15,11 +15,13 @@ from françoise.db import open_db
 load_dotenv()
 
 parser = argparse.ArgumentParser(
-        description="Initializes a database with the necessary schema.")
+        description="Initializes a database with the necessary schema, or migrates an existing one.")
 
 parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
 
 args = parser.parse_args()
 
 with open_db(args.database) as db:
-    db.create_schema()
+    previous_version = db.get_schema_version()
+    version = db.migrate()
+    print('migrated schema from version `%d` to `%d`' % (previous_version, version))
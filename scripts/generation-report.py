@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import argparse
+from datetime import datetime, timedelta, timezone
+import os
+
+if __name__ == '__main__' and __package__ is None:
+    import sys
+    # __file__ should be defined in this case
+    PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PARENT_DIR)
+
+from dotenv import load_dotenv
+from françoise.db import open_db
+
+load_dotenv()
+
+parser = argparse.ArgumentParser(
+        description="Reports token throughput per model, prompt growth per conversation and cold model loads.")
+
+parser.add_argument("-d", "--days", type=float, default=7, help="only report generations from the last `days`")
+parser.add_argument("-n", "--limit", type=int, default=20, help="number of conversations to report prompt growth for")
+parser.add_argument("--cold-load-threshold", type=float, default=1.0,
+                    help="seconds of model loading above which a generation counts as a cold load")
+parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
+
+args = parser.parse_args()
+
+
+def format_number(value, format: str = '%.1f') -> str:
+    return '-' if value is None else format % (value,)
+
+
+since = (datetime.now(timezone.utc) - timedelta(days=args.days)).isoformat()
+
+with open_db(args.database) as db:
+    throughput = db.get_model_throughput(since)
+    growth = db.get_prompt_growth(since, args.limit)
+    cold_loads = db.get_cold_loads(since, args.cold_load_threshold)
+
+print('throughput per model over the last %g days' % (args.days,))
+print('%-24s %8s %10s %10s %12s %12s %10s %10s' % (
+    'model', 'replies', 'prompt', 'response', 'prompt tok/s', 'tok/s', 'ttft s', 'total s'))
+for model, count, prompt_tokens, tokens, prompt_rate, rate, ttft, total in throughput:
+    print('%-24s %8d %10s %10s %12s %12s %10s %10s' % (
+        model,
+        count,
+        format_number(prompt_tokens, '%.0f'),
+        format_number(tokens, '%.0f'),
+        format_number(prompt_rate),
+        format_number(rate),
+        format_number(ttft, '%.3f'),
+        format_number(total, '%.3f')))
+
+print()
+print('prompt growth per conversation')
+print('%-16s %8s %10s %10s %10s' % ('conversation', 'replies', 'first', 'latest', 'max'))
+for conversation_id, count, first, latest, maximum in growth:
+    print('%-16d %8d %10s %10s %10s' % (
+        conversation_id,
+        count,
+        format_number(first, '%d'),
+        format_number(latest, '%d'),
+        format_number(maximum, '%d')))
+
+print()
+print('cold loads over %gs per model' % (args.cold_load_threshold,))
+print('%-24s %8s %10s %10s %12s' % ('model', 'replies', 'cold', 'rate', 'avg load s'))
+for model, count, cold, load_seconds in cold_loads:
+    print('%-24s %8d %10d %9.1f%% %12s' % (
+        model,
+        count,
+        cold or 0,
+        100 * (cold or 0) / count,
+        format_number(load_seconds, '%.3f')))
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import itertools
+import json
 import os
+import sys
 
-if __name__ == '__main__' and __package__ is None:
-    import sys
+# NOTE `__mp_main__` is this script re-imported by the hashing processes
+if __name__ in ('__main__', '__mp_main__') and __package__ is None:
     # __file__ should be defined in this case
     PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     sys.path.append(PARENT_DIR)
@@ -16,35 +21,151 @@ from françoise.db import open_db
 load_dotenv()
 
 parser = argparse.ArgumentParser(
-        description="Onboards a user with an agent and conversation.")
+        description="Onboards a user with an agent and conversation, or every user in a CSV or JSONL file.")
 
-parser.add_argument("-n", "--name", type=str, required=True)
-parser.add_argument("-email", "--email", type=str, required=True)
-parser.add_argument("-pw", "--password", type=str, required=True)
-parser.add_argument("-a", "--agent", type=int, required=True)
+parser.add_argument("-n", "--name", type=str)
+parser.add_argument("-email", "--email", type=str)
+parser.add_argument("-pw", "--password", type=str)
+parser.add_argument("-a", "--agent", type=int)
 parser.add_argument("-model", "--model", type=str, default='gemma3')
-parser.add_argument("-prof", "--proficiency", type=str, required=True)
+parser.add_argument("-prof", "--proficiency", type=str)
+parser.add_argument("-w", "--weight", type=float, default=1.0, help="share of generations relative to other users")
+parser.add_argument("-f", "--file", type=str,
+                    help="a CSV or JSONL file with `name`, `email`, `password`, `agent`, `proficiency` and optionally "
+                         "`model` and `weight` per row, which default to --agent, --model and so on")
+parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes hashing passwords")
+parser.add_argument("--batch-size", type=int, default=500)
 parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
 
-args = parser.parse_args()
 
-salt = bcrypt.gensalt()
-password = args.password.encode('utf-8')
-hashed_password = bcrypt.hashpw(password, salt)
+def hash_password(password: str) -> tuple[bytes, bytes]:
+    salt = bcrypt.gensalt()
+    return (salt, bcrypt.hashpw(password.encode('utf-8'), salt))
 
-with open_db(args.database) as db:
-    user = db.create_user(
-            name=args.name,
-            email=args.email,
-            salt=salt,
-            password=hashed_password)
 
-    print('create user with id `%d`' % (user[0],))
+def read_rows(path: str):
+    # NOTE yields the line each row starts on with the row, or with the error
+    # that kept it from being read, so one bad line is reported alone
+    with open(path, newline='', encoding='utf-8') as file:
+        if path.endswith('.jsonl'):
+            for line, text in enumerate(file, start=1):
+                if not text.strip():
+                    continue
+                try:
+                    yield (line, json.loads(text))
+                except ValueError as e:
+                    yield (line, e)
+        else:
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield (reader.line_num, row)
 
-    conversation = db.create_conversation(
-            user_id=user[0],
-            agent_id=int(args.agent),
-            model=args.model,
-            proficiency=args.proficiency)
 
-    print('created conversation with id `%d` for user `%d` and agent `%d`' % conversation[0:3])
+def row_to_user(row, args) -> dict:
+    if isinstance(row, Exception):
+        raise row
+    # NOTE a JSONL line can hold any JSON value, not only an object
+    if not isinstance(row, dict):
+        raise Exception('row is not an object')
+    user = {
+        'name': row.get('name'),
+        'email': row.get('email'),
+        'password': row.get('password'),
+        'agent_id': int(row.get('agent') or args.agent or 0),
+        'proficiency': row.get('proficiency') or args.proficiency,
+        'model': row.get('model') or args.model,
+        'weight': float(row.get('weight') or args.weight)
+    }
+    missing = [key for key in ('name', 'email', 'password', 'agent_id', 'proficiency') if not user.get(key)]
+    if missing:
+        raise Exception('missing %s' % (', '.join(missing),))
+    # NOTE JSONL can carry a number where a password is expected
+    if not isinstance(user['password'], str):
+        raise Exception('password is not a string')
+    return user
+
+
+def onboard_one(args) -> None:
+    salt, hashed_password = hash_password(args.password)
+
+    with open_db(args.database) as db:
+        user = db.create_user(
+                name=args.name,
+                email=args.email,
+                salt=salt,
+                password=hashed_password,
+                weight=args.weight)
+
+        print('create user with id `%d`' % (user[0],))
+
+        conversation = db.create_conversation(
+                user_id=user[0],
+                agent_id=int(args.agent),
+                model=args.model,
+                proficiency=args.proficiency)
+
+        print('created conversation with id `%d` for user `%d` and agent `%d`' % conversation[0:3])
+
+
+def onboard_file(args) -> None:
+    counts = {'onboarded': 0, 'failed': 0}
+
+    def fail(line: int, email, error) -> None:
+        print('failed to onboard line `%d` (`%s`): %s' % (line, email, error))
+        counts['failed'] += 1
+
+    # NOTE the file is read a batch at a time, the batch's passwords are hashed
+    # on every core, then its users are inserted in one transaction
+    rows = read_rows(args.file)
+    with ProcessPoolExecutor(args.workers) as executor, open_db(args.database) as db:
+        while True:
+            batch = list(itertools.islice(rows, args.batch_size))
+            if not batch:
+                break
+
+            users = []
+            seen = set()
+            for line, row in batch:
+                try:
+                    user = row_to_user(row, args)
+                except Exception as e:
+                    fail(line, row.get('email') if isinstance(row, dict) else None, e)
+                    continue
+                if user['email'] in seen:
+                    fail(line, user['email'], 'duplicate email in file')
+                    continue
+                seen.add(user['email'])
+                users.append((line, user))
+
+            # NOTE a row that fails to hash is reported alone, the rest go on
+            futures = [executor.submit(hash_password, user['password']) for line, user in users]
+            hashed = []
+            for (line, user), future in zip(users, futures):
+                try:
+                    salt, hashed_password = future.result()
+                except Exception as e:
+                    fail(line, user['email'], e)
+                    continue
+                user.update(salt=salt, password=hashed_password)
+                hashed.append((line, user))
+            users = hashed
+
+            results = db.onboard_users([user for line, user in users])
+            for (line, user), result in zip(users, results):
+                if isinstance(result, Exception):
+                    fail(line, user['email'], result)
+                else:
+                    counts['onboarded'] += 1
+
+            print(', '.join('%s `%d`' % item for item in counts.items()))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.file:
+        onboard_file(args)
+    elif all((args.name, args.email, args.password, args.agent, args.proficiency)):
+        onboard_one(args)
+    else:
+        parser.error('either --file, or --name, --email, --password, --agent and --proficiency are required')
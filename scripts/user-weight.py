@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+if __name__ == '__main__' and __package__ is None:
+    import sys
+    # __file__ should be defined in this case
+    PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PARENT_DIR)
+
+from dotenv import load_dotenv
+from françoise.db import open_db
+
+load_dotenv()
+
+parser = argparse.ArgumentParser(
+        description="Sets a user's share of generations relative to other users.")
+
+parser.add_argument("-id", "--id", type=int, required=True)
+parser.add_argument("-w", "--weight", type=float, required=True)
+parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
+
+args = parser.parse_args()
+
+if args.weight <= 0:
+    parser.error('weight must be positive')
+
+with open_db(args.database) as db:
+    if not db.set_user_weight(args.id, args.weight):
+        parser.error('user with id `%d` does not exist' % (args.id,))
+    print('set weight of user `%d` to `%g`' % (args.id, args.weight))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import os
+import signal
+
+if __name__ == '__main__' and __package__ is None:
+    import sys
+    # __file__ should be defined in this case
+    PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(PARENT_DIR)
+
+from dotenv import load_dotenv
+from françoise.app import App
+from françoise.db import open_db
+
+load_dotenv()
+
+parser = argparse.ArgumentParser(
+        description="Drains the inbound job queue without serving HTTP.")
+
+parser.add_argument("-c", "--concurrency", type=int, default=int(os.environ.get('WORKER_CONCURRENCY', '2')))
+parser.add_argument("--requeue-dead", action='store_true')
+parser.add_argument("-db", "--database", type=str, default=os.environ.get('DATABASE_URL', 'data.db'))
+
+args = parser.parse_args()
+
+if args.requeue_dead:
+    with open_db(args.database) as db:
+        print('requeued `%d` dead jobs' % (db.requeue_dead_jobs(),))
+
+
+async def main():
+    app = App(DATABASE_URL=args.database, WORKER_CONCURRENCY=str(args.concurrency))
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+
+    # NOTE the app lifespan owns the worker pool and the LLM client
+    async with app.router.lifespan_context(app):
+        await stopped.wait()
+
+asyncio.run(main())
@@ -0,0 +1,44 @@
+import asyncio
+import unittest
+
+from françoise.admission import AdmissionController, RateLimiter
+
+
+class TestAdmission(unittest.TestCase):
+    def test_rate_limiter(self):
+        limiter = RateLimiter(1, burst=2, max_keys=2)
+        self.assertIsNone(limiter.try_acquire('a'))
+        self.assertIsNone(limiter.try_acquire('a'))
+        self.assertGreater(limiter.try_acquire('a'), 0)
+        limiter.try_acquire('b')
+        limiter.try_acquire('c')
+        self.assertEqual(list(limiter.buckets), ['b', 'c'])
+
+    def test_max_in_flight(self):
+        admission = AdmissionController(lambda: 0, max_in_flight=1, retry_after=30)
+        self.assertIsNone(asyncio.run(admission.admit('bob@x.com', 1)))
+        self.assertEqual(asyncio.run(admission.admit('bob@x.com', 1)), 30)
+        admission.release()
+        self.assertIsNone(asyncio.run(admission.admit('bob@x.com', 1)))
+
+    def test_max_queued(self):
+        queued = [10]
+        admission = AdmissionController(lambda: queued[0], max_queued=10, queue_check_interval=0)
+        self.assertEqual(asyncio.run(admission.admit('bob@x.com', 1)), 60)
+        queued[0] = 9
+        self.assertIsNone(asyncio.run(admission.admit('bob@x.com', 1)))
+
+    def test_sender_rate(self):
+        admission = AdmissionController(lambda: 0, sender_rate=0.1, sender_burst=1, conversation_rate=0)
+        self.assertIsNone(asyncio.run(admission.admit('bob@x.com', 1)))
+        self.assertEqual(asyncio.run(admission.admit('BOB@x.com', 2)), 10)
+        self.assertIsNone(asyncio.run(admission.admit('alice@x.com', 1)))
+
+    def test_conversation_rate(self):
+        admission = AdmissionController(lambda: 0, conversation_rate=0.5, conversation_burst=1)
+        self.assertIsNone(asyncio.run(admission.admit('bob@x.com', 1)))
+        self.assertEqual(asyncio.run(admission.admit('alice@x.com', 1)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
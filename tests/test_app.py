@@ -0,0 +1,255 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+import httpx
+
+from françoise.app import App
+from françoise.db import open_db
+
+AsyncClient = httpx.AsyncClient
+
+
+class TestApp(unittest.TestCase):
+    def setUp(self):
+        fd, self.url = tempfile.mkstemp()
+        os.close(fd)
+        with open_db(self.url) as db:
+            db.migrate()
+            db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+            db.create_user('Bob', 'bob@x.com', 'salt', 'password')
+            db.create_conversation(1, 1, 'A1', 'gemma3')
+
+        self.generated = []
+        self.sent = []
+        self.on_generate = None
+        # NOTE every client the App builds, for Ollama and Mailgun, is served
+        # by `handle` instead of the network
+        patch = mock.patch('httpx.AsyncClient', self.create_client)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.url + suffix):
+                os.remove(self.url + suffix)
+
+    def create_client(self, *args, **kwargs):
+        return AsyncClient(*args, transport=httpx.MockTransport(self.handle), **kwargs)
+
+    async def handle(self, request):
+        if request.url.host == 'mailgun':
+            self.sent.append(request.content.decode())
+            return httpx.Response(200, json={'id': '<%d@mailgun>' % (len(self.sent),)})
+        if request.url.path == '/api/tags':
+            return httpx.Response(200, json={'models': [{'name': 'gemma3:latest'}]})
+        if request.url.path == '/api/ps':
+            return httpx.Response(200, json={'models': [{'name': 'gemma3:latest'}]})
+
+        data = json.loads(request.content)
+        # NOTE loading a model sends no messages, only replies are recorded
+        if data.get('messages'):
+            self.generated.append(data.get('messages'))
+            if self.on_generate:
+                self.on_generate()
+            await asyncio.sleep(0.05)
+        return httpx.Response(200, json={
+            'message': {'role': 'assistant', 'content': 'Bonjour'},
+            'done': True,
+            'prompt_eval_count': 10,
+            'eval_count': 2})
+
+    def create_app(self, **kwargs):
+        return App(
+                DATABASE_URL=self.url,
+                LLM_API_URLS='http://ollama:11434',
+                MAILGUN_API_URL='http://mailgun/messages',
+                MAILGUN_API_KEY='key',
+                MAILGUN_API_SENDER='francoise@x.com',
+                WORKER_POLL_INTERVAL='0.05',
+                **kwargs)
+
+    def post(self, client, message_id, message='Salut', sender='bob@x.com'):
+        headers = [['To', '"Françoise.1" <francoise@x.com>'], ['Message-Id', message_id]]
+        return client.post('/mailgun', data={
+            'message-headers': json.dumps(headers, ensure_ascii=False, separators=(',', ':')),
+            'body-plain': message,
+            'sender': sender,
+            'subject': 'Bonjour'})
+
+    def count_rows(self, table_name):
+        with open_db(self.url) as db:
+            return len(list(db.iter_rows(table_name)))
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('timed out waiting')
+            time.sleep(0.05)
+
+    def test_backlog_does_not_starve_other_users(self):
+        with open_db(self.url) as db:
+            for agent_id in range(2, 7):
+                db.create_agent('Agent %d' % (agent_id,), 'French', 'B1', 'You are {agent_name}.')
+                db.create_conversation(1, agent_id, 'A1', 'gemma3')
+            db.create_user('Alice', 'alice@x.com', 'salt', 'password')
+            db.create_conversation(2, 1, 'A1', 'gemma3')
+            # NOTE Bob's backlog of six replies is enqueued before Alice's one
+            for conversation_id in range(1, 8):
+                conversation = db.get_conversation_dict(conversation_id)
+                db.add_user_message(conversation_id, 'Salut de %s' % (conversation.get('user_name'),))
+                db.enqueue_job(
+                        'reply',
+                        {'conversation_id': conversation_id, 'sender': conversation.get('user_email')},
+                        conversation_id=conversation_id)
+
+        with TestClient(self.create_app()):
+            self.wait_for(lambda: len(self.sent) == 7)
+
+        users = ['Alice' if 'Salut de Alice' in json.dumps(messages) else 'Bob' for messages in self.generated]
+        # NOTE first in first out, Alice would wait for all six of Bob's
+        self.assertIn('Alice', users[:2])
+
+    def test_duplicate_delivery(self):
+        with TestClient(self.create_app(WORKER_CONCURRENCY='0')) as client:
+            self.assertEqual(self.post(client, '<1@x>').status_code, 200)
+            # NOTE Mailgun retrying a delivery that was stored is acknowledged
+            self.assertEqual(self.post(client, '<1@x>').status_code, 200)
+
+        self.assertEqual(self.count_rows('messages'), 1)
+        self.assertEqual(self.count_rows('jobs'), 1)
+
+    def test_duplicate_delivery_race(self):
+        # NOTE as if another process stored the delivery after the lookup
+        with mock.patch('françoise.db.Database.has_message_id', return_value=False):
+            with TestClient(self.create_app(WORKER_CONCURRENCY='0')) as client:
+                self.assertEqual(self.post(client, '<1@x>').status_code, 200)
+                self.assertEqual(self.post(client, '<1@x>').status_code, 200)
+
+        self.assertEqual(self.count_rows('messages'), 1)
+        self.assertEqual(self.count_rows('jobs'), 1)
+
+    def test_integrity_error(self):
+        error = sqlite3.IntegrityError('NOT NULL constraint failed: messages.content')
+        with mock.patch('françoise.db.Database.add_user_message', side_effect=error):
+            with TestClient(self.create_app(WORKER_CONCURRENCY='0'), raise_server_exceptions=False) as client:
+                # NOTE not mistaken for a duplicate, so Mailgun retries it
+                self.assertEqual(self.post(client, '<1@x>').status_code, 500)
+
+        self.assertEqual(self.count_rows('jobs'), 0)
+
+    def test_shed(self):
+        with open_db(self.url) as db:
+            db.enqueue_job('reply', {'conversation_id': 1}, conversation_id=1)
+
+        app = self.create_app(WORKER_CONCURRENCY='0', ADMISSION_MAX_QUEUED='1', ADMISSION_RETRY_AFTER='30')
+        with TestClient(app) as client:
+            response = self.post(client, '<1@x>')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '30')
+        self.assertEqual(self.count_rows('messages'), 0)
+
+    def test_coalesced_burst(self):
+        # NOTE without workers nothing claims the pending job, so the whole
+        # burst lands in it even without a window
+        with TestClient(self.create_app(WORKER_CONCURRENCY='0', REPLY_COALESCE_WINDOW='0')) as client:
+            for i in range(3):
+                self.assertEqual(self.post(client, '<%d@x>' % (i,), message='Salut %d' % (i,)).status_code, 200)
+        self.assertEqual(self.count_rows('jobs'), 1)
+
+        # NOTE drained as `scripts/worker.py` would
+        with TestClient(self.create_app(WORKER_CONCURRENCY='1')):
+            self.wait_for(lambda: self.sent)
+
+        self.assertEqual(len(self.generated), 1)
+        # NOTE the one reply answers every email of the burst
+        prompt = json.dumps(self.generated[0], ensure_ascii=False)
+        self.assertIn('Salut 0', prompt)
+        self.assertIn('Salut 2', prompt)
+        self.assertEqual(len(self.sent), 1)
+        with open_db(self.url) as db:
+            messages = db.get_messages_by_conversation(1)
+        self.assertEqual([role for role, content in messages], ['user', 'user', 'user', 'assistant'])
+
+    def test_reply_stored_during_generation(self):
+        with open_db(self.url) as db:
+            message_id = db.add_user_message(1, 'Salut')[0]
+            db.enqueue_job('reply', {'conversation_id': 1, 'sender': 'bob@x.com'}, conversation_id=1)
+
+        # NOTE as a worker that reclaimed the job after its lock expired would
+        def answer():
+            with open_db(self.url) as db:
+                db.add_assistant_message(1, 'Bonjour', reply_to=message_id)
+        self.on_generate = answer
+
+        with TestClient(self.create_app(WORKER_CONCURRENCY='1')):
+            self.wait_for(lambda: self.generated and not self.count_rows('jobs'))
+
+        with open_db(self.url) as db:
+            messages = db.get_messages_by_conversation(1)
+        self.assertEqual([role for role, content in messages], ['user', 'assistant'])
+        self.assertEqual(self.sent, [])
+
+    def run_bump(self, before, bumps=0):
+        with open_db(self.url) as db:
+            db.add_user_message(1, 'Salut')
+            db.connection.execute(
+                    "UPDATE conversations SET last_message_at = '2020-01-01T00:00:00+00:00', bumps = ?",
+                    (bumps,))
+            db.connection.commit()
+            db.enqueue_bumps([1], before)
+
+        def has_bump():
+            with open_db(self.url) as db:
+                return any(kind == 'bump' for kind, status in db.count_jobs())
+
+        # NOTE without mail workers, the mail job the bump enqueues stays put
+        with TestClient(self.create_app(WORKER_CONCURRENCY='1', MAIL_CONCURRENCY='0', BUMP_MAX_BUMPS='2')):
+            self.wait_for(lambda: not has_bump())
+
+        with open_db(self.url) as db:
+            return (db.get_messages_by_conversation(1), db.get_activity(1), db.count_jobs())
+
+    def test_bump(self):
+        messages, activity, jobs = self.run_bump('2021-01-01T00:00:00+00:00')
+        self.assertEqual(len(self.generated), 1)
+        self.assertEqual(messages, [('user', 'Salut'), ('assistant', 'Bonjour')])
+        self.assertEqual(activity[1], 1)
+        self.assertEqual(jobs, {('mail', 'pending'): 1})
+
+    def test_bump_after_user_wrote(self):
+        # NOTE the user wrote after the conversation was found dormant
+        messages, activity, jobs = self.run_bump('2019-01-01T00:00:00+00:00')
+        self.assertEqual(self.generated, [])
+        self.assertEqual(messages, [('user', 'Salut')])
+        self.assertEqual(jobs, {})
+
+    def test_bump_max_bumps(self):
+        messages, activity, jobs = self.run_bump('2021-01-01T00:00:00+00:00', bumps=2)
+        self.assertEqual(self.generated, [])
+        self.assertEqual(activity[1], 2)
+        self.assertEqual(jobs, {})
+
+    def test_bump_user_wrote_during_generation(self):
+        def write():
+            with open_db(self.url) as db:
+                db.add_user_message(1, 'Me voilà !')
+        self.on_generate = write
+
+        messages, activity, jobs = self.run_bump('2021-01-01T00:00:00+00:00')
+        self.assertEqual(len(self.generated), 1)
+        # NOTE the bump is dropped rather than sent after the user's message
+        self.assertEqual(messages, [('user', 'Salut'), ('user', 'Me voilà !')])
+        self.assertEqual(activity[1], 0)
+        self.assertEqual(jobs, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from françoise.asyncdb import open_async_db
+from françoise.db import open_db
+
+
+class TestAsyncDatabase(unittest.TestCase):
+    def setUp(self):
+        fd, self.url = tempfile.mkstemp()
+        os.close(fd)
+        with open_db(self.url) as db:
+            db.migrate()
+            db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+            db.create_user('Bob', 'bob@x.com', 'salt', 'password')
+            db.create_conversation(1, 1, 'A1', 'gemma3')
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.url + suffix):
+                os.remove(self.url + suffix)
+
+    def run_db(self, fn):
+        async def run():
+            async with open_async_db(self.url, readers=2) as db:
+                return await fn(db)
+        return asyncio.run(run())
+
+    def test_read_and_write(self):
+        async def fn(db):
+            await db.add_user_message(1, 'Bonjour', message_id='<1@x>')
+            await db.add_assistant_message(1, 'Salut', reply_to=1)
+            return await db.get_messages_by_conversation(1)
+
+        messages = self.run_db(fn)
+        self.assertEqual(messages, [('user', 'Bonjour'), ('assistant', 'Salut')])
+
+    def test_batched_writes(self):
+        async def fn(db):
+            return await asyncio.gather(
+                    *(db.add_user_message(1, 'Message %d' % (i,), message_id='<%d@x>' % (i % 10,)) for i in range(20)),
+                    return_exceptions=True)
+
+        results = self.run_db(fn)
+        # NOTE a failed write is rolled back alone, the rest of its batch commits
+        self.assertEqual(sum(isinstance(result, sqlite3.IntegrityError) for result in results), 10)
+        with open_db(self.url) as db:
+            self.assertEqual(len(db.get_messages_by_conversation(1)), 10)
+
+    def test_write_callable(self):
+        async def fn(db):
+            def add_messages(db):
+                with db.transaction():
+                    db.add_user_message(1, 'Bonjour')
+                    db.add_user_message(1, 'Bonjour', message_id='<1@x>')
+                    db.add_user_message(1, 'Bonjour', message_id='<1@x>')
+
+            with self.assertRaises(sqlite3.IntegrityError):
+                await db.write(add_messages)
+            return await db.read(lambda db: db.get_messages_by_conversation(1))
+
+        self.assertEqual(self.run_db(fn), [])
+
+    def test_iter_rows(self):
+        rows = self.run_db(lambda db: db.iter_rows('users'))
+        self.assertEqual([row['email'] for row in rows], ['bob@x.com'])
+
+    def test_unknown_method(self):
+        async def fn(db):
+            with self.assertRaises(AttributeError):
+                db.migrate
+        self.run_db(fn)
+
+
+if __name__ == '__main__':
+    unittest.main()
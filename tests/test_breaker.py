@@ -0,0 +1,45 @@
+import time
+import unittest
+
+from françoise.breaker import CircuitBreaker, CircuitOpen
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_open(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.before()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(CircuitOpen) as context:
+            breaker.before()
+        self.assertGreater(context.exception.delay, 29)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        breaker.failure()
+        breaker.opened_at = time.monotonic() - 30
+        self.assertEqual(breaker.state, 'half-open')
+        # NOTE only one trial call goes through
+        breaker.before()
+        with self.assertRaises(CircuitOpen):
+            breaker.before()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+
+        breaker.opened_at = time.monotonic() - 30
+        breaker.before()
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+
+
+if __name__ == '__main__':
+    unittest.main()
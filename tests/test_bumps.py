@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import os
+import tempfile
+import unittest
+
+from françoise.asyncdb import open_async_db
+from françoise.bumps import BumpScheduler
+from françoise.db import open_db
+
+
+class TestBumpScheduler(unittest.TestCase):
+    def setUp(self):
+        fd, self.url = tempfile.mkstemp()
+        os.close(fd)
+        with open_db(self.url) as db:
+            db.migrate()
+            db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+            for i in range(3):
+                db.create_user('User %d' % i, 'user%d@x.com' % i, 'salt', 'password')
+                db.create_conversation(i + 1, 1, 'A1', 'gemma3')
+                db.add_user_message(i + 1, 'Bonjour')
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.url + suffix):
+                os.remove(self.url + suffix)
+
+    def run_scheduler(self, fn, **kwargs):
+        async def run():
+            async with open_async_db(self.url) as db:
+                notified = []
+                scheduler = BumpScheduler(db, lambda: notified.append(True), hours=[3], **kwargs)
+                return (await fn(scheduler), notified)
+        return asyncio.run(run())
+
+    def test_enqueue(self):
+        later = datetime.now(timezone.utc) + timedelta(days=8)
+
+        async def fn(scheduler):
+            return (await scheduler.enqueue(later), await scheduler.enqueue(later))
+
+        (first, second), notified = self.run_scheduler(fn, dormant_days=7, batch_size=2)
+        self.assertEqual(first, [1, 2])
+        # NOTE the next batch waits for the previous one to be done
+        self.assertEqual(second, [])
+        self.assertEqual(notified, [True])
+
+    def test_enqueue_not_dormant(self):
+        ids, notified = self.run_scheduler(lambda scheduler: scheduler.enqueue(datetime.now(timezone.utc)))
+        self.assertEqual(ids, [])
+
+    def test_enqueue_replies_queued(self):
+        with open_db(self.url) as db:
+            db.enqueue_job('reply', {}, conversation_id=1)
+
+        later = datetime.now(timezone.utc) + timedelta(days=8)
+        ids, notified = self.run_scheduler(lambda scheduler: scheduler.enqueue(later))
+        self.assertEqual(ids, [])
+        ids, notified = self.run_scheduler(lambda scheduler: scheduler.enqueue(later), max_queued=1)
+        self.assertEqual(ids, [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
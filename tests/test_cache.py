@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from françoise.cache import Cache
+from françoise.db import ConnectionPool
+
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        cache = Cache('test', maxsize=2)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        cache.get(1)
+        cache.set(3, 'c')
+        self.assertEqual((cache.get(1), cache.get(2), cache.get(3)), ('a', None, 'c'))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_ttl(self):
+        cache = Cache('test', ttl=0)
+        cache.set(1, 'a')
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_invalidate(self):
+        cache = Cache('test')
+        cache.set(1, {'user_id': 1})
+        cache.set(2, {'user_id': 2})
+        cache.invalidate(lambda value: value['user_id'] == 1)
+        self.assertEqual(list(cache.entries), [2])
+
+
+class TestConversationCache(unittest.TestCase):
+    def setUp(self):
+        fd, self.url = tempfile.mkstemp()
+        os.close(fd)
+        self.cache = Cache('conversations')
+        self.pool = ConnectionPool(self.url, conversation_cache=self.cache)
+        with self.pool.write() as db:
+            db.migrate()
+            db.create_agent('Françoise', 'French', 'B1', 'You write to {user_name}.')
+            db.create_user('Bob', 'bob@example.com', 'salt', 'password')
+            db.create_conversation(1, 1, 'A1', 'gemma3')
+
+    def tearDown(self):
+        self.pool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.url + suffix):
+                os.remove(self.url + suffix)
+
+    def test_get_conversation_dict(self):
+        with self.pool.read() as db:
+            conversation = db.get_conversation_dict(1)
+            self.assertEqual(conversation['system_prompt'], 'You write to Bob.')
+            self.assertIs(db.get_conversation_dict(1), conversation)
+            self.assertIsNone(db.get_conversation_dict(2))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_invalidated_by_writes(self):
+        with self.pool.read() as db:
+            self.assertEqual(db.get_conversation_dict(1)['user_weight'], 1)
+        with self.pool.write() as db:
+            db.set_user_weight(1, 3)
+        with self.pool.read() as db:
+            self.assertEqual(db.get_conversation_dict(1)['user_weight'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import unittest
+
+import httpx
+
+from françoise.chat import ChatClient, create_chat_request
+
+
+def create_client(handler, **kwargs) -> ChatClient:
+    client = ChatClient('http://localhost:11434/api/chat', **kwargs)
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def create_chunks(words, delay=0):
+    async def chunks():
+        for word in words:
+            await asyncio.sleep(delay)
+            yield (json.dumps({'message': {'role': 'assistant', 'content': word}, 'done': False}) + '\n').encode()
+        yield (json.dumps({'message': {'role': 'assistant', 'content': ''}, 'done': True, 'eval_count': len(words)}) + '\n').encode()
+    return chunks()
+
+
+class TestChat(unittest.TestCase):
+    messages = [{'role': 'user', 'content': 'Salut'}]
+
+    def test_create_chat_request(self):
+        url, data = create_chat_request(self.messages, model='gemma3', url='http://x', max_tokens=10)
+        self.assertEqual(data['options'], {'num_predict': 10})
+        self.assertFalse(data['stream'])
+
+    def test_create_chat_request_context(self):
+        url, data = create_chat_request(
+                self.messages, model='gemma3', url='http://x', max_tokens=10, context_tokens=32768)
+        self.assertEqual(data['options'], {'num_predict': 10, 'num_ctx': 32768})
+
+    def test_context_tokens(self):
+        requests = []
+
+        def handler(request):
+            requests.append(json.loads(request.content))
+            return httpx.Response(200, json={'message': {'role': 'assistant', 'content': 'Bonjour'}, 'done': True})
+        budgets = {'gemma3': 32768}
+        client = create_client(handler, max_tokens=10, context_tokens=lambda model: budgets.get(model, 8192))
+        asyncio.run(client.complete(self.messages, model='gemma3'))
+        asyncio.run(client.complete(self.messages, model='llama3.2'))
+        # NOTE a load asks for the same context, or Ollama would load it again
+        asyncio.run(client.load('gemma3'))
+        self.assertEqual([request['options'].get('num_ctx') for request in requests], [32768, 8192, 32768])
+        self.assertEqual(requests[0]['options']['num_predict'], 10)
+
+    def test_chat(self):
+        def handler(request):
+            return httpx.Response(200, json={'message': {'role': 'assistant', 'content': 'Bonjour'}, 'done': True})
+        client = create_client(handler)
+        self.assertEqual(asyncio.run(client.chat(self.messages, model='gemma3')), 'Bonjour')
+
+    def test_stream(self):
+        def handler(request):
+            self.assertTrue(json.loads(request.content)['stream'])
+            return httpx.Response(200, content=create_chunks(['Bon', 'jour']))
+        client = create_client(handler, stream=True)
+        result = asyncio.run(client.complete(self.messages, model='gemma3'))
+        self.assertEqual(result['message']['content'], 'Bonjour')
+        self.assertEqual(result['eval_count'], 2)
+        self.assertIn('time_to_first_token', result)
+
+    def test_stream_max_tokens(self):
+        def handler(request):
+            return httpx.Response(200, content=create_chunks(['a', 'b', 'c', 'd']))
+        client = create_client(handler, stream=True, max_tokens=2)
+        result = asyncio.run(client.complete(self.messages, model='gemma3'))
+        self.assertEqual(result['message']['content'], 'ab')
+        self.assertEqual(result['done_reason'], 'length')
+
+    def test_stream_stall(self):
+        def handler(request):
+            return httpx.Response(200, content=create_chunks(['a', 'b'], delay=0.2))
+        client = create_client(handler, stream=True, stall_timeout=0.05)
+        with self.assertRaisesRegex(Exception, 'stalled'):
+            asyncio.run(client.complete(self.messages, model='gemma3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from françoise.context import ContextManager, estimate_tokens, parse_token_budgets, split_history
+from françoise.db import ConnectionPool, open_db
+
+
+class FakeChat:
+    def __init__(self):
+        self.calls = []
+
+    async def chat(self, messages, **kwargs):
+        self.calls.append(messages)
+        return 'summary %d' % len(self.calls)
+
+
+class TestContext(unittest.TestCase):
+    def setUp(self):
+        fd, self.url = tempfile.mkstemp()
+        os.close(fd)
+        with open_db(self.url) as db:
+            db.create_schema()
+            db.create_agent('Françoise', 'French', 'B1', 'You write to {user_name}.')
+            db.create_user('Bob', 'bob@example.com', 'salt', 'password')
+            db.create_conversation(1, 1, 'A1', 'gemma3')
+            self.conversation = db.conversation_to_dict(db.get_conversation(1))
+        self.pool = ConnectionPool(self.url)
+
+    def tearDown(self):
+        self.pool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.url + suffix):
+                os.remove(self.url + suffix)
+
+    def test_parse_token_budgets(self):
+        self.assertEqual(parse_token_budgets('gemma3=32768, llama3=8192'), {'gemma3': 32768, 'llama3': 8192})
+        self.assertEqual(parse_token_budgets(None), {})
+
+    def test_split_history(self):
+        messages = [(i, 'user', 'x' * 30) for i in range(5)]
+        older, recent = split_history(messages, estimate_tokens('x' * 30) * 2)
+        self.assertEqual(older, messages[:3])
+        self.assertEqual(recent, messages[3:])
+
+    def test_split_history_keeps_latest(self):
+        messages = [(1, 'user', 'x' * 300)]
+        self.assertEqual(split_history(messages, 1), ([], messages))
+
+    def test_get_messages_within_budget(self):
+        with open_db(self.url) as db:
+            db.add_user_message(1, 'Salut')
+        chat = FakeChat()
+        context = ContextManager(self.pool, chat, default_budget=1000, response_tokens=0)
+        messages = asyncio.run(context.get_messages(self.conversation))
+        self.assertEqual(messages[0], {'role': 'system', 'content': 'You write to Bob.'})
+        self.assertEqual(messages[1:], [{'role': 'user', 'content': 'Salut'}])
+        self.assertEqual(chat.calls, [])
+
+    def test_get_messages_folds_older_turns(self):
+        with open_db(self.url) as db:
+            for i in range(10):
+                db.add_user_message(1, 'x' * 300)
+        chat = FakeChat()
+        context = ContextManager(self.pool, chat, default_budget=500, response_tokens=0)
+        messages = asyncio.run(context.get_messages(self.conversation))
+        self.assertEqual(len(chat.calls), 1)
+        self.assertEqual(messages[1]['content'], 'Summary of your earlier letters:\nsummary 1')
+
+        with open_db(self.url) as db:
+            message_id, content = db.get_summary(1)
+            self.assertEqual(content, 'summary 1')
+            self.assertEqual(len(db.get_messages_after(1, message_id)), len(messages) - 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,498 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from françoise.db import SCHEMA_VERSION, ConnectionPool, Database
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(sqlite3.connect(':memory:'))
+        self.db.create_schema()
+
+    def tearDown(self):
+        self.db.connection.close()
+
+    def test_claim_job(self):
+        self.db.enqueue_job('reply', {'conversation_id': 1})
+        job = self.db.job_to_dict(self.db.claim_job(60))
+        self.assertEqual(job['payload'], {'conversation_id': 1})
+        self.assertEqual(job['attempts'], 1)
+        # NOTE the job is locked until its visibility timeout expires
+        self.assertIsNone(self.db.claim_job(60))
+
+    def test_claim_expired_job(self):
+        self.db.enqueue_job('reply', {})
+        self.db.claim_job(-1)
+        job = self.db.job_to_dict(self.db.claim_job(60))
+        self.assertEqual(job['attempts'], 2)
+
+    def test_fail_job(self):
+        self.db.enqueue_job('reply', {})
+        id, *remaining = self.db.claim_job(60)
+        self.db.fail_job(id, 'error', 0, 2)
+        self.db.claim_job(60)
+        self.db.fail_job(id, 'error', 0, 2)
+        self.assertIsNone(self.db.claim_job(60))
+        self.assertEqual(self.db.requeue_dead_jobs(), 1)
+        self.assertIsNotNone(self.db.claim_job(60))
+
+    def test_complete_job(self):
+        self.db.enqueue_job('reply', {})
+        id, *remaining = self.db.claim_job(-1)
+        self.db.complete_job(id)
+        self.assertIsNone(self.db.claim_job(60))
+
+    def test_enqueue_coalesced_job(self):
+        first = self.db.enqueue_coalesced_job('reply', 1, {'subject': 'a'}, 0, 60)
+        second = self.db.enqueue_coalesced_job('reply', 1, {'subject': 'b'}, 0, 60)
+        self.assertEqual(first[0], second[0])
+        job = self.db.job_to_dict(self.db.claim_job(60))
+        self.assertEqual(job['payload']['subject'], 'b')
+        self.assertAlmostEqual(job['payload']['enqueued_at'], json.loads(first[3])['enqueued_at'], places=3)
+
+    def test_enqueue_coalesced_job_window(self):
+        self.db.enqueue_coalesced_job('reply', 1, {}, 60, 120)
+        self.assertIsNone(self.db.claim_job(60))
+        # NOTE the window never extends past the maximum wait
+        self.db.enqueue_coalesced_job('reply', 1, {}, 60, 0)
+        self.assertIsNotNone(self.db.claim_job(60))
+
+    def test_claim_job_kinds(self):
+        self.db.enqueue_job('reply', {}, conversation_id=1)
+        self.db.enqueue_job('mail', {}, conversation_id=1)
+        job = self.db.job_to_dict(self.db.claim_job(60, ['mail']))
+        self.assertEqual(job['kind'], 'mail')
+        self.assertIsNone(self.db.claim_job(60, ['mail']))
+        # NOTE a running mail job does not hold back the conversation's replies
+        job = self.db.job_to_dict(self.db.claim_job(60, ['reply']))
+        self.assertEqual(job['kind'], 'reply')
+
+    def test_defer_job(self):
+        self.db.enqueue_job('mail', {})
+        id, *remaining = self.db.claim_job(60)
+        self.db.defer_job(id, 60)
+        self.assertIsNone(self.db.claim_job(60))
+        self.db.defer_job(id, 0)
+        job = self.db.job_to_dict(self.db.claim_job(60))
+        self.assertEqual(job['attempts'], 1)
+
+    def test_claim_job_per_conversation(self):
+        self.db.enqueue_coalesced_job('reply', 1, {}, 0, 0)
+        self.db.claim_job(60)
+        # NOTE the running job is not pending, so this enqueues another
+        self.db.enqueue_coalesced_job('reply', 1, {}, 0, 0)
+        self.db.enqueue_coalesced_job('reply', 2, {}, 0, 0)
+        job = self.db.job_to_dict(self.db.claim_job(60))
+        self.assertEqual(job['id'], 3)
+        self.assertIsNone(self.db.claim_job(60))
+
+    def test_extend_job(self):
+        self.db.enqueue_job('reply', {})
+        id, *remaining = self.db.claim_job(-1)
+        self.assertTrue(self.db.extend_job(id, 60))
+        self.assertIsNone(self.db.claim_job(60))
+        self.db.complete_job(id)
+        self.assertFalse(self.db.extend_job(id, 60))
+
+    def test_claim_job_after_retry(self):
+        self.db.enqueue_job('mail', {}, conversation_id=1)
+        self.db.enqueue_job('mail', {}, conversation_id=1)
+        self.db.enqueue_job('mail', {}, conversation_id=2)
+        id, *remaining = self.db.claim_job(60)
+        self.db.fail_job(id, 'error', 60, 5)
+        # NOTE the second mail waits for the first to be retried, rather than
+        # overtaking it, while other conversations go on
+        self.assertEqual(self.db.claim_job(60)[0], 3)
+        self.assertIsNone(self.db.claim_job(60))
+        self.db.fail_job(id, 'error', 0, 5)
+        self.assertEqual(self.db.claim_job(60)[0], 1)
+        self.db.complete_job(id)
+        self.assertEqual(self.db.claim_job(60)[0], 2)
+
+    def test_claim_job_fairly(self):
+        self.db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+        self.db.create_agent('Amélie', 'French', 'B1', 'You are {agent_name}.')
+        self.db.create_user('Bob', 'bob@x.com', 'salt', 'password')
+        self.db.create_user('Alice', 'alice@x.com', 'salt', 'password')
+        self.db.create_conversation(1, 1, 'A1', 'gemma3')
+        self.db.create_conversation(1, 2, 'A1', 'gemma3')
+        self.db.create_conversation(2, 1, 'A1', 'gemma3')
+        for conversation_id in (1, 2, 3):
+            self.db.enqueue_job('reply', {}, conversation_id=conversation_id)
+
+        self.assertEqual(self.db.claim_job(60)[0], 1)
+        # NOTE Bob already has a reply running, so Alice goes ahead of his backlog
+        self.assertEqual(self.db.claim_job(60)[0], 3)
+        self.assertEqual(self.db.claim_job(60)[0], 2)
+
+    def test_claim_job_weighted(self):
+        self.db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+        self.db.create_agent('Amélie', 'French', 'B1', 'You are {agent_name}.')
+        self.db.create_user('Bob', 'bob@x.com', 'salt', 'password')
+        self.db.create_user('Alice', 'alice@x.com', 'salt', 'password')
+        self.db.set_user_weight(2, 2.0)
+        self.db.create_conversation(1, 1, 'A1', 'gemma3')
+        self.db.create_conversation(1, 2, 'A1', 'gemma3')
+        self.db.create_conversation(2, 1, 'A1', 'gemma3')
+        self.db.create_conversation(2, 2, 'A1', 'gemma3')
+        for conversation_id in (1, 2, 3, 4):
+            self.db.enqueue_job('reply', {}, conversation_id=conversation_id)
+
+        self.assertEqual(self.db.claim_job(60)[0], 1)
+        self.assertEqual(self.db.claim_job(60)[0], 3)
+        # NOTE Alice's weight lets her run two replies for each of Bob's
+        self.assertEqual(self.db.claim_job(60)[0], 4)
+        self.assertEqual(self.db.claim_job(60)[0], 2)
+
+    def test_transaction(self):
+        with self.assertRaises(ZeroDivisionError):
+            with self.db.transaction():
+                self.db.enqueue_job('reply', {})
+                1 / 0
+        self.assertIsNone(self.db.claim_job(60))
+
+
+class TestMessages(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(sqlite3.connect(':memory:'))
+        self.db.migrate()
+
+    def tearDown(self):
+        self.db.connection.close()
+
+    def test_get_last_messages(self):
+        self.db.add_user_message(1, 'Salut')
+        self.db.add_assistant_message(1, 'Bonjour')
+        id, *remaining = self.db.add_user_message(2, 'Coucou')
+        self.db.mark_messages_sent([id])
+        last_messages = self.db.get_last_messages([1, 2, 3])
+        self.assertEqual(last_messages[1][1:3], ('assistant', 'Bonjour'))
+        self.assertIsNone(last_messages[1][3])
+        self.assertIsNotNone(last_messages[2][3])
+        self.assertNotIn(3, last_messages)
+
+    def test_get_reply_state(self):
+        self.assertEqual(self.db.get_reply_state(1), (None, None))
+        id, *remaining = self.db.add_user_message(1, 'Salut')
+        self.db.add_assistant_message(1, 'Bonjour', reply_to=id)
+        self.db.add_user_message(1, 'Ça va ?')
+        user_message_id, reply = self.db.get_reply_state(1)
+        self.assertEqual(user_message_id, 3)
+        self.assertEqual(reply[:3], (2, 1, 'Bonjour'))
+
+    def test_message_id_is_unique(self):
+        self.db.add_user_message(1, 'Salut', message_id='<abc@x>')
+        self.db.add_user_message(1, 'Ça va ?')
+        self.db.add_user_message(1, 'Coucou')
+        self.assertTrue(self.db.has_message_id('<abc@x>'))
+        self.assertFalse(self.db.has_message_id('<def@x>'))
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.add_user_message(2, 'Salut', message_id='<abc@x>')
+
+    def test_bulk_insert(self):
+        rows = ({'conversation_id': 1, 'role': 'user', 'content': str(i), 'created_at': ''} for i in range(25))
+        self.assertEqual(self.db.bulk_insert('messages', rows, batch_size=10), 25)
+        exported = list(self.db.iter_rows('messages'))
+        self.assertEqual([row['content'] for row in exported[:3]], ['0', '1', '2'])
+        # NOTE rows keep their `id` when they are imported again
+        self.assertEqual(self.db.bulk_insert('messages', exported, on_conflict='ignore'), 0)
+        with self.assertRaises(Exception):
+            self.db.bulk_insert('messages', [{'unknown': 1}])
+
+    def test_add_assistant_messages(self):
+        rows = self.db.add_assistant_messages([(1, 'Bonjour', None), (2, 'Salut', None)])
+        self.assertEqual([row[1] for row in rows], [1, 2])
+
+
+class TestGenerations(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(sqlite3.connect(':memory:'))
+        self.db.migrate()
+
+    def tearDown(self):
+        self.db.connection.close()
+
+    def add_reply(self, conversation_id, model, prompt_eval_count, load_duration=0):
+        return self.db.add_assistant_message(conversation_id, 'Bonjour', generation={
+            'model': model,
+            'backend': 'http://localhost:11434',
+            'prompt_eval_count': prompt_eval_count,
+            'prompt_eval_duration': 500_000_000,
+            'eval_count': 100,
+            'eval_duration': 2_000_000_000,
+            'load_duration': load_duration,
+            'done_reason': 'stop'
+        })
+
+    def test_add_assistant_message_with_generation(self):
+        id, *remaining = self.add_reply(1, 'gemma3', 200)
+        row = self.db.connection.execute('SELECT message_id, model, eval_count FROM generations').fetchone()
+        self.assertEqual(row, (id, 'gemma3', 100))
+
+    def test_get_model_throughput(self):
+        self.add_reply(1, 'gemma3', 200)
+        self.add_reply(2, 'gemma3', 400)
+        model, count, prompt_tokens, tokens, prompt_rate, rate, *remaining = self.db.get_model_throughput('')[0]
+        self.assertEqual((model, count, prompt_tokens, tokens), ('gemma3', 2, 300, 100))
+        self.assertAlmostEqual(prompt_rate, 600)
+        self.assertAlmostEqual(rate, 50)
+
+    def test_get_prompt_growth(self):
+        self.add_reply(1, 'gemma3', 200)
+        self.add_reply(1, 'gemma3', 900)
+        self.add_reply(2, 'gemma3', 300)
+        rows = self.db.get_prompt_growth('')
+        self.assertEqual(rows[0], (1, 2, 200, 900, 900))
+        self.assertEqual(rows[1], (2, 1, 300, 300, 300))
+
+    def test_get_cold_loads(self):
+        self.add_reply(1, 'gemma3', 200, load_duration=8_000_000_000)
+        self.add_reply(2, 'gemma3', 200, load_duration=50_000_000)
+        model, count, cold, load_seconds = self.db.get_cold_loads('', 1.0)[0]
+        self.assertEqual((model, count, cold), ('gemma3', 2, 1))
+        self.assertAlmostEqual(load_seconds, 8)
+
+
+class TestOnboarding(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(sqlite3.connect(':memory:'))
+        self.db.migrate()
+        self.db.create_agent('Françoise', 'French', 'B1', 'You write to {user_name}.')
+
+    def tearDown(self):
+        self.db.connection.close()
+
+    def create_user(self, email, agent_id=1):
+        return {
+            'name': 'Bob',
+            'email': email,
+            'salt': 's',
+            'password': 'p',
+            'agent_id': agent_id,
+            'proficiency': 'A1',
+            'model': 'gemma3'
+        }
+
+    def test_onboard_users(self):
+        results = self.db.onboard_users([
+            self.create_user('bob@x.com'),
+            self.create_user('bob@x.com'),
+            self.create_user('alice@x.com', agent_id=2),
+            self.create_user('carol@x.com')
+        ])
+        self.assertEqual(results[0], (1, 1))
+        self.assertIsInstance(results[1], sqlite3.IntegrityError)
+        self.assertIsInstance(results[2], Exception)
+        # NOTE the failed rows left nothing behind
+        self.assertEqual(results[3], (2, 2))
+        self.assertEqual(self.db.connection.execute('SELECT COUNT(*) FROM users').fetchone(), (2,))
+        self.assertFalse(self.db.connection.in_transaction)
+
+
+class TestArchives(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(sqlite3.connect(':memory:'))
+        self.db.migrate()
+        for i in range(4):
+            self.db.add_user_message(1, 'Salut %d' % i, message_id='<%d@x>' % i)
+            self.db.add_assistant_message(1, 'Bonjour %d' % i)
+        self.db.add_user_message(2, 'Coucou')
+        self.db.save_summary(1, 6, 'Bob said hello three times.')
+
+    def tearDown(self):
+        self.db.connection.close()
+
+    def test_archive_messages(self):
+        self.assertEqual(self.db.get_archivable_conversations('9999'), [(1, 6)])
+        self.assertEqual(self.db.archive_messages(1, 6, '9999'), 6)
+        self.assertEqual(self.db.get_archivable_conversations('9999'), [])
+        self.assertEqual([id for id, role, content in self.db.get_messages_after(1, 6)], [7, 8])
+
+        archived = self.db.get_archived_messages(1)
+        self.assertEqual([message['id'] for message in archived], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(archived[0]['message_id'], '<0@x>')
+        messages = self.db.get_messages_by_conversation(1, archived=True)
+        self.assertEqual(messages[0], ('user', 'Salut 0'))
+        self.assertEqual(len(messages), 8)
+        self.assertEqual(len(self.db.get_messages_by_conversation(1)), 2)
+
+    def test_archive_recent_messages(self):
+        self.assertEqual(self.db.get_archivable_conversations(''), [])
+        self.assertEqual(self.db.archive_messages(1, 6, ''), 0)
+
+
+class TestDormancy(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(sqlite3.connect(':memory:'))
+        self.db.migrate()
+        self.db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+        for i in range(3):
+            self.db.create_user('User %d' % i, 'user%d@x.com' % i, 'salt', 'password')
+            self.db.create_conversation(i + 1, 1, 'A1', 'gemma3')
+            self.db.add_user_message(i + 1, 'Bonjour')
+
+    def tearDown(self):
+        self.db.connection.close()
+
+    def test_create_message_activity(self):
+        last_message_at, bumps = self.db.get_activity(1)
+        self.assertIsNotNone(last_message_at)
+        self.db.add_bump_message(1, 'Tu es là ?')
+        self.db.add_bump_message(1, 'Tu es là ?')
+        self.assertEqual(self.db.get_activity(1)[1], 2)
+        self.assertGreater(self.db.get_activity(1)[0], last_message_at)
+        # NOTE the user answering resets the bumps
+        self.db.add_user_message(1, 'Oui !')
+        self.assertEqual(self.db.get_activity(1)[1], 0)
+
+    def test_get_dormant_conversations(self):
+        self.assertEqual(self.db.get_dormant_conversations('0000', 2, 10), [])
+        self.assertEqual(self.db.get_dormant_conversations('9999', 2, 10), [1, 2, 3])
+        self.assertEqual(self.db.get_dormant_conversations('9999', 2, 1), [1])
+
+        self.db.add_bump_message(2, 'Tu es là ?')
+        self.assertEqual(self.db.get_dormant_conversations('9999', 1, 10), [1, 3])
+
+        # NOTE conversations with a job in flight are left alone
+        self.db.enqueue_bumps([1], '9999')
+        self.assertEqual(self.db.get_dormant_conversations('9999', 2, 10), [3, 2])
+        job = self.db.job_to_dict(self.db.claim_job(60))
+        self.assertEqual(job['payload']['before'], '9999')
+        self.db.fail_job(job['id'], 'error', 0, 1)
+        self.assertEqual(self.db.get_dormant_conversations('9999', 2, 10), [3, 2])
+
+    def test_get_active_models(self):
+        self.db.create_user('User 3', 'user3@x.com', 'salt', 'password')
+        self.db.create_conversation(4, 1, 'A1', 'llama3.2')
+        self.assertEqual(self.db.get_active_models('9999'), [])
+        self.assertEqual(self.db.get_active_models('0000'), [('gemma3', 3)])
+        self.db.add_user_message(4, 'Bonjour')
+        self.assertEqual(self.db.get_active_models('0000'), [('gemma3', 3), ('llama3.2', 1)])
+        # NOTE found through the index rather than a scan of every message
+        statements = []
+        self.db.connection.set_trace_callback(statements.append)
+        self.db.get_active_models('0000')
+        self.db.connection.set_trace_callback(None)
+        plan = ' '.join(row[-1] for row in self.db.connection.execute(
+                'EXPLAIN QUERY PLAN ' + statements[-1].replace("'0000'", '?'), ('0000',)))
+        self.assertIn('SEARCH conversations USING INDEX conversations_last_message_at_idx', plan)
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(sqlite3.connect(':memory:'))
+
+    def tearDown(self):
+        self.db.connection.close()
+
+    def get_indexes(self, table_name):
+        res = self.db.connection.execute('PRAGMA index_list(%s)' % (table_name,))
+        return [row[1] for row in res.fetchall()]
+
+    def test_migrate_fresh_database(self):
+        self.assertEqual(self.db.migrate(), SCHEMA_VERSION)
+        self.assertEqual(self.db.get_schema_version(), SCHEMA_VERSION)
+        self.assertIn('messages_conversation_id_id_idx', self.get_indexes('messages'))
+
+    def test_migrate_existing_database(self):
+        # NOTE databases created before migrations only have the tables
+        self.db.connection.execute("""
+            CREATE TABLE messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        """)
+        self.assertEqual(self.db.get_schema_version(), 0)
+        self.db.migrate()
+        self.assertIn('messages_conversation_id_id_idx', self.get_indexes('messages'))
+        self.assertIn('sent_at', [row[1] for row in self.db.connection.execute('PRAGMA table_info(messages)')])
+        # NOTE migrating again is a no-op
+        self.assertEqual(self.db.migrate(), SCHEMA_VERSION)
+
+    def test_migrate_last_message_at(self):
+        self.db.connection.execute("""
+            CREATE TABLE conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                agent_id INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                proficiency TEXT NOT NULL
+            )
+        """)
+        self.db.connection.execute("INSERT INTO conversations (user_id, agent_id, model, proficiency) VALUES (1, 1, 'gemma3', 'A1')")
+        self.db.connection.execute("INSERT INTO conversations (user_id, agent_id, model, proficiency) VALUES (2, 1, 'gemma3', 'A1')")
+        self.db.create_schema()
+        self.db.connection.execute("""
+            INSERT INTO messages (conversation_id, role, content, created_at)
+            VALUES (1, 'user', 'Bonjour', '2025-03-01'), (1, 'assistant', 'Salut', '2025-03-02')
+        """)
+        self.db.migrate()
+        self.assertEqual(self.db.get_activity(1), ('2025-03-02', 0))
+        self.assertEqual(self.db.get_activity(2), (None, 0))
+        self.assertIn('conversations_last_message_at_idx', self.get_indexes('conversations'))
+
+    def test_migrate_user_weight(self):
+        self.db.connection.execute("""
+            CREATE TABLE users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                email TEXT UNIQUE,
+                salt TEXT NOT NULL,
+                password TEXT NOT NULL
+            )
+        """)
+        self.db.connection.execute("INSERT INTO users (name, email, salt, password) VALUES ('Bob', 'bob@x.com', 's', 'p')")
+        self.db.migrate()
+        self.assertEqual(self.db.connection.execute('SELECT weight FROM users').fetchone(), (1.0,))
+        self.assertEqual(self.db.set_user_weight(1, 2.5)[-1], 2.5)
+        self.assertIsNone(self.db.set_user_weight(2, 2.5))
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        fd, self.url = tempfile.mkstemp()
+        os.close(fd)
+        self.pool = ConnectionPool(self.url, readers=2)
+        with self.pool.write() as db:
+            db.migrate()
+
+    def tearDown(self):
+        self.pool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.url + suffix):
+                os.remove(self.url + suffix)
+
+    def test_journal_mode(self):
+        with self.pool.read() as db:
+            self.assertEqual(db.connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_read_is_query_only(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.pool.read() as db:
+                db.enqueue_job('reply', {})
+
+    def test_concurrent_writes(self):
+        def enqueue():
+            for _ in range(50):
+                with self.pool.write() as db:
+                    db.enqueue_job('reply', {})
+
+        threads = [threading.Thread(target=enqueue) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with self.pool.read() as db:
+            self.assertEqual(db.connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
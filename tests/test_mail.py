@@ -1,6 +1,18 @@
+import asyncio
+import time
 import unittest
 
-from françoise.mail import parse_to_header, parse_conversation_id_from_headers
+import httpx
+
+from françoise.breaker import CircuitBreaker, CircuitOpen
+from françoise.mail import (
+    MailClient,
+    RateLimited,
+    normalize_body,
+    parse_retry_after,
+    parse_to_header,
+    parse_conversation_id_from_headers
+)
 
 
 class TestMail(unittest.TestCase):
@@ -14,6 +26,133 @@ class TestMail(unittest.TestCase):
         conversation_id = parse_conversation_id_from_headers(headers)
         self.assertEqual(conversation_id, 2)
 
+    def test_normalize_body(self):
+        self.assertEqual(normalize_body('  Bonjour Françoise !\r\n'), 'Bonjour Françoise !')
+
+    def test_normalize_body_attribution(self):
+        body = 'Merci !\n\nOn Mon, Mar 3, 2025 at 10:12 AM Françoise <\nf@example.com> wrote:\n> Bonjour\n> Comment ça va ?'
+        self.assertEqual(normalize_body(body), 'Merci !')
+        body = 'Merci !\r\n\r\nLe lun. 3 mars 2025 à 10:12, Françoise <f@example.com> a écrit\u202f:\r\n> Bonjour'
+        self.assertEqual(normalize_body(body), 'Merci !')
+
+    def test_normalize_body_attribution_without_address(self):
+        body = 'Merci !\n\nOn Mon, Mar 3, 2025 at 10:12 AM Françoise wrote:\n> Bonjour'
+        self.assertEqual(normalize_body(body), 'Merci !')
+
+    def test_normalize_body_prose(self):
+        # NOTE sentences shaped like an attribution are the user's own words
+        body = 'Bonjour Françoise,\nLe journal a écrit :\nil fait beau demain.'
+        self.assertEqual(normalize_body(body), body)
+        body = 'On Monday my teacher wrote:\n"Practice every day."'
+        self.assertEqual(normalize_body(body), body)
+        body = 'Le 3 mars, ma sœur a écrit :\nJe viens samedi.'
+        self.assertEqual(normalize_body(body), body)
+
+    def test_normalize_body_inline_quotes(self):
+        body = '> Tu aimes le cinéma ?\nOui, beaucoup.\n> Et la musique ?\nAussi.'
+        self.assertEqual(normalize_body(body), 'Oui, beaucoup.\nAussi.')
+
+    def test_normalize_body_outlook(self):
+        body = 'Merci !\n\nFrom: Françoise <f@example.com>\nSent: Monday, March 3, 2025 10:12 AM\nTo: Bob\n\nBonjour'
+        self.assertEqual(normalize_body(body), 'Merci !')
+        body = 'Merci !\n\n-----Original Message-----\nBonjour'
+        self.assertEqual(normalize_body(body), 'Merci !')
+
+    def test_normalize_body_signature(self):
+        self.assertEqual(normalize_body('Merci !\n-- \nBob\n555-1234'), 'Merci !')
+        self.assertEqual(normalize_body('Merci !\n\nEnvoyé de mon iPhone'), 'Merci !')
+
+    def test_normalize_body_fully_quoted(self):
+        self.assertEqual(normalize_body('> Bonjour'), '> Bonjour')
+
+
+def create_mail_client(handler, **kwargs) -> MailClient:
+    client = MailClient('http://mailgun/v3/example.com/messages', 'key', **kwargs)
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+class TestMailClient(unittest.TestCase):
+    def test_send(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, json={'id': '<1@example.com>'})
+
+        client = create_mail_client(handler)
+        response = asyncio.run(client.send({'to': 'bob@x.com', 'text': 'Bonjour'}))
+        self.assertEqual(response['id'], '<1@example.com>')
+        self.assertEqual(requests[0].content, b'to=bob%40x.com&text=Bonjour')
+        self.assertTrue(requests[0].headers['Authorization'].startswith('Basic '))
+
+    def test_send_rate_limited(self):
+        client = create_mail_client(lambda request: httpx.Response(429, headers={'Retry-After': '120'}))
+        with self.assertRaises(RateLimited) as context:
+            asyncio.run(client.send({'text': 'Bonjour'}))
+        self.assertEqual(context.exception.delay, 120)
+        self.assertEqual(client.breaker.failures, 0)
+
+    def test_send_circuit_open(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(503)
+
+        client = create_mail_client(handler, breaker=CircuitBreaker(failure_threshold=2))
+        for _ in range(2):
+            with self.assertRaises(httpx.HTTPStatusError):
+                asyncio.run(client.send({'text': 'Bonjour'}))
+        # NOTE Mailgun is no longer called while the circuit is open
+        with self.assertRaises(CircuitOpen):
+            asyncio.run(client.send({'text': 'Bonjour'}))
+        self.assertEqual(len(calls), 2)
+
+    def test_send_half_open_rate_limited(self):
+        responses = [httpx.Response(503), httpx.Response(429, headers={'Retry-After': '5'}), httpx.Response(200, json={})]
+        client = create_mail_client(lambda request: responses.pop(0), breaker=CircuitBreaker(failure_threshold=1))
+        with self.assertRaises(httpx.HTTPStatusError):
+            asyncio.run(client.send({'text': 'Bonjour'}))
+        client.breaker.opened_at = time.monotonic() - client.breaker.reset_timeout
+        # NOTE the trial send is throttled, which still shows Mailgun is up
+        with self.assertRaises(RateLimited):
+            asyncio.run(client.send({'text': 'Bonjour'}))
+        self.assertEqual(client.breaker.state, 'closed')
+        self.assertEqual(asyncio.run(client.send({'text': 'Bonjour'})), {})
+
+    def test_send_half_open_cancelled(self):
+        client = create_mail_client(lambda request: httpx.Response(200, json={}), breaker=CircuitBreaker(failure_threshold=1))
+        client.breaker.failure()
+        client.breaker.opened_at = time.monotonic() - client.breaker.reset_timeout
+
+        async def cancel():
+            task = asyncio.create_task(client.send({'text': 'Bonjour'}))
+            # NOTE the bucket is drained, so the trial send waits on it
+            client.bucket.tokens = -10
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel())
+        self.assertFalse(client.breaker.trial)
+        client.bucket.tokens = client.bucket.burst
+        self.assertEqual(asyncio.run(client.send({'text': 'Bonjour'})), {})
+
+    def test_send_rejected(self):
+        client = create_mail_client(lambda request: httpx.Response(400), breaker=CircuitBreaker(failure_threshold=1))
+        with self.assertRaises(httpx.HTTPStatusError):
+            asyncio.run(client.send({'text': 'Bonjour'}))
+        # NOTE a rejected email is not a sign Mailgun is down
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('30', 60), 30)
+        self.assertEqual(parse_retry_after(None, 60), 60)
+        self.assertEqual(parse_retry_after('soon', 60), 60)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', 60), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
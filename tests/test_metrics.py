@@ -0,0 +1,52 @@
+import unittest
+
+from françoise.metrics import Counter, Gauge, Histogram, registry
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = list(registry.metrics)
+        registry.enabled = True
+
+    def tearDown(self):
+        registry.metrics = self.metrics
+        registry.enabled = False
+
+    def test_disabled(self):
+        registry.enabled = False
+        counter = Counter('test_disabled_total', 'Test counter.')
+        counter.inc()
+        self.assertEqual(counter.get_values(), {})
+
+    def test_counter(self):
+        counter = Counter('test_total', 'Test counter.', ('outcome',))
+        counter.inc(outcome='accepted')
+        counter.inc(2, outcome='accepted')
+        self.assertIn('test_total{outcome="accepted"} 3.0\n', counter.render())
+
+    def test_gauge_function(self):
+        gauge = Gauge('test_gauge', 'Test gauge.', ('kind', 'status'))
+        gauge.set_function(lambda: {('reply', 'pending'): 2})
+        self.assertIn('test_gauge{kind="reply",status="pending"} 2.0\n', gauge.render())
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test histogram.', ('stage',), buckets=(0.1, 1))
+        histogram.observe(0.05, stage='send')
+        histogram.observe(0.5, stage='send')
+        histogram.observe(5, stage='send')
+        rendered = histogram.render()
+        self.assertIn('# TYPE test_seconds histogram\n', rendered)
+        self.assertIn('test_seconds_bucket{stage="send",le="0.1"} 1\n', rendered)
+        self.assertIn('test_seconds_bucket{stage="send",le="1.0"} 2\n', rendered)
+        self.assertIn('test_seconds_bucket{stage="send",le="+Inf"} 3\n', rendered)
+        self.assertIn('test_seconds_sum{stage="send"} 5.55\n', rendered)
+        self.assertIn('test_seconds_count{stage="send"} 3\n', rendered)
+
+    def test_label_escaping(self):
+        counter = Counter('test_escaped_total', 'Test counter.', ('agent',))
+        counter.inc(agent='Fran"çoise')
+        self.assertIn('test_escaped_total{agent="Fran\\"çoise"} 1.0\n', counter.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
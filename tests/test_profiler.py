@@ -0,0 +1,46 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from françoise.profiler import Profiler
+
+
+def render_prompt(n: int) -> str:
+    return ''.join(str(i) for i in range(n))
+
+
+async def handler(job: dict) -> None:
+    for _ in range(5):
+        render_prompt(20000)
+        await asyncio.sleep(0.01)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_unsampled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory, sample_rate=0)
+            asyncio.run(profiler.wrap(handler)({'id': 1, 'kind': 'reply'}))
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(profiler.render_stacks(), '')
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory, sample_rate=1, interval=0.001)
+            asyncio.run(profiler.wrap(handler)({'id': 1, 'kind': 'reply'}))
+            names = sorted(os.listdir(directory))
+            self.assertEqual(len(names), 2)
+            self.assertTrue(names[0].endswith('-reply-1.allocations.txt'))
+            self.assertTrue(names[1].endswith('-reply-1.prof'))
+            self.assertIsNone(profiler.active)
+
+            stacks = profiler.render_stacks(reset=True)
+            self.assertIn('test_profiler.py:handler', stacks)
+            for line in stacks.splitlines():
+                stack, count = line.rsplit(' ', 1)
+                self.assertGreater(int(count), 0)
+            self.assertEqual(profiler.render_stacks(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
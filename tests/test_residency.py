@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timezone
+import json
+import unittest
+
+import httpx
+
+from françoise.residency import ResidencyManager, get_seconds_until, parse_hours
+from tests.test_router import create_router, handle_probe
+
+
+class TestResidency(unittest.TestCase):
+    messages = [{'role': 'user', 'content': 'Salut'}]
+
+    def test_parse_hours(self):
+        self.assertEqual(parse_hours('5, 3,24'), [0, 3, 5])
+        self.assertEqual(parse_hours(None), [])
+
+    def test_get_seconds_until(self):
+        now = datetime(2026, 1, 1, 2, 30, tzinfo=timezone.utc)
+        self.assertEqual(get_seconds_until([3, 4], now), 1800)
+        self.assertEqual(get_seconds_until([2], now), 23.5 * 3600)
+
+    def test_get_keep_alive(self):
+        residency = ResidencyManager(None, None, keep_alive_min=300, keep_alive_max=3600, window=3600)
+        self.assertEqual(residency.get_keep_alive('gemma3'), 300)
+        # NOTE a single request an hour is too rare to hold the model for
+        residency.record('gemma3')
+        self.assertEqual(residency.get_keep_alive('gemma3'), 300)
+        residency.record('gemma3')
+        self.assertEqual(residency.get_keep_alive('gemma3'), 3600)
+        for _ in range(10):
+            residency.record('gemma3')
+        self.assertEqual(residency.get_keep_alive('gemma3'), 600)
+
+    def test_complete(self):
+        requests = []
+
+        def handler(request):
+            response = handle_probe(request)
+            if response:
+                return response
+            requests.append(json.loads(request.content))
+            return httpx.Response(200, json={'message': {'role': 'assistant', 'content': 'Bonjour'}, 'done': True})
+
+        async def complete(residency):
+            await residency.router.probe_all()
+            return await residency.chat(self.messages, model='gemma3')
+
+        residency = ResidencyManager(create_router(handler, urls=('http://a:11434',)), None)
+        self.assertEqual(asyncio.run(complete(residency)), 'Bonjour')
+        self.assertEqual(requests[0]['keep_alive'], 300)
+
+    def test_warm(self):
+        requests = []
+
+        def handler(request):
+            response = handle_probe(request)
+            if response:
+                return response
+            requests.append(json.loads(request.content))
+            return httpx.Response(200, json={'model': 'gemma3', 'done': True, 'done_reason': 'load'})
+
+        async def warm(residency):
+            await residency.router.probe_all()
+            await residency.warm('gemma3', 3600)
+            # NOTE the model is now known to be loaded, so it is not loaded again
+            await residency.warm('gemma3', 3600)
+
+        residency = ResidencyManager(create_router(handler), None)
+        asyncio.run(warm(residency))
+        self.assertEqual(requests, [{'model': 'gemma3', 'messages': [], 'keep_alive': 3600}])
+        self.assertTrue(residency.router.is_loaded('gemma3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
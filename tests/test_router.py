@@ -0,0 +1,109 @@
+import asyncio
+import unittest
+
+import httpx
+
+from françoise.chat import ChatClient
+from françoise.router import Router, normalize_model, parse_backend_urls
+
+
+def create_router(handler, urls=('http://a:11434', 'http://b:11434')) -> Router:
+    transport = httpx.MockTransport(handler)
+
+    def create_client(url):
+        client = ChatClient(url)
+        client.client = httpx.AsyncClient(transport=transport)
+        return client
+
+    router = Router(list(urls), create_client)
+    router.probe_client = httpx.AsyncClient(transport=transport)
+    return router
+
+
+def handle_probe(request, models=('gemma3:latest',), loaded=()):
+    if request.url.path == '/api/tags':
+        return httpx.Response(200, json={'models': [{'name': name} for name in models]})
+    if request.url.path == '/api/ps':
+        return httpx.Response(200, json={'models': [{'name': name} for name in loaded]})
+    return None
+
+
+class TestRouter(unittest.TestCase):
+    messages = [{'role': 'user', 'content': 'Salut'}]
+
+    def test_parse_backend_urls(self):
+        self.assertEqual(parse_backend_urls('http://a:11434/api/chat, http://b:11434/'),
+                         ['http://a:11434', 'http://b:11434'])
+
+    def test_normalize_model(self):
+        self.assertEqual(normalize_model('gemma3'), 'gemma3:latest')
+        self.assertEqual(normalize_model('gemma3:12b'), 'gemma3:12b')
+
+    def test_select(self):
+        def handler(request):
+            loaded = ('gemma3:latest',) if request.url.host == 'b' else ()
+            return handle_probe(request, loaded=loaded)
+        router = create_router(handler, urls=('http://a:11434', 'http://b:11434', 'http://c:11434'))
+        asyncio.run(router.probe_all())
+        # NOTE backends with the model loaded and a free slot win, then the
+        # least loaded
+        self.assertEqual(router.select('gemma3', set()).url, 'http://b:11434')
+        router.backends[1].in_flight = 1
+        self.assertEqual(router.select('gemma3', set()).url, 'http://b:11434')
+        self.assertEqual(router.select('gemma3', {router.backends[1]}).url, 'http://a:11434')
+        router.backends[0].in_flight = 1
+        self.assertEqual(router.select('gemma3', {router.backends[1]}).url, 'http://c:11434')
+        self.assertIsNone(router.select('llama3', set()))
+
+    def test_select_saturated(self):
+        def handler(request):
+            loaded = ('gemma3:latest',) if request.url.host == 'a' else ()
+            return handle_probe(request, loaded=loaded)
+        router = create_router(handler)
+        asyncio.run(router.probe_all())
+        router.backends[0].in_flight = 3
+        self.assertEqual(router.select('gemma3', set()).url, 'http://a:11434')
+        # NOTE once the loaded backend is full, generations spill over
+        router.backends[0].in_flight = 4
+        self.assertEqual(router.select('gemma3', set()).url, 'http://b:11434')
+        router.backends[1].in_flight = 4
+        self.assertEqual(router.select('gemma3', set()).url, 'http://a:11434')
+
+    def test_complete_spreads_load(self):
+        async def handler(request):
+            response = handle_probe(request, loaded=('gemma3:latest',) if request.url.host == 'a' else ())
+            if response:
+                return response
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json={'message': {'role': 'assistant', 'content': 'Bonjour'}, 'done': True})
+
+        async def chat(router):
+            await router.probe_all()
+            return await asyncio.gather(*(router.complete(self.messages, model='gemma3') for _ in range(16)))
+
+        results = asyncio.run(chat(create_router(handler)))
+        backends = [result['backend'] for result in results]
+        self.assertEqual(backends.count('http://a:11434'), 8)
+        self.assertEqual(backends.count('http://b:11434'), 8)
+
+    def test_failover(self):
+        def handler(request):
+            response = handle_probe(request)
+            if response:
+                return response
+            if request.url.host == 'a':
+                raise httpx.ConnectError('connection refused')
+            return httpx.Response(200, json={'message': {'role': 'assistant', 'content': 'Bonjour'}, 'done': True})
+
+        async def chat(router):
+            await router.probe_all()
+            router.backends[1].in_flight = 1
+            return await router.chat(self.messages, model='gemma3')
+
+        router = create_router(handler)
+        self.assertEqual(asyncio.run(chat(router)), 'Bonjour')
+        self.assertFalse(router.backends[0].healthy)
+
+
+if __name__ == '__main__':
+    unittest.main()
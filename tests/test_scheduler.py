@@ -0,0 +1,60 @@
+import asyncio
+import unittest
+
+from françoise.scheduler import FairScheduler
+
+
+class FakeChat:
+    def __init__(self):
+        self.calls = []
+
+    async def complete(self, messages, **kwargs):
+        self.calls.append(messages[0]['content'])
+        await asyncio.sleep(0)
+        return {'message': {'role': 'assistant', 'content': 'Bonjour'}}
+
+
+class TestScheduler(unittest.TestCase):
+    def run_requests(self, scheduler, requests):
+        async def run():
+            # NOTE holds the only slot until every request is waiting
+            await scheduler.acquire('holder', 1.0, 1.0)
+            tasks = [asyncio.create_task(scheduler.chat([{'role': 'user', 'content': content}], model='gemma3', **kwargs))
+                     for content, kwargs in requests]
+            await asyncio.sleep(0)
+            scheduler.release()
+            await asyncio.gather(*tasks)
+        asyncio.run(run())
+        return scheduler.client.calls
+
+    def test_fair_across_tenants(self):
+        scheduler = FairScheduler(FakeChat(), capacity=1)
+        requests = [('bob %d' % i, {'tenant': 1}) for i in range(4)] + [('alice', {'tenant': 2})]
+        calls = self.run_requests(scheduler, requests)
+        # NOTE alice does not wait behind the whole of bob's backlog
+        self.assertEqual(calls.index('alice'), 1)
+
+    def test_weights(self):
+        scheduler = FairScheduler(FakeChat(), capacity=1)
+        requests = []
+        for i in range(3):
+            requests.append(('bob %d' % i, {'tenant': 1, 'weight': 1}))
+            requests.append(('alice %d' % i, {'tenant': 2, 'weight': 3}))
+        calls = self.run_requests(scheduler, requests)
+        self.assertEqual(calls[:4], ['bob 0', 'alice 0', 'alice 1', 'alice 2'])
+
+    def test_cancelled_waiter(self):
+        async def run():
+            scheduler = FairScheduler(FakeChat(), capacity=1)
+            await scheduler.acquire(1, 1.0, 1.0)
+            task = asyncio.create_task(scheduler.acquire(2, 1.0, 1.0))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            scheduler.release()
+            return scheduler.active
+        self.assertEqual(asyncio.run(run()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
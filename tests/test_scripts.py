@@ -0,0 +1,180 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from typing import Optional
+import unittest
+from urllib.parse import parse_qs
+
+from françoise.db import open_db
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+
+def run_script(name: str, *args: str, env: Optional[dict] = None) -> str:
+    result = subprocess.run(
+            [sys.executable, os.path.join(SCRIPTS_DIR, name), *args],
+            capture_output=True,
+            text=True,
+            check=True,
+            env={**os.environ, **(env or {})})
+    return result.stdout
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # NOTE stands in for both Ollama and Mailgun, recording what it was sent
+    def send_json(self, data: dict) -> None:
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_json({'models': [{'name': 'gemma3:latest'}]})
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        if self.path == '/messages':
+            self.server.sent.append({k: v[0] for k, v in parse_qs(content).items()})
+            self.send_json({'id': '<%d@x>' % (len(self.server.sent),)})
+            return
+        if json.loads(content).get('messages'):
+            self.server.generated.append(content)
+        self.send_json({'message': {'role': 'assistant', 'content': 'Bienvenue !'}, 'done': True})
+
+    def log_message(self, *args):
+        pass
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source.db')
+        self.target = os.path.join(self.directory.name, 'target.db')
+        self.export = os.path.join(self.directory.name, 'export.jsonl')
+        with open_db(self.source) as db:
+            db.migrate()
+            db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+            db.create_user('Bob', 'bob@x.com', b'salt', b'password')
+            db.create_conversation(1, 1, 'A1', 'gemma3')
+            for i in range(4):
+                db.add_user_message(1, 'Salut %d' % i, message_id='<%d@x>' % i)
+                db.add_assistant_message(1, 'Bonjour %d' % i)
+            db.save_summary(1, 6, 'Bob said hello three times.')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip_compacted(self):
+        run_script('compact.py', '-d', '0', '-db', self.source)
+        run_script('db-export.py', '-o', self.export, '-db', self.source)
+        run_script('db-import.py', '-i', self.export, '-db', self.target)
+
+        with open_db(self.source) as source, open_db(self.target) as target:
+            self.assertEqual(len(source.get_messages_by_conversation(1)), 2)
+            # NOTE the archived messages came along, as did the summary that
+            # stands in for them in prompts
+            self.assertEqual(
+                    target.get_messages_by_conversation(1, archived=True),
+                    source.get_messages_by_conversation(1, archived=True))
+            self.assertEqual(len(target.get_messages_by_conversation(1, archived=True)), 8)
+            self.assertEqual(target.get_summary(1), source.get_summary(1))
+            for table_name in ('users', 'conversations', 'messages', 'summaries', 'archives'):
+                self.assertEqual(list(target.iter_rows(table_name)), list(source.iter_rows(table_name)))
+
+
+class TestOnboard(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.directory.name, 'data.db')
+        with open_db(self.database) as db:
+            db.migrate()
+            db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def onboard(self, name: str, content: str) -> tuple[str, list[str]]:
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        output = run_script('user-onboard.py', '-f', path, '-a', '1', '-prof', 'A1', '--workers', '1', '-db', self.database)
+        with open_db(self.database) as db:
+            return (output, [row['email'] for row in db.iter_rows('users')])
+
+    def test_onboard_csv(self):
+        output, emails = self.onboard('users.csv', '\n'.join((
+            'name,email,password',
+            'Bob,bob@x.com,secret',
+            'Eve,eve@x.com,',
+            'Alice,alice@x.com,secret')))
+        self.assertEqual(emails, ['bob@x.com', 'alice@x.com'])
+        self.assertIn('failed to onboard line `3` (`eve@x.com`): missing password', output)
+        self.assertIn('onboarded `2`, failed `1`', output)
+
+    def test_onboard_jsonl(self):
+        output, emails = self.onboard('users.jsonl', '\n'.join((
+            '{"name": "Bob", "email": "bob@x.com", "password": "secret"}',
+            '{"name": "Eve", "email": ',
+            '[1, 2]',
+            '{"name": "Alice", "email": "alice@x.com", "password": "secret"}')))
+        # NOTE the rows around a line that is not JSON, or not an object, go on
+        self.assertEqual(emails, ['bob@x.com', 'alice@x.com'])
+        self.assertIn('failed to onboard line `2`', output)
+        self.assertIn('failed to onboard line `3` (`None`): row is not an object', output)
+        self.assertIn('onboarded `2`, failed `2`', output)
+
+
+class TestConversationStarter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.directory.name, 'data.db')
+        with open_db(self.database) as db:
+            db.migrate()
+            db.create_agent('Françoise', 'French', 'B1', 'You are {agent_name}.')
+            db.create_agent('Amélie', 'French', 'B1', 'You are {agent_name}.')
+            db.create_user('Bob', 'bob@x.com', 'salt', 'password')
+            db.create_conversation(1, 1, 'A1', 'gemma3')
+            db.create_conversation(1, 2, 'A1', 'gemma3')
+            # NOTE a previous run generated this welcome, then stopped before mailing it
+            db.add_assistant_message(1, 'Bonjour Bob !')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.sent = []
+        self.server.generated = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d' % (self.server.server_address[1],)
+        self.env = {
+            'LLM_API_URLS': url,
+            'MAILGUN_API_URL': url + '/messages',
+            'MAILGUN_API_KEY': 'key',
+            'MAILGUN_API_SENDER': 'francoise@x.com'
+        }
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def test_resume(self):
+        run_script('conversation-starter.py', '--id', '1-2', '-db', self.database, env=self.env)
+        # NOTE the unsent welcome is mailed as it was, only the other is generated
+        self.assertEqual(len(self.server.generated), 1)
+        self.assertEqual(sorted(mail['text'] for mail in self.server.sent), ['Bienvenue !', 'Bonjour Bob !'])
+        with open_db(self.database) as db:
+            self.assertTrue(all(row['sent_at'] for row in db.iter_rows('messages')))
+
+        # NOTE a run after that has nothing left to send
+        output = run_script('conversation-starter.py', '--id', '1-2', '-db', self.database, env=self.env)
+        self.assertIn('skipped `2`', output)
+        self.assertEqual(len(self.server.generated), 1)
+        self.assertEqual(len(self.server.sent), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from françoise.db import ConnectionPool, open_db
+from françoise.worker import WorkerPool
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        fd, self.url = tempfile.mkstemp()
+        os.close(fd)
+        with open_db(self.url) as db:
+            db.migrate()
+            db.enqueue_job('reply', {}, conversation_id=1)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.url + suffix):
+                os.remove(self.url + suffix)
+
+    def test_lock_is_kept(self):
+        pool = ConnectionPool(self.url)
+        claims = []
+
+        async def handler(job):
+            # NOTE runs for several visibility timeouts, during which the job
+            # must not be claimable by another worker
+            for _ in range(4):
+                await asyncio.sleep(0.1)
+                with pool.write() as db:
+                    claims.append(db.claim_job(0.15))
+
+        async def run():
+            workers = WorkerPool(pool, {'reply': handler}, concurrency=0, visibility_timeout=0.15)
+            await workers.run_job(workers.claim())
+
+        try:
+            asyncio.run(run())
+            with pool.read() as db:
+                self.assertEqual(db.count_jobs(), {})
+        finally:
+            pool.close()
+        self.assertEqual(claims, [None] * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()